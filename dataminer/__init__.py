@@ -4,15 +4,175 @@ import argparse
 from pathlib import Path
 import sys
 from dataminer.build import process_dir, load_config
+from dataminer.memory import parse_size
+from dataminer.shard import parse_shard
+from dataminer.worker import WORKER_POOL
 
 
-def run():
+def run_build(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", required=True)
     parser.add_argument("input", type=Path)
     parser.add_argument("output", type=Path)
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of files processed in parallel"
+    )
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="print the predicted work list and runtime without processing anything",
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="skip work that an earlier, interrupted run already completed, and files that "
+        "didn't change since the last run",
+    )
+    parser.add_argument(
+        "--shard", type=parse_shard, default=None, metavar="i/N",
+        help="only process the i-th of N deterministic parts of the input",
+    )
+    parser.add_argument(
+        "--only-changed", action="store_true",
+        help="leave output files whose contents didn't change untouched, and skip input files "
+        "that didn't change since the last run",
+    )
+    parser.add_argument(
+        "--max-memory", type=parse_size, default=None, metavar="SIZE",
+        help="limit on the contents of archive entries read ahead by the extract stage and "
+        "held until the processors are done with them, e.g. 2G. Extraction waits for the "
+        "processors while it's used up",
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="after the initial run, keep reprocessing files as they change",
+    )
+    parser.add_argument(
+        "--settle", type=float, default=5.0,
+        help="seconds without changes before a batch of changes is processed",
+    )
+    parser.add_argument(
+        "--poll", action="store_true", help="watch by polling instead of inotify"
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     load_config(args.config)
-    process_dir(args.input, args.output)
+
+    # Helpers are shared by the initial run and every batch in watch mode
+    try:
+        if args.watch:
+            from dataminer.watch import Watch
+
+            Watch(
+                args.input, args.output, args.settle, args.poll, args.jobs, args.only_changed,
+                args.max_memory,
+            ).run()
+        else:
+            runner = process_dir(
+                args.input, args.output, args.jobs, args.plan, args.resume, args.shard,
+                args.only_changed, args.max_memory, incremental=args.resume or args.only_changed,
+            )
+
+            if runner.failures:
+                sys.exit(1)
+    finally:
+        WORKER_POOL.close()
+
+
+def run_verify(argv):
+    from dataminer.verify import verify_paths
+
+    parser = argparse.ArgumentParser(prog="dataminer verify")
+    parser.add_argument("-j", "--threads", type=int, default=None)
+    parser.add_argument(
+        "--state",
+        type=Path,
+        default=None,
+        help="Remember the chunk hashes of verified vpks in this file, and next time "
+        "only check the chunks that changed (v2 vpks with archives only)",
+    )
+    parser.add_argument("input", type=Path, nargs="+")
+
+    args = parser.parse_args(argv)
+
+    if not verify_paths(args.input, args.threads, args.state):
+        sys.exit(1)
+
+
+def run_extract(argv):
+    from dataminer.extract import extract
+
+    parser = argparse.ArgumentParser(prog="dataminer extract")
+    parser.add_argument("-j", "--threads", type=int, default=None)
+    parser.add_argument(
+        "--match", action="append", default=None, metavar="GLOB",
+        help="only extract files whose output path matches, can be given more than once",
+    )
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path)
+
+    args = parser.parse_args(argv)
+
+    if not extract(args.input, args.output, args.match, args.threads):
+        sys.exit(1)
+
+
+def run_merge(argv):
+    from dataminer.shard import merge
+
+    parser = argparse.ArgumentParser(prog="dataminer merge")
+    parser.add_argument("output", type=Path)
+    parser.add_argument("shards", type=Path, nargs="+")
+
+    args = parser.parse_args(argv)
+
+    if not merge(args.shards, args.output):
+        sys.exit(1)
+
+
+def run_stats(argv):
+    from dataminer.metrics import compare, load_summary
+
+    parser = argparse.ArgumentParser(prog="dataminer stats")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare the metrics of two runs and flag regressions"
+    )
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.2,
+        help="relative change that counts as a regression (default 0.2)",
+    )
+    compare_parser.add_argument(
+        "--min-duration", type=float, default=1.0,
+        help="timings shorter than this many seconds are never flagged (default 1.0)",
+    )
+    compare_parser.add_argument(
+        "old", type=Path, help="run summary or output directory of the earlier run"
+    )
+    compare_parser.add_argument(
+        "new", type=Path, help="run summary or output directory of the later run"
+    )
+
+    args = parser.parse_args(argv)
+
+    regressions = compare(
+        load_summary(args.old), load_summary(args.new), args.threshold, args.min_duration
+    )
+    if regressions:
+        print(f"REGRESSIONS: {len(regressions)}")
+        sys.exit(1)
+
+
+COMMANDS = {
+    "verify": run_verify,
+    "extract": run_extract,
+    "merge": run_merge,
+    "stats": run_stats,
+}
+
+
+def run():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        run_build(sys.argv[1:])
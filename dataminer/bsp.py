@@ -0,0 +1,132 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import io
+import mmap
+import threading
+import zipfile
+
+DEFAULT_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+
+
+class BufferReader(io.RawIOBase):
+    """Stream with its own read position over a shared buffer, without copying it"""
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def readinto(self, b):
+        n = max(min(len(b), len(self.view) - self.pos), 0)
+        b[:n] = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+class BspPak:
+    """
+    The pakfile of a BSP, mmapped once. Every thread gets its own ZipFile over
+    the mapping, so entries can be decompressed in parallel (zlib and lzma release the GIL)
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fd:
+            self.mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapped)
+        self.local = threading.local()
+        # Whatever still needs the pak, it's closed when the last one is done with it
+        self.users = 0
+        self.users_lock = threading.Lock()
+
+        try:
+            self.infos = self.zip().infolist()
+        except Exception:
+            self.close()
+            raise
+
+    def zip(self) -> zipfile.ZipFile:
+        zf = getattr(self.local, "zip", None)
+        if zf is None:
+            zf = self.local.zip = zipfile.ZipFile(BufferReader(self.view))
+        return zf
+
+    def open(self, info: zipfile.ZipInfo):
+        return self.zip().open(info)
+
+    def read(self, info: zipfile.ZipInfo) -> bytes:
+        return self.zip().read(info)
+
+    def decompress_iter(self, infos, threads=None, max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES):
+        """
+        Yields (info, data) as soon as each entry is decompressed. Decompressed data that
+        hasn't been consumed yet is kept below max_in_flight_bytes (apart from single bigger entries)
+        """
+        infos = iter(infos)
+        next_info = next(infos, None)
+        in_flight = 0
+        pending = {}
+
+        with ThreadPoolExecutor(threads) as pool:
+            while True:
+                while next_info is not None and (
+                    not pending or in_flight + next_info.file_size <= max_in_flight_bytes
+                ):
+                    pending[pool.submit(self.read, next_info)] = next_info
+                    in_flight += next_info.file_size
+                    next_info = next(infos, None)
+
+                if not pending:
+                    return
+
+                # One at a time, finished futures would keep their data alive otherwise
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                info = pending.pop(future)
+                data = future.result()
+                del done, future
+
+                yield info, data
+                del data
+                in_flight -= info.file_size
+
+    def acquire(self):
+        with self.users_lock:
+            self.users += 1
+
+    def release(self):
+        with self.users_lock:
+            self.users -= 1
+            last = self.users == 0
+        if last:
+            self.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mapped.close()
+        except BufferError:
+            # Still referenced by a ZipFile somewhere, unmapped once that is gone
+            pass
@@ -1,15 +1,39 @@
-from dataminer.file import File
-from dataminer.processor import PROCESSORS, Processor
-from dataminer.extractor import EXTRACTORS
+from dataminer.bsp import DEFAULT_MAX_IN_FLIGHT_BYTES
+from dataminer.cache import DEFAULT_MAX_SIZE, ResultCache, config_hash
+from dataminer.file import SHARE_IN_MEMORY_SIZE, BSPPakFile, File
+from dataminer.inventory import Delta, Inventory
+from dataminer.memory import MemoryBudget, StageMemory
+from dataminer.metrics import METRICS, write_metrics
+from dataminer.overlay import OverlayIndex
+from dataminer.priority import PriorityClasses, clear_markers, write_marker
+from dataminer.processor import PROCESSORS, Processor, ToolTimeoutError
+from dataminer.extractor import EXTRACTORS, PathFilter
+
+from dataminer.journal import Journal
+from dataminer.output import OutputStats
+from dataminer.schedule import TimingHistory, predict_wall_time
+from dataminer.shard import shard_of, write_manifest
 
 from pathlib import Path
+import contextlib
 from fnmatch import fnmatchcase
-import os
+from itertools import groupby
+import json
+import queue
+import shutil
+import threading
 import yaml
 import time
 
 CONFIG = {}
 
+# Items per processing thread that can wait in the queues between the stages of a run,
+# what they hold in memory is limited by --max-memory
+QUEUE_DEPTH = 4
+
+# Sent through the queues once a stage is done
+_END = object()
+
 
 def load_config(path: Path):
     global CONFIG
@@ -23,64 +47,793 @@ def filter_match(path_to_match, filters):
     return False
 
 
-def process_dir(input_path: Path, output_path: Path):
-    output_root = output_path.absolute()
+class WorkItem:
+    """A file together with the processors that have to run on it"""
+
+    def __init__(self, file: File, processors: list[Processor], verify: bool):
+        self.file = file
+        self.processors = processors
+        self.verify = verify
+
+        self.relpath = file.relpath
+        self.size = file.size
+        self.identity = file.identity
+        self.cost = 0.0
+        # Index of its priority class, lower is done first
+        self.priority = 0
+        # Contents of archive entries end up in memory while they are processed, real files
+        # are mapped from the page cache
+        self.memory = 0 if file.is_real else self.size
+        # Hash of the contents, only computed if the result cache needs it
+        self.digest = None
+        # Part of the memory budget held from extraction until the processors are done
+        self.reserved = 0
+        # Relative path of the input file it comes from, an archive for archive entries
+        self.source = None
+
+
+class Failure:
+    def __init__(self, proc_name: str, relpath: str, kind: str, message: str, duration: float):
+        self.proc_name = proc_name
+        self.relpath = relpath
+        # "timeout" or "error"
+        self.kind = kind
+        self.message = message
+        self.duration = duration
+
+    def to_json(self):
+        return {
+            "processor": self.proc_name,
+            "path": self.relpath,
+            "kind": self.kind,
+            "message": self.message,
+            "duration": self.duration,
+        }
+
+
+class Runner:
+    """Instantiated processors for one output root, which files can be fed to one at a time"""
+
+    def __init__(
+        self, output_path: Path, resume=False, shard=None, only_changed=False, max_memory=None,
+        incremental=False,
+    ):
+        self.output_root = output_path.absolute()
+        METRICS.reset()
+        # (index, count), only files that hash into this shard are processed
+        self.shard = shard
+
+        self.processors: list[Processor] = []
+
+        self.proc_timings = {}
+        self.corrupt_files = []
+        self.failures: list[Failure] = []
+        self.lock = threading.Lock()
+        self.history = TimingHistory(self.output_root.joinpath(TimingHistory.FILE_NAME))
+        self.journal = Journal(self.output_root.joinpath(Journal.FILE_NAME), resume)
+        self.skipped = 0
+        # Output paths relative to the output root, for the manifest
+        self.outputs: set[str] = set()
+
+        proc_dict = {}
+        for proc in PROCESSORS:
+            proc_dict[proc.name] = proc
+
+        self.output_stats = OutputStats() if only_changed else None
+
+        for proc_config in CONFIG["processors"]:
+            name = proc_config["name"]
+            proc = proc_dict[name](self.output_root, proc_config)
+            proc.output_stats = self.output_stats
+            # Outputs of unchanged files are kept from the previous run as well
+            proc.resume = resume or incremental
 
-    if not output_root.exists():
-        output_root.mkdir(parents=True)
+            self.processors.append(proc)
 
-    instantiated_processors: list[Processor] = []
+        self.overlay: OverlayIndex = None
 
-    proc_timings = {}
-    proc_dict = {}
-    for proc in PROCESSORS:
-        proc_dict[proc.name] = proc
+        # Input files of this run, and what changed compared to the previous run
+        self.inventory: Inventory = None
+        self.delta: Delta = None
 
-    for proc_config in CONFIG["processors"]:
-        name = proc_config["name"]
-        proc = proc_dict[name](output_root, proc_config)
+        # Skip input files that didn't change since the previous run with the same config
+        self.incremental = incremental
+        self.unchanged = 0
+        # Input relative path -> {(output relative path, priority class)}
+        self.sources: dict[str, set] = {}
+        # Input relative path -> work items not recorded yet
+        self.source_pending: dict[str, int] = {}
+        # Inputs with failed or corrupt work, done again by the next run
+        self.failed_sources: set[str] = set()
+        # Input relative path -> outputs of the previous run that it may not produce anymore,
+        # for files that were removed or changed
+        self.stale_outputs: dict[str, set[str]] = {}
 
-        proc.pre_process()
-        instantiated_processors.append(proc)
+        # Anything inside of archives that no processor wants is skipped by the extractors
+        self.wanted = PathFilter(
+            [pat for proc in self.processors for pat in proc.config["filters"]]
+        )
 
-    def run_processors_on_file(file_info: File):
-        for proc in instantiated_processors:
-            path_to_match = file_info.path.relative_to(file_info.input_root).as_posix()
+        # Limits what work in flight holds in memory, the extraction of further files
+        # waits while it's used up
+        self.budget = MemoryBudget(max_memory) if max_memory else None
+        self.memory = StageMemory()
 
+        self.priorities = PriorityClasses(CONFIG.get("priorities", []))
+        # Per priority class, for the markers written when a class is done
+        self.class_outputs: list[set[str]] = [set() for _ in range(len(self.priorities))]
+        self.class_failures = [0] * len(self.priorities)
+        self.class_remaining = [0] * len(self.priorities)
+        self.start_time = time.time()
+
+        self.cache = None
+        # Processor name -> hash of its config, for the result cache
+        self.config_hashes = {}
+
+        cache_config = CONFIG.get("cache")
+        if cache_config:
+            self.cache = ResultCache(
+                Path(cache_config["path"]).expanduser(),
+                cache_config.get("max_size", DEFAULT_MAX_SIZE),
+            )
+            for proc in self.processors:
+                if proc.cacheable:
+                    self.config_hashes[proc.name] = config_hash(proc.config)
+
+        # Outputs of the previous run are only reused with the same config and tools
+        self.run_config = config_hash({
+            "config": {k: v for k, v in CONFIG.items() if k not in ("cache", "metrics")},
+            "shard": list(shard) if shard is not None else None,
+            "tools": [config_hash(proc.config) for proc in self.processors],
+        })
+
+    # Has to be called before anything is processed
+    def prepare(self):
+        if not self.output_root.exists():
+            self.output_root.mkdir(parents=True)
+
+        for proc in self.processors:
+            proc.pre_process()
+
+        clear_markers(self.output_root)
+
+        self.journal.open()
+
+    def finish(self):
+        self.post_process()
+
+        self.journal.close()
+        self.save_state()
+
+    # Also called after every batch in watch mode
+    def post_process(self):
+        for proc in self.processors:
+            proc.post_process()
+
+        self.remove_stale_outputs()
+
+    # Everything a later run starts from, also saved after every batch in watch mode
+    def save_state(self):
+        write_manifest(self.output_root, self.shard, self.outputs)
+        self.history.save()
+        if self.cache is not None:
+            self.cache.save()
+        if self.inventory is not None:
+            self.inventory.config = self.run_config
+            with self.lock:
+                self.inventory.outputs = {
+                    source: sorted(outputs) for source, outputs in self.sources.items()
+                    if not self.source_pending.get(source) and source not in self.failed_sources
+                }
+            self.inventory.save(self.output_root.joinpath(Inventory.FILE_NAME))
+        self.write_report()
+
+    def make_work_item(self, file_info: File, verify=False, source=None):
+        path_to_match = file_info.relpath
+
+        matching = []
+        for proc in self.processors:
             pats = proc.config["filters"]
             if filter_match(path_to_match, pats):
                 # print(path_to_match, pat, proc.name)
+                matching.append(proc)
+
+        if not matching:
+            return None
+
+        if self.shard is not None and shard_of(path_to_match, self.shard[1]) != self.shard[0]:
+            return None
+
+        item = WorkItem(file_info, matching, verify)
+        item.priority = self.priorities.classify(item.relpath, matching)
+        item.source = source if source is not None else item.relpath
+
+        if self.journal.completed:
+            item.processors = []
+            for proc in matching:
+                recorded = self.journal.recorded_outputs(proc.name, item.relpath, item.identity)
+                if recorded is not None:
+                    output_paths = [self.output_root.joinpath(relpath) for relpath in recorded]
+                else:
+                    output_paths = [proc.output_path_for(file_info)]
+
+                if (
+                    self.journal.is_done(proc.name, item.relpath, item.identity)
+                    and all(path.exists() for path in output_paths)
+                ):
+                    for path in output_paths:
+                        self.add_output(path, item.priority, item.source)
+                    self.skipped += 1
+                else:
+                    item.processors.append(proc)
+
+            if not item.processors:
+                return None
+
+        for proc in item.processors:
+            item.cost += self.history.estimate(proc.name, item.relpath, item.size)
+
+        return item
+
+    # entry_filter can be used to only process some of the files inside of archives
+    def iter_work_items(self, file_info: File, entry_filter=None):
+        item = None
+        if self.overlay is None or self.overlay.is_effective(file_info.relpath):
+            item = self.make_work_item(file_info)
+        if item is not None:
+            yield item
+
+        for ex in EXTRACTORS:
+            path_to_match = file_info.relpath
+
+            pats = CONFIG["extractors"][ex.name]["filters"]
+            if filter_match(path_to_match, pats):
+                # print(path_to_match, pat, ex.name)
+                verify = CONFIG["extractors"][ex.name].get("verify", False)
+                for f in ex.get_files(file_info, self.wanted, self.overlay):
+                    if entry_filter is not None and not entry_filter(f):
+                        continue
+
+                    METRICS.extractor_entry(ex.name)
+                    item = self.make_work_item(f, verify, file_info.relpath)
+                    if item is not None:
+                        # Released once the item was processed
+                        if isinstance(f, BSPPakFile):
+                            f.bsp.acquire()
+                        yield item
+
+    def build_overlay(self, input_path: Path):
+        """With an overlay in the config, only the copies of files the game would load are processed"""
+        overlay_config = CONFIG.get("overlay")
+        if not overlay_config:
+            return
+
+        self.overlay = OverlayIndex.build(input_path.absolute(), overlay_config["search_paths"])
+        print(
+            f"OVERLAY: {len(self.overlay.entries)} files from {len(self.overlay.sources)} "
+            f"search paths, {self.overlay.overridden} overridden copies skipped"
+        )
+
+    def collect_work(self, input_path: Path) -> list[WorkItem]:
+        """Every work item under input_path, by priority class and then most expensive first"""
+        items = []
+
+        self.build_overlay(input_path)
+
+        input_root = input_path.absolute()
+        with self.memory.stage("inventory"):
+            self.inventory = Inventory.scan(input_root)
+
+            previous = Inventory.load(input_root, self.output_root.joinpath(Inventory.FILE_NAME))
+            self.delta = self.inventory.diff(previous)
+            print(
+                f"INVENTORY: {len(self.inventory)} files in {self.inventory.duration:.2f}s, "
+                f"{len(self.delta.new)} new, {len(self.delta.removed)} removed, "
+                f"{len(self.delta.changed)} changed since the last run"
+            )
+            unchanged = self.unchanged_outputs(previous)
+
+            # Only the indexes of archives are read here, the extract stage reads their contents.
+            # The whole list is needed to order it by priority class and cost
+            for relpath, stat in self.inventory.files.items():
+                outputs = unchanged.get(relpath)
+                if outputs is not None:
+                    self.keep_outputs(relpath, outputs)
+                    continue
+
+                file_info = File(input_root, input_root.joinpath(relpath), stat, relpath)
+
+                self.sources[relpath] = set()
+                items += self.iter_work_items(file_info)
+
+            for item in items:
+                self.source_pending[item.source] = self.source_pending.get(item.source, 0) + 1
+
+        items.sort(key=lambda item: (item.priority, -item.cost))
+
+        return items
+
+    def process_item(self, item: WorkItem) -> list:
+        """
+        Runs the processors on the item and drops its contents afterwards. Returns what
+        record_item() needs, (processor, outputs or None, failure, duration, cached) for each
+        """
+        file_info = item.file
+        results = []
+
+        # Read the contents only once if several processors need them, the cache hashes them too
+        shared = contextlib.nullcontext()
+        if len(item.processors) > 1 or any(proc.name in self.config_hashes for proc in item.processors):
+            shared = file_info.share()
+
+        with shared:
+            for proc in item.processors:
                 start_time = time.time()
+                failure = None
+                cached = False
+                outputs = None
                 try:
-                    proc.run_processor(file_info)
+                    key = self.cache_key(proc, item)
+                    cached = key is not None and self.restore_output(proc, file_info, key)
+                    if not cached:
+                        outputs = proc.run_processor(file_info)
+                        if key is not None:
+                            self.cache.put(key, proc.output_path_for(file_info))
                 except Exception as e:
                     print(
-                        f'ERROR while running processor "{proc.name}" on file "{file_info.path}"'
+                        f'ERROR while running processor "{proc.name}" on file "{file_info.path}": {e!r}'
                     )
-                    raise e
+                    kind = "timeout" if isinstance(e, ToolTimeoutError) else "error"
+                    failure = Failure(proc.name, item.relpath, kind, str(e) or repr(e), 0.0)
                 final_time = time.time() - start_time
-                proc_timings[proc.name] = proc_timings.get(proc.name, 0) + final_time
+                METRICS.processor_done(proc.name, item.size, final_time, failure is not None, cached)
+
+                results.append((proc, outputs, failure, final_time, cached))
+
+        if item.verify and not file_info.verify():
+            print(f'ERROR: checksum mismatch for file "{file_info.path}"')
+            with self.lock:
+                self.corrupt_files.append(file_info.path)
+                self.failed_sources.add(item.source)
+
+        self.drop_item(item)
+
+        return results
 
-    for root, _, files in os.walk(input_path):
-        for path in files:
-            file_info = File(
-                input_root=input_path.absolute(),
-                path=Path(os.path.join(root, path)).absolute(),
+    # Releases the contents of the item and what it holds of the memory budget
+    def drop_item(self, item: WorkItem):
+        item.file.close()
+        if isinstance(item.file, BSPPakFile):
+            item.file.bsp.release()
+        if self.budget is not None:
+            self.budget.release(item.reserved)
+        item.reserved = 0
+
+    def record_item(self, item: WorkItem, results: list):
+        """Journal, manifest and timings for the outputs of a processed item"""
+        for proc, outputs, failure, final_time, cached in results:
+            if failure is None:
+                if outputs is None:
+                    self.journal.record(proc.name, item.relpath, item.identity)
+                    self.add_output(proc.output_path_for(item.file), item.priority, item.source)
+                else:
+                    self.journal.record(proc.name, item.relpath, item.identity, [
+                        path.relative_to(self.output_root).as_posix() for path in outputs
+                    ])
+                    for path in outputs:
+                        self.add_output(path, item.priority, item.source)
+
+            with self.lock:
+                if failure is not None:
+                    failure.duration = final_time
+                    self.failures.append(failure)
+                    self.class_failures[item.priority] += 1
+                    self.failed_sources.add(item.source)
+                self.proc_timings[proc.name] = self.proc_timings.get(proc.name, 0) + final_time
+                # Restoring from the cache says nothing about how long the work takes
+                if not cached:
+                    self.history.record(proc.name, item.relpath, final_time, item.size)
+
+        with self.lock:
+            self.source_pending[item.source] -= 1
+
+    def run_work_item(self, item: WorkItem):
+        self.record_item(item, self.process_item(item))
+
+    def unchanged_outputs(self, previous: Inventory) -> dict[str, list]:
+        """
+        Outputs of the previous run for the input files that didn't change since, as long as
+        they all still exist. Only used with the same config, everything is processed otherwise
+        """
+        if not self.incremental or previous is None or previous.config != self.run_config:
+            return {}
+
+        unchanged = {}
+        for relpath, outputs in previous.outputs.items():
+            if relpath in self.delta.removed or relpath in self.delta.changed:
+                self.stale_outputs[relpath] = {output for output, _ in outputs}
+            elif all(self.output_root.joinpath(output).exists() for output, _ in outputs):
+                unchanged[relpath] = outputs
+
+        return unchanged
+
+    # Outputs of an input file that is skipped because it didn't change
+    def keep_outputs(self, relpath: str, outputs: list):
+        with self.lock:
+            self.sources[relpath] = set()
+            for output, priority in outputs:
+                self.outputs.add(output)
+                if priority is not None:
+                    self.class_outputs[priority].add(output)
+                self.sources[relpath].add((output, priority))
+            self.unchanged += 1
+
+    def remove_stale_outputs(self):
+        """Outputs of removed input files, and the ones changed input files didn't produce again"""
+        with self.lock:
+            claimed = {output for outputs in self.sources.values() for output, _ in outputs}
+
+        removed = 0
+        kept = {}
+        for source, outputs in self.stale_outputs.items():
+            # Still pending if the run was interrupted, failed work is done again by the next run
+            if self.source_pending.get(source) or source in self.failed_sources:
+                kept[source] = outputs
+                continue
+
+            for relpath in outputs - claimed:
+                with self.lock:
+                    self.outputs.discard(relpath)
+
+                path = self.output_root.joinpath(relpath)
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    path.unlink()
+                else:
+                    continue
+                removed += 1
+
+        self.stale_outputs = kept
+        if removed:
+            print(f"INCREMENTAL: removed {removed} outputs of removed or changed files")
+
+    def cache_key(self, proc: Processor, item: WorkItem):
+        if proc.name not in self.config_hashes:
+            return None
+
+        if item.digest is None:
+            item.digest = self.cache.digest(item.file)
+
+        return self.cache.key(
+            item.digest, proc.name, self.config_hashes[proc.name], proc.cache_key_extra(item.file)
+        )
+
+    # Writes the cached output of proc, returns False if there is none
+    def restore_output(self, proc: Processor, file_info: File, key: str) -> bool:
+        cached = self.cache.get(key)
+        if cached is None:
+            return False
+
+        output_path = proc.output_path_for(file_info)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(cached, "rb") as inp, proc.open_output(output_path) as out:
+            shutil.copyfileobj(inp, out, 1024 * 1024)
+
+        return True
+
+    def add_output(self, output_path: Path, priority=None, source=None):
+        # Processors don't have to produce output for every file
+        if output_path.exists():
+            relpath = output_path.relative_to(self.output_root).as_posix()
+            with self.lock:
+                self.outputs.add(relpath)
+                if priority is not None:
+                    self.class_outputs[priority].add(relpath)
+                if source is not None:
+                    self.sources.setdefault(source, set()).add((relpath, priority))
+
+    def item_done(self, item: WorkItem):
+        with self.lock:
+            self.class_remaining[item.priority] -= 1
+            if self.class_remaining[item.priority] == 0:
+                self.class_done(item.priority)
+
+    # Called with the lock held
+    def class_done(self, priority: int):
+        name = self.priorities.names[priority]
+        duration = time.time() - self.start_time
+        write_marker(
+            self.output_root, name, self.class_outputs[priority], self.class_failures[priority], duration
+        )
+        print(
+            f"PRIORITY {name}: done after {duration:.2f}s, {len(self.class_outputs[priority])} outputs, "
+            f"{self.class_failures[priority]} failures"
+        )
+
+    def extract_items(self, items: list[WorkItem], stop: threading.Event = None):
+        """
+        Yields the items with the contents of archive entries read into memory, as long as
+        the memory budget allows. Entries of BSP pakfiles are decompressed in parallel and
+        come after the other items of their priority class, in the order they finish
+        """
+        config = CONFIG["extractors"]["bsp"]
+        max_in_flight_bytes = config.get("max_in_flight_bytes", DEFAULT_MAX_IN_FLIGHT_BYTES)
+        if self.budget is not None:
+            # The items waiting to be processed need the rest of the budget
+            max_in_flight_bytes = min(max_in_flight_bytes, self.budget.limit // 2)
+
+        for _, class_items in groupby(items, key=lambda item: item.priority):
+            paks = {}
+            for item in class_items:
+                if stop is not None and stop.is_set():
+                    return
+
+                if isinstance(item.file, BSPPakFile):
+                    paks.setdefault(item.file.bsp, {})[item.file.info] = item
+                    continue
+
+                # Blocks until enough of the items in flight are done
+                self.reserve(item)
+                if not item.file.is_real and item.size <= SHARE_IN_MEMORY_SIZE:
+                    try:
+                        with item.file.open() as fd:
+                            item.file.data = fd.read()
+                    except Exception:
+                        # The processors read the entry on their own then, and report the error
+                        pass
+                yield item
+
+            for pak, pak_items in paks.items():
+                for info, data in pak.decompress_iter(
+                    pak_items, config.get("threads"), max_in_flight_bytes
+                ):
+                    item = pak_items.pop(info)
+                    self.reserve(item)
+                    item.file.data = data
+                    # Only the file keeps the data alive, it's dropped when the file is closed
+                    del data
+                    yield item
+
+                    # Items that weren't extracted keep their pakfile open until the process exits
+                    if stop is not None and stop.is_set():
+                        return
+
+    def reserve(self, item: WorkItem):
+        if self.budget is not None:
+            item.reserved = self.budget.acquire(item.memory)
+
+    def extract_stage(self, items: list[WorkItem], process_queue: queue.Queue, workers: int,
+                      stop: threading.Event, errors: list):
+        try:
+            with self.memory.stage("extract"):
+                for item in self.extract_items(items, stop):
+                    process_queue.put(item)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            for _ in range(workers):
+                process_queue.put(_END)
+
+    def process_stage(self, process_queue: queue.Queue, write_queue: queue.Queue,
+                      stop: threading.Event, errors: list):
+        try:
+            with self.memory.stage("process"):
+                while (item := process_queue.get()) is not _END:
+                    if stop.is_set():
+                        self.drop_item(item)
+                        continue
+                    try:
+                        results = self.process_item(item)
+                    except BaseException as e:
+                        errors.append(e)
+                        stop.set()
+                        continue
+                    write_queue.put((item, results))
+        finally:
+            write_queue.put(_END)
+
+    def run_work_items(self, items: list[WorkItem], jobs=1):
+        """
+        items have to be sorted by priority class, like collect_work returns them. They go
+        through three stages connected by bounded queues: one thread reads the contents of
+        archive entries ahead, jobs threads run the processors and this thread records the
+        outputs. The memory budget is held from extraction until the processors are done
+        with an item, so extraction waits for slow processors
+        """
+        with self.lock:
+            for item in items:
+                self.class_remaining[item.priority] += 1
+            for priority, remaining in enumerate(self.class_remaining):
+                if remaining == 0:
+                    self.class_done(priority)
+
+        process_queue = queue.Queue(jobs * QUEUE_DEPTH)
+        write_queue = queue.Queue(jobs * QUEUE_DEPTH)
+        stop = threading.Event()
+        errors = []
+
+        threads = [threading.Thread(
+            target=self.extract_stage, args=(items, process_queue, jobs, stop, errors), daemon=True,
+        )]
+        for _ in range(jobs):
+            threads.append(threading.Thread(
+                target=self.process_stage, args=(process_queue, write_queue, stop, errors), daemon=True,
+            ))
+        for thread in threads:
+            thread.start()
+
+        ended = 0
+        try:
+            with self.memory.stage("write"):
+                while ended < jobs:
+                    entry = write_queue.get()
+                    if entry is _END:
+                        ended += 1
+                        continue
+                    item, results = entry
+                    self.record_item(item, results)
+                    self.item_done(item)
+        finally:
+            if ended < jobs:
+                # Interrupted, the other stages stop after the items they are at
+                stop.set()
+                while ended < jobs:
+                    if write_queue.get() is _END:
+                        ended += 1
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def forget_source(self, relpath: str) -> set[str]:
+        """
+        For an input file that is processed again or was removed, in watch mode. Its outputs are
+        removed afterwards unless something produces them again. Returns the other input files
+        that share some of them (protobuf descriptors found in several binaries), which have to
+        be processed again as well for the right version to win
+        """
+        with self.lock:
+            old = {output for output, _ in self.sources.pop(relpath, set())}
+            self.stale_outputs[relpath] = self.stale_outputs.get(relpath, set()) | old
+            self.source_pending.pop(relpath, None)
+            self.failed_sources.discard(relpath)
+
+            sharing = {
+                source for source, outputs in self.sources.items()
+                if any(output in old for output, _ in outputs)
+            }
+
+        for proc in self.processors:
+            proc.forget([self.output_root.joinpath(output) for output in old])
+
+        return sharing
+
+    def process_file(self, file_info: File, entry_filter=None):
+        with self.lock:
+            # Only some entries of an archive keep the outputs of the others
+            if entry_filter is None:
+                self.sources[file_info.relpath] = set()
+            self.failed_sources.discard(file_info.relpath)
+
+        items = list(self.iter_work_items(file_info, entry_filter))
+        with self.lock:
+            for item in items:
+                self.source_pending[item.source] = self.source_pending.get(item.source, 0) + 1
+        items.sort(key=lambda item: item.priority)
+        for item in self.extract_items(items):
+            self.run_work_item(item)
+
+    def print_plan(self, items: list[WorkItem], jobs=1):
+        for item in items:
+            procs = ",".join(proc.name for proc in item.processors)
+            print(f"{item.cost:10.3f}s {item.size:>12} {item.relpath} [{procs}]")
+
+        if len(self.priorities) > 1:
+            for priority, name in enumerate(self.priorities.names):
+                class_items = [item for item in items if item.priority == priority]
+                print(
+                    f"PRIORITY {name}: {len(class_items)} files, "
+                    f"{sum(item.cost for item in class_items):.2f}s of work"
+                )
+
+        total = sum(item.cost for item in items)
+        wall_time = predict_wall_time([item.cost for item in items], jobs)
+        print(f"PLAN: {len(items)} files, {total:.2f}s of work, ~{wall_time:.2f}s with {jobs} jobs")
+
+    def print_summary(self):
+        print("TIMINGS:")
+        for (name, timing) in self.proc_timings.items():
+            print(f"{name}: {timing}")
+
+        if self.output_stats is not None:
+            print(
+                f"OUTPUTS: {self.output_stats.written} written, "
+                f"{self.output_stats.unchanged} unchanged"
             )
 
-            run_processors_on_file(file_info)
+        if self.memory.peaks:
+            print(
+                "PEAK RSS: "
+                + ", ".join(f"{stage} {peak / 1e6:.1f} MB" for stage, peak in self.memory.peaks.items())
+                + (f" (budget {self.budget.peak / 1e6:.1f} of {self.budget.limit / 1e6:.1f} MB used)"
+                   if self.budget is not None else "")
+            )
+
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(
+                f"CACHE: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['evictions']} evicted"
+            )
+
+        if self.corrupt_files:
+            print(f"CORRUPT FILES ({len(self.corrupt_files)}):")
+            for path in self.corrupt_files:
+                print(path)
+
+        if self.failures:
+            print(f"FAILURES ({len(self.failures)}):")
+            for f in sorted(self.failures, key=lambda f: (f.kind, f.relpath)):
+                print(f"{f.kind} {f.duration:.2f}s {f.proc_name} {f.relpath}: {f.message}")
+
+    REPORT_FILE_NAME = ".dataminer_report.json"
+
+    def write_metrics(self, files: int, jobs: int):
+        summary = METRICS.summary(
+            started=self.start_time,
+            duration=time.time() - self.start_time,
+            jobs=jobs,
+            files=files,
+            input_files=len(self.inventory) if self.inventory is not None else 0,
+            peak_rss=self.memory.peaks,
+            cache=self.cache.stats() if self.cache is not None else None,
+        )
+
+        metrics_config = CONFIG.get("metrics") or {}
+        textfile = metrics_config.get("textfile")
+        write_metrics(self.output_root, summary, Path(textfile).expanduser() if textfile else None)
+
+    def write_report(self):
+        report = {
+            "failures": [f.to_json() for f in self.failures],
+            "corrupt_files": [path.as_posix() for path in self.corrupt_files],
+        }
+        if self.cache is not None:
+            report["cache"] = self.cache.stats()
+        report["peak_rss"] = self.memory.peaks
+
+        with open(self.output_root.joinpath(self.REPORT_FILE_NAME), "w") as fd:
+            json.dump(report, fd, indent=2)
+
+
+def process_dir(
+    input_path: Path, output_path: Path, jobs=1, plan=False, resume=False, shard=None,
+    only_changed=False, max_memory=None, incremental=False,
+):
+    runner = Runner(output_path, resume, shard, only_changed, max_memory, incremental)
+
+    items = runner.collect_work(input_path)
+
+    if runner.unchanged:
+        print(f"INCREMENTAL: skipping {runner.unchanged} files that didn't change since the last run")
+    if runner.skipped:
+        print(f"RESUME: skipping {runner.skipped} already completed jobs")
+
+    if plan:
+        runner.print_plan(items, jobs)
+        return runner
+
+    runner.prepare()
 
-            for ex in EXTRACTORS:
-                path_to_match = file_info.path.relative_to(
-                    file_info.input_root
-                ).as_posix()
+    try:
+        runner.run_work_items(items, jobs)
+    finally:
+        runner.finish()
+        runner.write_metrics(len(items), jobs)
 
-                pats = CONFIG["extractors"][ex.name]["filters"]
-                if filter_match(path_to_match, pats):
-                    # print(path_to_match, pat, ex.name)
-                    for f in ex.get_files(file_info):
-                        run_processors_on_file(f)
+    runner.print_summary()
 
-    print("TIMINGS:")
-    for (name, timing) in proc_timings.items():
-        print(f"{name}: {timing}")
+    return runner
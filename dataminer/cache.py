@@ -0,0 +1,160 @@
+from dataminer.file import File
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Config keys that don't change what a processor outputs
+RUNTIME_KEYS = {"filters", "timeout", "retries", "max_output_bytes", "worker", "priority"}
+
+
+def config_hash(config: dict) -> str:
+    settings = {k: v for k, v in config.items() if k not in RUNTIME_KEYS}
+
+    # Another version of the tool can give different output
+    tool = config.get("bin_path") and shutil.which(config["bin_path"])
+    if tool:
+        st = os.stat(tool)
+        settings["bin_path"] = [tool, st.st_size, st.st_mtime_ns]
+
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode("utf8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResultCache:
+    """
+    Processor outputs by (input contents, processor, processor config), shared between runs
+    and output roots. Least recently used outputs are evicted once max_size is exceeded
+    """
+
+    INDEX_FILE_NAME = "index.json"
+
+    def __init__(self, root: Path, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # key -> [size, last used]
+        self.entries: dict[str, list] = {}
+        # Absolute path -> [identity, digest], so unchanged files aren't hashed again
+        self.inputs: dict[str, list] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        index = self._load_index()
+        self.entries = index.get("entries", {})
+        self.inputs = index.get("inputs", {})
+
+    def _load_index(self) -> dict:
+        path = self.root.joinpath(self.INDEX_FILE_NAME)
+        if not path.exists():
+            return {}
+
+        try:
+            with open(path, "r") as fd:
+                return json.load(fd)
+        except (OSError, ValueError) as e:
+            print(f'Couldn\'t load cache index "{path}":', e)
+            return {}
+
+    def digest(self, file: File) -> str:
+        if file.is_real:
+            path = file.path.as_posix()
+            identity = file.identity
+            with self.lock:
+                known = self.inputs.get(path)
+            if known is not None and known[0] == identity:
+                return known[1]
+
+        h = hashlib.sha256()
+        with file.map() as data:
+            h.update(data)
+        digest = h.hexdigest()
+
+        if file.is_real:
+            with self.lock:
+                self.inputs[path] = [identity, digest]
+
+        return digest
+
+    def key(self, digest: str, proc_name: str, proc_config_hash: str, extra="") -> str:
+        return hashlib.sha256(
+            f"{digest}\0{proc_name}\0{proc_config_hash}\0{extra}".encode("utf8")
+        ).hexdigest()
+
+    def object_path(self, key: str) -> Path:
+        return self.root.joinpath("objects", key[:2], key)
+
+    def get(self, key: str):
+        """Path of the cached output, or None"""
+        path = self.object_path(key)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and path.exists():
+                entry[1] = time.time()
+                self.hits += 1
+                return path
+
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, output_path: Path):
+        # Processors don't have to produce output for every file
+        if not output_path.exists():
+            return
+
+        path = self.object_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=".", delete=False) as tmp:
+            with open(output_path, "rb") as fd:
+                shutil.copyfileobj(fd, tmp, 1024 * 1024)
+        os.replace(tmp.name, path)
+
+        with self.lock:
+            self.entries[key] = [path.stat().st_size, time.time()]
+
+    def save(self):
+        with self.lock:
+            # Other runs may have used the same cache in the meantime
+            index = self._load_index()
+            for key, entry in index.get("entries", {}).items():
+                ours = self.entries.get(key)
+                if ours is None or ours[1] < entry[1]:
+                    self.entries[key] = entry
+            for path, known in index.get("inputs", {}).items():
+                self.inputs.setdefault(path, known)
+
+            total = sum(size for size, _ in self.entries.values())
+            for key in sorted(self.entries, key=lambda k: self.entries[k][1]):
+                if total <= self.max_size:
+                    break
+                total -= self.entries.pop(key)[0]
+                self.evictions += 1
+                try:
+                    os.unlink(self.object_path(key))
+                except FileNotFoundError:
+                    pass
+
+            self.inputs = {p: known for p, known in self.inputs.items() if os.path.exists(p)}
+
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self.root.joinpath(self.INDEX_FILE_NAME)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as fd:
+                json.dump({"entries": self.entries, "inputs": self.inputs}, fd)
+            os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
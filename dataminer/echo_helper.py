@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Reference helper for the worker protocol in dataminer/worker.py, for testing.
+
+Outputs the arguments it was given, one per line, followed by the size of the
+first one if it is a file. Runs as a normal command line tool unless --worker
+is passed. Special arguments: "crash" exits, "hang" never responds and "fail"
+returns status 1
+"""
+
+import os
+import struct
+import sys
+import time
+
+
+def handle(args: list[bytes]) -> tuple[int, bytes]:
+    if b"crash" in args:
+        os._exit(3)
+    if b"hang" in args:
+        time.sleep(1000000)
+    if b"fail" in args:
+        return 1, b"failed on request"
+
+    output = b"".join(arg + b"\n" for arg in args)
+    if args and os.path.isfile(args[0]):
+        output += str(os.path.getsize(args[0])).encode("utf8") + b"\n"
+    output += f"pid {os.getpid()}\n".encode("utf8")
+
+    return 0, output
+
+
+def serve():
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    while True:
+        header = stdin.read(4)
+        if len(header) < 4:
+            return
+
+        (length,) = struct.unpack("<I", header)
+        payload = stdin.read(length)
+
+        status, output = handle(payload.split(b"\0"))
+
+        stdout.write(struct.pack("<II", status, len(output)) + output)
+        stdout.flush()
+
+
+def main():
+    args = sys.argv[1:]
+
+    if "--worker" in args:
+        serve()
+        return
+
+    status, output = handle([os.fsencode(a) for a in args])
+    sys.stdout.buffer.write(output)
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Bulk extraction of everything inside of vpks and bsp pakfiles, to the same paths
+the extractors give them (<archive dir>/<archive name>/<entry path>)
+"""
+
+from dataminer import vpk
+from dataminer.bsp import BspPak
+from dataminer.extractor import PathFilter, index_filters
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+import threading
+import time
+
+EXTRACT_BUFFER_SIZE = 4 * 1024 * 1024
+# Entries of one archive are extracted in batches of about this size, in archive order
+BATCH_SIZE = 64 * 1024 * 1024
+
+
+class ExtractStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.failed: list[tuple[Path, Exception]] = []
+
+    def done(self, size: int):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def fail(self, path: Path, error: Exception):
+        print(f'ERROR: Couldn\'t extract "{path}": {error!r}')
+        with self.lock:
+            self.failed.append((path, error))
+
+
+def _output_path(output_path: Path, prefix: str, name: str):
+    # Entry names come from the archive, don't let them escape the output directory
+    if name.startswith("/") or ".." in name.split("/"):
+        raise ValueError(f"unsafe path {name!r}")
+    return output_path.joinpath(prefix + name)
+
+
+def _create(path: Path, size: int) -> int:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    if size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # Not supported by every filesystem
+            pass
+    return fd
+
+
+def _pwrite_all(fd: int, data, offset: int):
+    data = memoryview(data)
+    while data:
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
+
+
+def extract_vpk_batch(archive_path: str, batch, stats: ExtractStats):
+    """Extracts (output path, metadata) entries of one archive, sorted by offset"""
+    buf = bytearray(EXTRACT_BUFFER_SIZE)
+    view = memoryview(buf)
+    archive_fd = None
+
+    try:
+        for out_path, (preload, _, _, _, archive_offset, file_length) in batch:
+            try:
+                fd = _create(out_path, len(preload) + file_length)
+                try:
+                    _pwrite_all(fd, preload, 0)
+
+                    if file_length > 0 and archive_fd is None:
+                        archive_fd = os.open(archive_path, os.O_RDONLY)
+
+                    offset = 0
+                    while offset < file_length:
+                        n = os.preadv(
+                            archive_fd, [view[: min(file_length - offset, len(view))]],
+                            archive_offset + offset,
+                        )
+                        if n == 0:
+                            raise EOFError("Unexpected end of archive")
+                        _pwrite_all(fd, view[:n], len(preload) + offset)
+                        offset += n
+                finally:
+                    os.close(fd)
+            except (OSError, EOFError) as e:
+                stats.fail(out_path, e)
+                continue
+
+            stats.done(len(preload) + file_length)
+    finally:
+        if archive_fd is not None:
+            os.close(archive_fd)
+
+
+def extract_bsp_batch(pak: BspPak, batch, stats: ExtractStats):
+    """Decompresses (output path, info) entries of one pakfile, releases the pak when done"""
+    buf = bytearray(EXTRACT_BUFFER_SIZE)
+    view = memoryview(buf)
+
+    try:
+        for out_path, info in batch:
+            try:
+                with pak.open(info) as inp:
+                    fd = _create(out_path, info.file_size)
+                    try:
+                        offset = 0
+                        while True:
+                            n = inp.readinto(view)
+                            if n == 0:
+                                break
+                            _pwrite_all(fd, view[:n], offset)
+                            offset += n
+                    finally:
+                        os.close(fd)
+            except Exception as e:
+                # Bad CRCs and corrupt compressed data included
+                stats.fail(out_path, e)
+                continue
+
+            stats.done(info.file_size)
+    finally:
+        pak.release()
+
+
+def _batches(entries, entry_size):
+    """Yields (batch, size)"""
+    batch = []
+    size = 0
+    for entry in entries:
+        batch.append(entry)
+        size += entry_size(entry)
+        if size >= BATCH_SIZE:
+            yield batch, size
+            batch = []
+            size = 0
+    if batch:
+        yield batch, size
+
+
+def extract(input_path: Path, output_path: Path, match=None, threads=None) -> bool:
+    start_time = time.time()
+    stats = ExtractStats()
+    wanted = PathFilter(match) if match else None
+
+    # (size, function, args) of every batch of entries
+    jobs = []
+    dirs = set()
+
+    for root, _, files in os.walk(input_path):
+        for name in sorted(files):
+            path = Path(root).joinpath(name)
+            relpath = path.relative_to(input_path)
+            prefix = relpath.parent.joinpath(relpath.stem).as_posix() + "/"
+
+            if name.endswith("_dir.vpk"):
+                try:
+                    pak = vpk.open(path.as_posix())
+                    archives = {}
+                    for entry_path, metadata in pak.read_index_iter(**index_filters(wanted, prefix)):
+                        try:
+                            out_path = _output_path(output_path, prefix, entry_path)
+                        except ValueError as e:
+                            stats.fail(path.joinpath(entry_path), e)
+                            continue
+                        dirs.add(out_path.parent)
+                        archives.setdefault(metadata[3], []).append((out_path, metadata))
+                except Exception as e:
+                    stats.fail(path, e)
+                    continue
+
+                for archive_index, entries in archives.items():
+                    archive_path = pak._make_vpkfile_path({"archive_index": archive_index})
+                    entries.sort(key=lambda e: e[1][4])
+                    for batch, size in _batches(entries, lambda e: len(e[1][0]) + e[1][5]):
+                        jobs.append((size, extract_vpk_batch, (archive_path, batch, stats)))
+
+            elif name.endswith(".bsp"):
+                try:
+                    pak = BspPak(path)
+                except Exception as e:
+                    print("Couldn't open bsp (probably no pakfile):", e)
+                    continue
+
+                # Every batch holds on to the pak, closed right away if there are none
+                with pak:
+                    entries = []
+                    for info in pak.infos:
+                        if info.is_dir():
+                            continue
+                        if wanted is not None and not wanted.match(prefix + info.filename):
+                            continue
+                        try:
+                            out_path = _output_path(output_path, prefix, info.filename)
+                        except ValueError as e:
+                            stats.fail(path.joinpath(info.filename), e)
+                            continue
+                        dirs.add(out_path.parent)
+                        entries.append((out_path, info))
+
+                    entries.sort(key=lambda e: e[1].header_offset)
+                    for batch, size in _batches(entries, lambda e: e[1].file_size):
+                        pak.acquire()
+                        jobs.append((size, extract_bsp_batch, (pak, batch, stats)))
+
+    for d in sorted(dirs):
+        d.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(threads) as pool:
+        # Biggest batches first
+        jobs.sort(key=lambda job: job[0], reverse=True)
+        futures = [pool.submit(func, *args) for _, func, args in jobs]
+
+        for future in futures:
+            future.result()
+
+    duration = time.time() - start_time
+    print(
+        f"EXTRACTED: {stats.files} files, {stats.bytes / 1e9:.2f} GB in {duration:.2f}s"
+        + (f" ({stats.bytes / duration / 1e9:.2f} GB/s)" if duration > 0 else "")
+    )
+    if stats.failed:
+        print(f"FAILURES: {len(stats.failed)}")
+
+    return not stats.failed
@@ -1,16 +1,79 @@
 from os import walk
+from dataminer.bsp import BspPak
 from dataminer.file import BSPPakFile, File, VPKFile
+from dataminer.overlay import OverlayIndex
 from dataminer import vpk
 
+from fnmatch import translate
+from pathlib import Path
+import re
 import typing
-import zipfile
+
+_WILDCARDS = re.compile(r"[*?[]")
+
+
+class PathFilter:
+    """
+    Compiled filter patterns (fnmatchcase semantics), that can also tell whether anything
+    with an extension or inside of a directory can match at all
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.regex = re.compile("|".join(translate(pat) for pat in patterns) or "(?!)")
+
+        # Literal text at the start of every pattern
+        self.prefixes = [_WILDCARDS.split(pat, 1)[0] for pat in patterns]
+
+        # Only known if every pattern ends in a literal extension
+        self.exts = set()
+        for pat in patterns:
+            ext = pat.rsplit(".", 1)[-1] if "." in pat else None
+            if ext is None or "/" in ext or _WILDCARDS.search(ext):
+                self.exts = None
+                break
+            self.exts.add(ext)
+
+    def match(self, path: str) -> bool:
+        return self.regex.match(path) is not None
+
+    def match_ext(self, ext: str) -> bool:
+        return self.exts is None or ext in self.exts
+
+    # dir_path has to end with a slash
+    def match_dir(self, dir_path: str) -> bool:
+        return any(
+            prefix.startswith(dir_path) or dir_path.startswith(prefix) for prefix in self.prefixes
+        )
+
+
+def index_filters(wanted: PathFilter, prefix: str, effective=None) -> dict:
+    """
+    read_index_iter arguments for entries of a vpk, which are at prefix + their path.
+    effective is an extra path_filter on the path inside of the vpk
+    """
+    if wanted is None:
+        return {"path_filter": effective} if effective is not None else {}
+
+    path_filter = lambda path: wanted.match(prefix + path)
+    if effective is not None:
+        path_filter = lambda path: effective(path) and wanted.match(prefix + path)
+
+    return {
+        "ext_filter": wanted.match_ext,
+        "dir_filter": lambda ext, dir_path: wanted.match_dir(prefix + dir_path),
+        "path_filter": path_filter,
+    }
 
 
 class Extractor:
     name: str
 
+    # Only files whose path matches wanted have to be returned, and with an overlay
+    # only the ones that aren't overridden by another archive
     @classmethod
-    def get_files(cls, input_file: File) -> typing.Iterable[File]:
+    def get_files(
+        cls, input_file: File, wanted: PathFilter = None, overlay: OverlayIndex = None
+    ) -> typing.Iterable[File]:
         return []
 
 
@@ -18,7 +81,7 @@ class VpkExtractor(Extractor):
     name = "vpk"
 
     @classmethod
-    def get_files(cls, input_file: File):
+    def get_files(cls, input_file: File, wanted: PathFilter = None, overlay: OverlayIndex = None):
         # print("vpk extract", input_file.path)
 
         # without as_posix, everything explodes :)
@@ -28,40 +91,43 @@ class VpkExtractor(Extractor):
             print("Couldn't open vpk:", e)
             return []
 
-        for path, metadata in pak.read_index_iter():
+        vpk_relpath = input_file.obtain_real_file_path().relative_to(input_file.input_root)
+        prefix = vpk_relpath.parent.joinpath(vpk_relpath.stem).as_posix() + "/"
+
+        effective = None
+        if overlay is not None:
+            effective = overlay.path_filter(vpk_relpath.as_posix())
+
+        for path, metadata in pak.read_index_iter(**index_filters(wanted, prefix, effective)):
             try:
                 vpkfile = pak.get_vpkfile_instance(path, metadata)
             except Exception as e:
                 print("Couldn't read vpk:", e)
                 return []
 
-            vpk_relpath = input_file.obtain_real_file_path().relative_to(
-                input_file.input_root
-            )
-
-            yield VPKFile(
-                vpkfile, vpk_relpath.parent.joinpath(vpk_relpath.stem).joinpath(path)
-            )
+            yield VPKFile(vpkfile, Path(prefix + path))
 
 class BspExtractor(Extractor):
     name = "bsp"
 
     @classmethod
-    def get_files(cls, input_file: File):
-        bsp = None
-
+    def get_files(cls, input_file: File, wanted: PathFilter = None, overlay: OverlayIndex = None):
         try:
-            bsp = zipfile.ZipFile(input_file.obtain_real_file_path())
+            bsp = BspPak(input_file.obtain_real_file_path())
         except Exception as e:
             print("Couldn't open bsp (probably no pakfile):", e)
             return []
 
-        for info in bsp.infolist():
-            f = bsp.open(info)
+        extracted_relpath = input_file.obtain_real_file_path().relative_to(input_file.input_root)
+        prefix = extracted_relpath.parent.joinpath(extracted_relpath.stem).as_posix() + "/"
 
-            extracted_relpath = input_file.obtain_real_file_path().relative_to(input_file.input_root)
+        # Closed here unless work items still hold on to it
+        with bsp:
+            for info in bsp.infos:
+                if wanted is not None and not wanted.match(prefix + info.filename):
+                    continue
 
-            yield BSPPakFile(f, info.file_size, extracted_relpath.parent.joinpath(extracted_relpath.stem).joinpath(info.filename))
+                yield BSPPakFile(bsp, info, Path(prefix + info.filename))
 
 
 EXTRACTORS: list[typing.Type[Extractor]] = [VpkExtractor, BspExtractor]
@@ -1,23 +1,151 @@
 from dataminer import vpk
+from dataminer.bsp import BspPak, BufferReader
+from dataminer.metrics import METRICS
 from pathlib import Path
 from tempfile import NamedTemporaryFile
+import contextlib
+import io
+import mmap
+import os
+import zipfile
+
+VPK_BUFFER_SIZE = 1024 * 1024
+
+# Files inside of archives up to this size are kept in memory while shared,
+# bigger ones are extracted to a temporary file and mmapped
+SHARE_IN_MEMORY_SIZE = 64 * 1024 * 1024
 
 
 class File:
     input_root: Path
     path: Path
 
-    def __init__(self, input_root: Path, path: Path):
+    # Contents while shared, see share()
+    shared = None
+    # Contents of archive entries read ahead by the extract stage, dropped by close()
+    data = None
+
+    _relpath = None
+    # (size, mtime_ns, inode) from the inventory, so the file doesn't have to be stat'ed again
+    stat = None
+
+    def __init__(self, input_root: Path, path: Path, stat=None, relpath=None):
         self.input_root = input_root
         self.path = path
+        self.stat = stat
+        self._relpath = relpath
+
+    # Relative to the input root, what filters are matched against
+    @property
+    def relpath(self) -> str:
+        if self._relpath is None:
+            self._relpath = self.path.relative_to(self.input_root).as_posix()
+        return self._relpath
 
     @property
     def is_real(self):
         return True
 
+    @property
+    def size(self) -> int:
+        if self.stat is not None:
+            return self.stat[0]
+        return self.path.stat().st_size
+
+    # Changes whenever the contents of the file (probably) change
+    @property
+    def identity(self) -> str:
+        if self.stat is not None:
+            return f"{self.stat[0]}:{self.stat[1]}"
+        st = self.path.stat()
+        return f"{st.st_size}:{st.st_mtime_ns}"
+
     def open(self):
+        if self.shared is not None:
+            return self.open_shared()
         return open(self.obtain_real_file_path(), "rb")
 
+    # Independent stream over the shared contents, or the contents read ahead
+    def open_shared(self):
+        data = self.shared if self.shared is not None else self.data
+        return io.BufferedReader(BufferReader(memoryview(data)), VPK_BUFFER_SIZE)
+
+    # Read-only buffer with the whole contents of the file, mmapped when possible
+    @contextlib.contextmanager
+    def map(self):
+        if self.shared is not None:
+            yield memoryview(self.shared)
+            return
+
+        if self.data is not None:
+            yield memoryview(self.data)
+            return
+
+        if not self.is_real:
+            with self.open() as fd:
+                yield fd.read()
+            return
+
+        with open(self.path, "rb") as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                yield b""
+                return
+
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Still referenced by a memoryview, will be unmapped once that is gone
+                    pass
+
+    # Reads the contents once, open() and map() return views of them until the context exits.
+    # Used when several processors run on the same file
+    @contextlib.contextmanager
+    def share(self):
+        if self.shared is not None:
+            yield
+            return
+
+        mapped = None
+        try:
+            if self.size == 0:
+                self.shared = b""
+            elif self.data is not None:
+                self.shared = self.data
+            elif self.is_real or self.size > SHARE_IN_MEMORY_SIZE:
+                with open(self.obtain_real_file_path(), "rb") as fd:
+                    mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                self.shared = mapped
+            else:
+                with self.map() as data:
+                    self.shared = bytes(data)
+        except Exception:
+            # Every processor reads the file on its own then, and reports the error
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            self.shared = None
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Still referenced by a view, will be unmapped once that is gone
+                    pass
+
+    # Releases handles and temporary files, the file can still be reopened afterwards
+    def close(self):
+        pass
+
+    # Returns False if the file is known to be corrupt
+    def verify(self) -> bool:
+        return True
+
     # Maybe rename this... Files in vpks won't have paths that correspond to real paths on the system.
     def obtain_real_file_path(self) -> Path:
         return self.path
@@ -38,8 +166,31 @@ class VPKFile(File):
     def is_real(self):
         return False
 
+    @property
+    def size(self) -> int:
+        return self.file.length
+
+    @property
+    def identity(self) -> str:
+        return f"{self.file.crc32:08x}:{self.file.length}"
+
     def open(self):
-        return self.file
+        if self.shared is not None or self.data is not None:
+            return self.open_shared()
+
+        self.file.seek(0)
+        return io.BufferedReader(self.file, VPK_BUFFER_SIZE)
+
+    def verify(self) -> bool:
+        return self.file.verify_streamed()
+
+    def close(self):
+        self.data = None
+        self.file.close()
+
+        if self.backing_file is not None:
+            self.backing_file.close()
+            self.backing_file = None
 
     def obtain_real_file_path(self) -> Path:
         # print(f"file in VPK will be extracted to temp dir, this is not good! (file {self.path})")
@@ -53,26 +204,54 @@ class VPKFile(File):
 
         self.backing_file.truncate(self.file.length)
 
-        for chunk in iter(lambda: self.file.read(8192), b""):
-            self.backing_file.write(chunk)
+        if self.shared is not None:
+            self.backing_file.write(self.shared)
+        elif self.data is not None:
+            self.backing_file.write(self.data)
+        else:
+            self.file.seek(0)
+            buf = bytearray(VPK_BUFFER_SIZE)
+            view = memoryview(buf)
+            for n in iter(lambda: self.file.readinto(buf), 0):
+                self.backing_file.write(view[:n])
 
         self.backing_file.flush()
+        METRICS.temp_file_written(self.file.length)
 
         return Path(self.backing_file.name)
 
 class BSPPakFile(File):
     input_root = Path("/")
 
-    def __init__(self, file, size: int, path: Path):
-        self.file = file
+    def __init__(self, bsp: BspPak, info: zipfile.ZipInfo, path: Path):
+        self.bsp = bsp
+        self.info = info
         self.path = self.input_root.joinpath(path)
         self.backing_file = None
-        self.file_size = size
 
     @property
     def is_real(self):
         return False
 
+    @property
+    def size(self) -> int:
+        return self.info.file_size
+
+    @property
+    def identity(self) -> str:
+        return f"{self.info.CRC:08x}:{self.info.file_size}"
+
+    def open(self):
+        if self.shared is not None or self.data is not None:
+            return self.open_shared()
+        return self.bsp.open(self.info)
+
+    def close(self):
+        self.data = None
+        if self.backing_file is not None:
+            self.backing_file.close()
+            self.backing_file = None
+
     def obtain_real_file_path(self) -> Path:
         if self.backing_file is not None:
             return Path(self.backing_file.name)
@@ -81,11 +260,18 @@ class BSPPakFile(File):
             "w+b", suffix=self.path.suffix, prefix=self.path.stem
         )
 
-        self.backing_file.truncate(self.file_size)
+        self.backing_file.truncate(self.size)
 
-        for chunk in iter(lambda: self.file.read(8192), b""):
-            self.backing_file.write(chunk)
+        if self.shared is not None:
+            self.backing_file.write(self.shared)
+        elif self.data is not None:
+            self.backing_file.write(self.data)
+        else:
+            with self.open() as f:
+                for chunk in iter(lambda: f.read(VPK_BUFFER_SIZE), b""):
+                    self.backing_file.write(chunk)
 
         self.backing_file.flush()
+        METRICS.temp_file_written(self.size)
 
         return Path(self.backing_file.name)
@@ -0,0 +1,136 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+import json
+import os
+import time
+
+DEFAULT_SCAN_THREADS = 16
+
+
+class Delta:
+    """Relative paths that differ between two inventories"""
+
+    def __init__(self, new: set[str], removed: set[str], changed: set[str]):
+        self.new = new
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.new or self.removed or self.changed)
+
+
+def _scan_dir(path: str, relpath: str):
+    """Returns ({relpath: (size, mtime_ns, inode)}, [(subdir path, subdir relpath)])"""
+    files = {}
+    subdirs = []
+
+    try:
+        it = os.scandir(path)
+    except OSError as e:
+        print(f'Couldn\'t scan "{path}":', e)
+        return files, subdirs
+
+    with it:
+        for entry in it:
+            entry_relpath = entry.name if not relpath else f"{relpath}/{entry.name}"
+            try:
+                # Like os.walk, symlinks to directories aren't followed
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, entry_relpath))
+                    continue
+
+                st = entry.stat()
+            except OSError:
+                # Removed in the meantime, or a dangling symlink
+                continue
+
+            files[entry_relpath] = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    return files, subdirs
+
+
+class Inventory:
+    """Every file under a root with its (size, mtime_ns, inode), by relative path"""
+
+    FILE_NAME = ".dataminer_inventory.json"
+
+    def __init__(self, root: Path, files: dict[str, tuple] = None):
+        self.root = root
+        self.files: dict[str, tuple] = files or {}
+        self.duration = 0.0
+        # Relative path -> [[output relative path, priority class], ...] for the files that were
+        # completely processed, so that unchanged ones can be skipped by the next run
+        self.outputs: dict[str, list] = {}
+        # Hash of the config the outputs were produced with
+        self.config = None
+
+    @classmethod
+    def scan(cls, root: Path, threads=DEFAULT_SCAN_THREADS):
+        """Scans directories in parallel, which mostly helps on network filesystems"""
+        start_time = time.time()
+        inventory = cls(root)
+
+        with ThreadPoolExecutor(threads) as pool:
+            pending = {pool.submit(_scan_dir, str(root), "")}
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    inventory.files.update(files)
+                    for subdir in subdirs:
+                        pending.add(pool.submit(_scan_dir, *subdir))
+
+        inventory.duration = time.time() - start_time
+        return inventory
+
+    @classmethod
+    def load(cls, root: Path, path: Path):
+        """Snapshot saved by a previous run, None if there is none"""
+        if not path.exists():
+            return None
+
+        try:
+            with open(path, "r") as fd:
+                snapshot = json.load(fd)
+            files = snapshot["files"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f'Couldn\'t load inventory "{path}":', e)
+            return None
+
+        inventory = cls(root, {relpath: tuple(stat) for relpath, stat in files.items()})
+        inventory.outputs = snapshot.get("outputs", {})
+        inventory.config = snapshot.get("config")
+        return inventory
+
+    def save(self, path: Path):
+        snapshot = {"config": self.config, "files": self.files, "outputs": self.outputs}
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as fd:
+            json.dump(snapshot, fd, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def diff(self, previous) -> Delta:
+        """Compared to an older inventory, everything is new if there is none"""
+        if previous is None:
+            return Delta(set(self.files), set(), set())
+
+        old = previous.files
+        new = set()
+        changed = set()
+        for relpath, stat in self.files.items():
+            old_stat = old.get(relpath)
+            if old_stat is None:
+                new.add(relpath)
+            elif old_stat != stat:
+                changed.add(relpath)
+
+        return Delta(new, set(old) - set(self.files), changed)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        """Relative paths, sorted"""
+        return iter(sorted(self.files))
@@ -0,0 +1,110 @@
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+
+class Journal:
+    """
+    Append-only record of completed (processor, relative path, file identity) work,
+    so that interrupted runs can be resumed
+    """
+
+    FILE_NAME = ".dataminer_journal"
+
+    # fsync after this many records, or this many seconds since the last fsync
+    SYNC_RECORDS = 256
+    SYNC_INTERVAL = 2.0
+
+    def __init__(self, path: Path, resume=False):
+        self.path = path
+        self.completed: set[tuple[str, str, str]] = set()
+        # Output paths of completed work that didn't just write the processor's output_path_for
+        self.outputs: dict[tuple[str, str, str], list[str]] = {}
+
+        if resume and path.exists():
+            with open(path, "r") as fd:
+                for line in fd:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line can be torn if the previous run was killed
+                        continue
+                    key = tuple(record[:3])
+                    self.completed.add(key)
+                    if len(record) > 3:
+                        self.outputs[key] = record[3]
+
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.fd = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    # Starts recording, a fresh run throws away the old journal
+    def open(self, append=False):
+        if not (self.resume or append):
+            self.fd = open(self.path, "w")
+            return
+
+        # Drop a torn last line, or the next record would be glued to it
+        if self.path.exists():
+            with open(self.path, "r+b") as fd:
+                end = fd.seek(0, os.SEEK_END)
+                fd.seek(max(0, end - 1))
+                if end and fd.read(1) != b"\n":
+                    while end > 0:
+                        start = max(0, end - 4096)
+                        fd.seek(start)
+                        newline = fd.read(end - start).rfind(b"\n")
+                        if newline >= 0:
+                            end = start + newline + 1
+                            break
+                        end = start
+                    fd.truncate(end)
+
+        self.fd = open(self.path, "a")
+
+    def is_done(self, proc_name: str, relpath: str, identity: str):
+        return (proc_name, relpath, identity) in self.completed
+
+    def recorded_outputs(self, proc_name: str, relpath: str, identity: str):
+        return self.outputs.get((proc_name, relpath, identity))
+
+    def record(self, proc_name: str, relpath: str, identity: str, outputs: list[str] = None):
+        record = [proc_name, relpath, identity]
+        if outputs is not None:
+            record.append(outputs)
+        line = json.dumps(record) + "\n"
+
+        with self.lock:
+            if self.fd is None:
+                return
+
+            self.fd.write(line)
+            self.unsynced += 1
+
+            if (
+                self.unsynced >= self.SYNC_RECORDS
+                or time.monotonic() - self.last_sync >= self.SYNC_INTERVAL
+            ):
+                self._sync()
+
+    def _sync(self):
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if self.fd is not None:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self._sync()
+                self.fd.close()
+                self.fd = None
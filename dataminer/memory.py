@@ -0,0 +1,125 @@
+import argparse
+import contextlib
+import re
+import resource
+import threading
+
+_SIZE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    """Parses sizes like 512M or 2G"""
+    match = _SIZE_RE.match(value.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(f'invalid size "{value}", expected e.g. 512M or 2G')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+class MemoryBudget:
+    """
+    Bytes that can be held by work in flight. acquire() blocks while the budget is used up,
+    which keeps the stages before it from running ahead
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size: int) -> int:
+        # Something bigger than the whole budget still runs, just alone
+        size = min(size, self.limit)
+
+        with self.cond:
+            while self.used + size > self.limit:
+                self.cond.wait()
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+        return size
+
+    def release(self, size: int):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+
+def _reset_peak_rss():
+    # Linux only, resets VmHWM to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as fd:
+            fd.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss() -> int:
+    try:
+        with open("/proc/self/status", "r") as fd:
+            for line in fd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Peak of the whole process then, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMemory:
+    """
+    Peak RSS while each stage of a run was active. Stages of the pipeline overlap, so a
+    sampler thread reads and resets VmHWM periodically and whenever a stage starts or ends,
+    the peak of each interval counts for every stage that was running during it
+    """
+
+    SAMPLE_INTERVAL = 0.05
+
+    def __init__(self):
+        self.peaks: dict[str, int] = {}
+        # Stage name -> how many threads are in it
+        self.active: dict[str, int] = {}
+        self.lock = threading.Lock()
+        # (thread, event that stops it) while any stage is active
+        self.sampler = None
+
+    def sample(self):
+        # Called with the lock held
+        peak = _peak_rss()
+        _reset_peak_rss()
+        for name in self.active:
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+    def run_sampler(self, stopped: threading.Event):
+        while not stopped.wait(self.SAMPLE_INTERVAL):
+            with self.lock:
+                self.sample()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        with self.lock:
+            self.sample()
+            self.active[name] = self.active.get(name, 0) + 1
+            if self.sampler is None:
+                stopped = threading.Event()
+                thread = threading.Thread(target=self.run_sampler, args=(stopped,), daemon=True)
+                thread.start()
+                self.sampler = (thread, stopped)
+
+        try:
+            yield
+        finally:
+            sampler = None
+            with self.lock:
+                self.sample()
+                self.active[name] -= 1
+                if self.active[name] == 0:
+                    del self.active[name]
+                if not self.active:
+                    sampler, self.sampler = self.sampler, None
+            if sampler is not None:
+                thread, stopped = sampler
+                stopped.set()
+                thread.join()
@@ -0,0 +1,241 @@
+"""
+Metrics of a run, written as an OpenMetrics textfile (for the node_exporter textfile
+collector and the like) and as a JSON run summary, which `dataminer stats compare` reads
+"""
+
+from pathlib import Path
+import json
+import os
+import threading
+
+TEXTFILE_NAME = ".dataminer_metrics.prom"
+SUMMARY_FILE_NAME = ".dataminer_run.json"
+
+# Upper bounds in seconds of the processor duration histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class ProcessorMetrics:
+    def __init__(self):
+        self.files = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.bytes = 0
+        self.duration = 0.0
+        # Count per bucket, the last one being +Inf
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+
+    def observe(self, duration: float):
+        self.duration += duration
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def to_json(self):
+        return {
+            "files": self.files,
+            "failures": self.failures,
+            "cache_hits": self.cache_hits,
+            "bytes": self.bytes,
+            "duration": self.duration,
+            "buckets": self.buckets,
+        }
+
+
+class Metrics:
+    """Counters of the current run, shared by everything that takes part in it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.processors: dict[str, ProcessorMetrics] = {}
+            # Extractor name -> entries handed out
+            self.extractor_entries: dict[str, int] = {}
+            self.subprocess_spawns = 0
+            self.temp_file_bytes = 0
+
+    def processor_done(self, name: str, size: int, duration: float, failed=False, cached=False):
+        with self.lock:
+            proc = self.processors.get(name)
+            if proc is None:
+                proc = self.processors[name] = ProcessorMetrics()
+            proc.files += 1
+            proc.bytes += size
+            proc.failures += failed
+            proc.cache_hits += cached
+            proc.observe(duration)
+
+    def extractor_entry(self, name: str):
+        with self.lock:
+            self.extractor_entries[name] = self.extractor_entries.get(name, 0) + 1
+
+    def subprocess_spawned(self):
+        with self.lock:
+            self.subprocess_spawns += 1
+
+    def temp_file_written(self, size: int):
+        with self.lock:
+            self.temp_file_bytes += size
+
+    def summary(self, **run) -> dict:
+        """run holds anything else about the run, like its duration and peak RSS"""
+        with self.lock:
+            return dict(
+                run,
+                processors={name: proc.to_json() for name, proc in sorted(self.processors.items())},
+                extractor_entries=dict(sorted(self.extractor_entries.items())),
+                subprocess_spawns=self.subprocess_spawns,
+                temp_file_bytes=self.temp_file_bytes,
+            )
+
+
+METRICS = Metrics()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def to_openmetrics(summary: dict) -> str:
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# TYPE dataminer_{name} {kind}")
+        lines.append(f"# HELP dataminer_{name} {help_text}")
+        for suffix, labels, value in samples:
+            lines.append(f"dataminer_{name}{suffix}{labels} {value}")
+
+    processors = summary["processors"]
+
+    family("run_timestamp_seconds", "gauge", "Start of the run.", [("", "", summary["started"])])
+    family("run_duration_seconds", "gauge", "Wall time of the run.", [("", "", summary["duration"])])
+    family("run_files", "gauge", "Files with work in the run.", [("", "", summary["files"])])
+    family("input_files", "gauge", "Files in the input directory.", [("", "", summary["input_files"])])
+
+    for name, key, help_text in (
+        ("processor_files", "files", "Files a processor ran on."),
+        ("processor_failures", "failures", "Files a processor failed on."),
+        ("processor_cache_hits", "cache_hits", "Outputs taken from the result cache."),
+        ("processor_bytes", "bytes", "Input bytes of the files a processor ran on."),
+    ):
+        family(name, "counter", help_text, [
+            ("_total", _labels(processor=proc), metrics[key]) for proc, metrics in processors.items()
+        ])
+
+    samples = []
+    for proc, metrics in processors.items():
+        count = 0
+        for bound, n in zip(DURATION_BUCKETS + ("+Inf",), metrics["buckets"]):
+            count += n
+            samples.append(("_bucket", _labels(processor=proc, le=bound), count))
+        samples.append(("_sum", _labels(processor=proc), metrics["duration"]))
+        samples.append(("_count", _labels(processor=proc), count))
+    family("processor_duration_seconds", "histogram", "Time a processor took per file.", samples)
+
+    family("extractor_entries", "counter", "Archive entries handed out by an extractor.", [
+        ("_total", _labels(extractor=name), n) for name, n in summary["extractor_entries"].items()
+    ])
+    family("subprocess_spawns", "counter", "External processes started.", [
+        ("_total", "", summary["subprocess_spawns"])
+    ])
+    family("temp_file_bytes", "counter", "Bytes of archive entries written to temp files.", [
+        ("_total", "", summary["temp_file_bytes"])
+    ])
+    family("peak_rss_bytes", "gauge", "Peak resident set size during a stage of the run.", [
+        ("", _labels(stage=stage), peak) for stage, peak in summary["peak_rss"].items()
+    ])
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path: Path, text: str):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as fd:
+        fd.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_metrics(output_root: Path, summary: dict, textfile: Path = None):
+    """textfile is an additional path for the OpenMetrics text, like a collector directory"""
+    _write_atomic(output_root.joinpath(SUMMARY_FILE_NAME), json.dumps(summary, indent=1))
+
+    text = to_openmetrics(summary)
+    _write_atomic(output_root.joinpath(TEXTFILE_NAME), text)
+    if textfile is not None:
+        _write_atomic(textfile, text)
+
+
+def load_summary(path: Path) -> dict:
+    """path is a run summary or the output directory of a run"""
+    if path.is_dir():
+        path = path.joinpath(SUMMARY_FILE_NAME)
+
+    with open(path, "r") as fd:
+        return json.load(fd)
+
+
+def _comparisons(old: dict, new: dict):
+    """
+    Yields (what, old value, new value, whether higher is worse, seconds it's based on),
+    the seconds being None for what isn't a timing
+    """
+    yield "run duration (s)", old["duration"], new["duration"], True, max(old["duration"], new["duration"])
+
+    for proc in sorted(set(old["processors"]) & set(new["processors"])):
+        o = old["processors"][proc]
+        n = new["processors"][proc]
+        seconds = max(o["duration"], n["duration"])
+        yield f"{proc} duration (s)", o["duration"], n["duration"], True, seconds
+        # Inputs change with every update, throughput is comparable regardless
+        yield (
+            f"{proc} throughput (MB/s)",
+            o["bytes"] / o["duration"] / 1e6 if o["duration"] else 0.0,
+            n["bytes"] / n["duration"] / 1e6 if n["duration"] else 0.0,
+            False,
+            seconds,
+        )
+        yield f"{proc} failures", o["failures"], n["failures"], True, None
+
+    yield "subprocess spawns", old["subprocess_spawns"], new["subprocess_spawns"], True, None
+    yield (
+        "temp files (MB)", old["temp_file_bytes"] / 1e6, new["temp_file_bytes"] / 1e6, True, None
+    )
+
+    for stage in old["peak_rss"]:
+        if stage in new["peak_rss"]:
+            yield (
+                f"peak RSS {stage} (MB)", old["peak_rss"][stage] / 1e6, new["peak_rss"][stage] / 1e6,
+                True, None,
+            )
+
+
+def compare(old: dict, new: dict, threshold: float, min_duration: float) -> list[str]:
+    """Prints the differences between two runs, returns what got worse by more than threshold"""
+    regressions = []
+
+    for what, o, n, higher_is_worse, seconds in _comparisons(old, new):
+        change = (n - o) / o if o else (0.0 if n == o else float("inf"))
+        worse = change > threshold if higher_is_worse else change < -threshold
+
+        # Short timings are mostly noise
+        if seconds is not None and seconds < min_duration:
+            worse = False
+
+        flag = " REGRESSION" if worse else ""
+        o_text = f"{o:.2f}" if isinstance(o, float) else str(o)
+        n_text = f"{n:.2f}" if isinstance(n, float) else str(n)
+        print(f"{what:40} {o_text:>12} {n_text:>12} {change * 100:>+9.1f}%{flag}")
+        if worse:
+            regressions.append(what)
+
+    return regressions
@@ -0,0 +1,139 @@
+from pathlib import Path
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+
+# New contents are kept in memory up to this size before spilling into a temporary file
+SPILL_SIZE = 8 * 1024 * 1024
+
+
+class OutputStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.unchanged = 0
+
+    def count(self, changed: bool):
+        with self.lock:
+            if changed:
+                self.written += 1
+            else:
+                self.unchanged += 1
+
+
+def _file_digest(path: Path):
+    digest = hashlib.md5()
+    with open(path, "rb", buffering=0) as fd:
+        buf = bytearray(1024 * 1024)
+        view = memoryview(buf)
+        for n in iter(lambda: fd.readinto(buf), 0):
+            digest.update(view[:n])
+    return digest.digest()
+
+
+@contextlib.contextmanager
+def plain_output(path: Path):
+    """Output file that is removed again if writing it fails, instead of being left half written"""
+    fd = path.open("wb")
+    try:
+        with fd:
+            yield fd
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+
+class ChangedOnlyFile:
+    """
+    Write-only file that leaves the existing file at path untouched (including mtime)
+    if the new contents are identical. Compares the size first, and the hash only if needed
+    """
+
+    def __init__(self, path: Path, stats: OutputStats):
+        self.path = path
+        self.stats = stats
+
+        self.size = 0
+        self.digest = hashlib.md5()
+        self.buffer = bytearray()
+        self.spill = None
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+
+        if self.spill is None:
+            self.buffer += data
+            if len(self.buffer) > SPILL_SIZE:
+                self.spill = tempfile.NamedTemporaryFile(
+                    "wb", dir=self.path.parent, prefix=f".{self.path.name}.", delete=False
+                )
+                self.spill.write(self.buffer)
+                self.buffer = bytearray()
+        else:
+            self.spill.write(data)
+
+        return len(data)
+
+    def _unchanged(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return False
+
+        return st.st_size == self.size and _file_digest(self.path) == self.digest.digest()
+
+    def _discard(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.unlink(self.spill.name)
+            self.spill = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._unchanged():
+            self._discard()
+            self.stats.count(False)
+            return
+
+        if self.spill is None:
+            self.spill = tempfile.NamedTemporaryFile(
+                "wb", dir=self.path.parent, prefix=f".{self.path.name}.", delete=False
+            )
+            self.spill.write(self.buffer)
+            self.buffer = bytearray()
+
+        self.spill.close()
+        os.chmod(self.spill.name, 0o666 & ~_UMASK)
+        os.replace(self.spill.name, self.path)
+        self.spill = None
+        self.stats.count(True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Don't replace a good output with a partial one
+            self.closed = True
+            self._discard()
+            return
+        self.close()
+
+
+def _get_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _get_umask()
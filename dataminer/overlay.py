@@ -0,0 +1,97 @@
+from dataminer import vpk
+
+from pathlib import Path
+import os
+
+
+class OverlayIndex:
+    """
+    Merged index of several vpks and loose file directories, resolving every game path to
+    the copy that comes first in the search path, like the game does. Game paths are
+    compared case-insensitively
+    """
+
+    def __init__(self):
+        # Game path (lowercase) -> (source, metadata), source being the path of the _dir.vpk or
+        # directory relative to the input root, metadata None for loose files
+        self.entries: dict[str, tuple] = {}
+        # In priority order
+        self.sources: list[str] = []
+        self.dirs: list[str] = []
+        self.overridden = 0
+
+    @classmethod
+    def build(cls, input_root: Path, search_paths: list[str]):
+        """search_paths are globs relative to input_root, highest priority first"""
+        index = cls()
+
+        for pattern in search_paths:
+            for path in sorted(input_root.glob(pattern)):
+                source = path.relative_to(input_root).as_posix()
+                if source in index.sources:
+                    continue
+
+                if path.is_dir():
+                    index.add_dir(path, source)
+                elif path.name.endswith("_dir.vpk"):
+                    index.add_vpk(path, source)
+
+        return index
+
+    def _add(self, game_path: str, source: str, metadata):
+        key = game_path.lower()
+        if key in self.entries:
+            self.overridden += 1
+        else:
+            self.entries[key] = (source, metadata)
+
+    def add_vpk(self, path: Path, source: str):
+        self.sources.append(source)
+
+        for game_path, metadata in vpk.open(path.as_posix()).read_index_iter():
+            self._add(game_path, source, metadata)
+
+    def add_dir(self, path: Path, source: str):
+        self.sources.append(source)
+        self.dirs.append(source)
+
+        for root, _, files in os.walk(path):
+            rel_root = Path(root).relative_to(path).as_posix()
+            for name in files:
+                self._add(name if rel_root == "." else f"{rel_root}/{name}", source, None)
+
+    def lookup(self, game_path: str):
+        """(source, metadata) of the copy of game_path the game would load, or None"""
+        return self.entries.get(game_path.lower())
+
+    def path_filter(self, source: str):
+        """
+        read_index_iter path_filter for the vpk source, that only passes entries
+        it provides. None if the vpk isn't part of the search path
+        """
+        if source not in self.sources:
+            return None
+
+        entries = self.entries
+
+        def effective(game_path):
+            winner = entries.get(game_path.lower())
+            return winner is None or winner[0] == source
+
+        return effective
+
+    def is_effective(self, relpath: str) -> bool:
+        """False for loose files (relative to the input root) that are overridden"""
+        source = None
+        prefix = ""
+        for d in self.dirs:
+            d_prefix = "" if d == "." else d + "/"
+            if relpath.startswith(d_prefix) and (source is None or len(d_prefix) > len(prefix)):
+                source = d
+                prefix = d_prefix
+
+        if source is None:
+            return True
+
+        winner = self.lookup(relpath[len(prefix) :])
+        return winner is None or winner[0] == source
@@ -0,0 +1,71 @@
+from fnmatch import fnmatchcase
+from pathlib import Path
+import json
+import os
+
+DEFAULT_CLASS = "default"
+MARKER_PREFIX = ".dataminer_done_"
+
+
+class PriorityClasses:
+    """
+    Classes of work from the priorities config, highest first. A file belongs to the highest
+    class that one of its filters matches or that one of its processors is assigned to
+    with priority: <class>, everything else to the default class, which comes last unless
+    it's listed
+    """
+
+    def __init__(self, config: list):
+        self.names = [entry["name"] for entry in config]
+        self.filters = [entry.get("filters", []) for entry in config]
+
+        if DEFAULT_CLASS not in self.names:
+            self.names.append(DEFAULT_CLASS)
+            self.filters.append([])
+        self.default = self.names.index(DEFAULT_CLASS)
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name: str) -> int:
+        if name not in self.names:
+            raise ValueError(f'unknown priority class "{name}"')
+        return self.names.index(name)
+
+    def classify(self, relpath: str, processors: list) -> int:
+        best = self.default
+        for proc in processors:
+            if "priority" in proc.config:
+                best = min(best, self.index(proc.config["priority"]))
+
+        for i in range(best):
+            if any(fnmatchcase(relpath, pat) for pat in self.filters[i]):
+                return i
+
+        return best
+
+
+def marker_path(output_root: Path, name: str) -> Path:
+    return output_root.joinpath(f"{MARKER_PREFIX}{name}.json")
+
+
+def clear_markers(output_root: Path):
+    """Markers of an earlier run would tell that work of this one is done"""
+    for path in output_root.glob(f"{MARKER_PREFIX}*.json"):
+        path.unlink()
+
+
+def write_marker(output_root: Path, name: str, outputs, failures: int, duration: float):
+    """Written once all work of a class is done, so its outputs can be used right away"""
+    marker = {
+        "class": name,
+        "outputs": sorted(outputs),
+        "failures": failures,
+        "duration": duration,
+    }
+
+    path = marker_path(output_root, name)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as fd:
+        json.dump(marker, fd, indent=1)
+    os.replace(tmp_path, path)
@@ -1,39 +1,233 @@
 from dataminer.file import File
+from dataminer.metrics import METRICS
 
 from pathlib import Path
+import codecs
+import hashlib
+import itertools
+import os
 import re
+import selectors
+import signal
+import struct
 import subprocess
+import tempfile
+import threading
+import time
 import typing
 import shutil
-from dataminer import vpk
+from dataminer import protobuf, vpk
+from dataminer.output import SPILL_SIZE, ChangedOnlyFile, OutputStats, plain_output
+from dataminer.symbols import SymbolReaderError, is_universal, symbol_names
+
+
+class ProcessorError(Exception):
+    pass
+
+
+class ToolTimeoutError(ProcessorError):
+    pass
+
+
+def _kill_process_group(proc: subprocess.Popen):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def run_tool(command, timeout=None, max_output_bytes=None, stdout_file=None, **kwargs):
+    """
+    Runs command in its own process group, returns (returncode, stdout, stderr).
+    The whole group is killed if it runs longer than timeout or outputs more than max_output_bytes.
+    With stdout_file, stdout is written to it as it comes instead of being returned
+    """
+    METRICS.subprocess_spawned()
+    proc = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+        **kwargs,
+    )
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+
+    stdout, stderr = bytearray(), bytearray()
+    outputs = {proc.stdout.fileno(): stdout, proc.stderr.fileno(): stderr}
+    total_output = 0
+
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(proc.stdout, selectors.EVENT_READ)
+            sel.register(proc.stderr, selectors.EVENT_READ)
+
+            while sel.get_map():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ToolTimeoutError(f"timed out after {timeout}s")
+
+                for key, _ in sel.select(remaining):
+                    data = os.read(key.fd, 1024 * 1024)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        continue
+
+                    if stdout_file is not None and key.fd == proc.stdout.fileno():
+                        stdout_file.write(data)
+                    else:
+                        outputs[key.fd] += data
+                    total_output += len(data)
+                    if max_output_bytes is not None and total_output > max_output_bytes:
+                        raise ProcessorError(f"output exceeded {max_output_bytes} bytes")
+
+        try:
+            proc.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            raise ToolTimeoutError(f"timed out after {timeout}s")
+    except BaseException:
+        _kill_process_group(proc)
+        raise
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+
+    return proc.returncode, bytes(stdout), bytes(stderr)
+
+
+def _split_lines(fd):
+    """Same lines as fd.read().decode("utf8").split("\\n"), without reading everything at once"""
+    decoder = codecs.getincrementaldecoder("utf8")()
+    rest = ""
+
+    while True:
+        chunk = fd.read(1024 * 1024)
+        lines = (rest + decoder.decode(chunk, final=not chunk)).split("\n")
+        rest = lines.pop()
+        yield from lines
+        if not chunk:
+            break
+
+    yield rest
 
 
 class Processor:
     name: str
 
+    # Defaults for naming output files, see output_path_for
+    output_suffix = ".txt"
+    no_processor_name = False
+    replace_processor_name = None
+
+    # If set, outputs with unchanged contents are left untouched
+    output_stats: typing.Optional[OutputStats] = None
+
+    # The output only depends on the input contents and the config, so it can be
+    # taken from the result cache. Only for processors that write one output file
+    cacheable = False
+
+    # Set for resumed runs, the outputs of the interrupted run are still there
+    resume = False
+
     config: dict[str, str]
 
     def __init__(self, output_root: Path, config: dict[str, str]):
         self.output_root = output_root
         self.config = config
 
-    # Public interface to process_file
-    def run_processor(self, file: File):
-        self.process_file(file)
+    # Public interface to process_file. Returns the paths that were written for the file,
+    # or None if that's just output_path_for
+    def run_processor(self, file: File) -> typing.Optional[list[Path]]:
+        return self.process_file(file)
 
     # TODO: Maybe rename this?
     def pre_process(self):
         pass
 
+    # Called once everything has been processed, and after every batch in watch mode
+    def post_process(self):
+        pass
+
+    # Outputs of a file that is processed again or was removed, in watch mode
+    def forget(self, output_paths: list[Path]):
+        pass
+
     def process_file(self, file: File):
         pass
 
+    # Anything besides the contents and the config that ends up in the output
+    def cache_key_extra(self, file: File) -> str:
+        return ""
+
+    def run_tool(self, command, file_args, stdout_file=None, **kwargs):
+        """
+        Runs an external tool with the timeout, retries and max_output_bytes from the config,
+        file_args are appended to command. Raises ProcessorError if it doesn't succeed.
+        Returns stdout, unless stdout_file is given to write it to
+
+        With worker: true in the config, file_args are sent to a long-lived helper instead
+        """
+        if command[0] is None:
+            raise ProcessorError("tool not found")
+
+        attempts = int(self.config.get("retries", 0)) + 1
+
+        for attempt in range(1, attempts + 1):
+            if stdout_file is not None:
+                # Whatever a failed attempt wrote
+                stdout_file.seek(0)
+                stdout_file.truncate()
+
+            try:
+                if self.config.get("worker", False):
+                    from dataminer.worker import WORKER_POOL
+
+                    # The helper protocol sends the whole output at once
+                    stdout = WORKER_POOL.request(
+                        command,
+                        file_args,
+                        env=kwargs.get("env"),
+                        timeout=self.config.get("timeout"),
+                        max_output_bytes=self.config.get("max_output_bytes"),
+                    )
+                    if stdout_file is not None:
+                        stdout_file.write(stdout)
+                    return stdout
+
+                returncode, stdout, stderr = run_tool(
+                    command + file_args,
+                    timeout=self.config.get("timeout"),
+                    max_output_bytes=self.config.get("max_output_bytes"),
+                    stdout_file=stdout_file,
+                    **kwargs,
+                )
+
+                if returncode != 0:
+                    if stdout_file is not None:
+                        stdout_file.seek(0)
+                        stdout = stdout_file.read()
+                    print(stdout.decode("utf8", "replace"))
+                    print(stderr.decode("utf8", "replace"))
+                    raise ProcessorError(f"exited with code {returncode}")
+
+                return stdout
+            except ProcessorError as e:
+                if attempt == attempts:
+                    raise
+                print(f'RETRY: processor "{self.name}" {e}, attempt {attempt + 1}/{attempts}')
+
     def run_command_for_file(
         self,
         command,
         file: File,
-        output_suffix=".txt",
-        no_processor_name=False,
+        output_suffix=None,
+        no_processor_name=None,
         replace_processor_name=None,
         **kwargs,
     ):
@@ -42,12 +236,11 @@ class Processor:
 
         command[0] = shutil.which(command[0])
 
-        proc = subprocess.run(
-            command + [file.obtain_real_file_path()], capture_output=True, **kwargs
-        )
+        # Only big outputs end up on disk
+        with tempfile.SpooledTemporaryFile(SPILL_SIZE) as stdout:
+            self.run_tool(command, [file.obtain_real_file_path()], stdout_file=stdout, **kwargs)
+            stdout.seek(0)
 
-        # TODO: Proper Error handling
-        if proc.returncode == 0:
             with self.create_output_file_for(
                 file,
                 output_suffix=output_suffix,
@@ -55,32 +248,54 @@ class Processor:
                 replace_processor_name=replace_processor_name,
             ) as output:
                 if "line_discard_filter" in self.config:
-                    r = re.compile(self.config["line_discard_filter"])
-                    for line in proc.stdout.decode("utf8").split("\n"):
-                        line = line.strip()
-                        if r.search(line) == None:
-                            output.write((line + "\n").encode("utf8"))
+                    self.write_filtered_lines(output, _split_lines(stdout))
                 else:
-                    output.write(proc.stdout)
-        else:
-            print("ERROR:", file.path, proc.returncode, self.name)
-            print(proc.stdout.decode("utf8"))
-            print(proc.stderr.decode("utf8"))
+                    shutil.copyfileobj(stdout, output, 1024 * 1024)
+
+    # Applies line_discard_filter from the config
+    def write_filtered_lines(self, output, lines: typing.Iterable[str]):
+        r = re.compile(self.config["line_discard_filter"])
+        for line in lines:
+            line = line.strip()
+            if r.search(line) == None:
+                output.write((line + "\n").encode("utf8"))
+
+    def output_path_for(
+        self, file: File, output_suffix=None,
+        no_processor_name=None, replace_processor_name=None,
+    ) -> Path:
+        if output_suffix is None:
+            output_suffix = self.output_suffix
+        if no_processor_name is None:
+            no_processor_name = self.no_processor_name
+        if replace_processor_name is None:
+            replace_processor_name = self.replace_processor_name
 
-    def create_output_file_for(
-        self, file: File, output_suffix=".txt",
-        no_processor_name=False, replace_processor_name=None,
-    ):
         path = file.path
         final_dir = self.output_root.joinpath(path.parent.relative_to(file.input_root))
-        final_dir.mkdir(parents=True, exist_ok=True)
 
         final_fname = f"{path.stem}_{replace_processor_name or self.name}{output_suffix}"
         if no_processor_name:
             final_fname = f"{path.stem}{output_suffix}"
-        final_path: Path = final_dir.joinpath(final_fname)
 
-        return final_path.open("wb")
+        return final_dir.joinpath(final_fname)
+
+    def create_output_file_for(
+        self, file: File, output_suffix=None,
+        no_processor_name=None, replace_processor_name=None,
+    ):
+        final_path = self.output_path_for(
+            file, output_suffix, no_processor_name, replace_processor_name
+        )
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+
+        return self.open_output(final_path)
+
+    def open_output(self, path: Path):
+        if self.output_stats is not None:
+            return ChangedOnlyFile(path, self.output_stats)
+
+        return plain_output(path)
 
 
 class VtableProcessor(Processor):
@@ -92,6 +307,7 @@ class VtableProcessor(Processor):
 
 class StringProcessor(Processor):
     name = "strings"
+    cacheable = True
 
     def process_file(self, file: File):
         self.run_command_for_file("strings", file)
@@ -99,9 +315,46 @@ class StringProcessor(Processor):
 
 class SymbolsProcessor(Processor):
     name = "symbols"
+    cacheable = True
+
+    # The path is part of the architecture headers of universal binaries, only their output
+    # depends on it
+    def cache_key_extra(self, file: File) -> str:
+        if "bin_path" in self.config:
+            return file.path.as_posix()
+
+        with file.open() as fd:
+            if not is_universal(fd.read(4)):
+                return ""
+        return self.display_path(file)
+
+    @staticmethod
+    def display_path(file: File) -> str:
+        return file.obtain_real_file_path().as_posix() if file.is_real else file.path.as_posix()
 
     def process_file(self, file: File):
-        self.run_command_for_file(["nm", "--just-symbol-name"], file)
+        # An external nm compatible tool can still be used
+        if "bin_path" in self.config:
+            self.run_command_for_file([self.config["bin_path"], "--just-symbol-name"], file)
+            return
+
+        # Written while they are read, only the symbols of one architecture are held at a time.
+        # The output is dropped again if the file turns out to be broken halfway through
+        with file.map() as data, self.create_output_file_for(file) as output:
+            names = symbol_names(
+                data, self.display_path(file), dynamic=self.config.get("dynamic", False)
+            )
+            lines = (name.decode("utf8", "replace") for name in names)
+
+            try:
+                if "line_discard_filter" in self.config:
+                    # Same as the output of the tool being split on newlines
+                    self.write_filtered_lines(output, itertools.chain(lines, [""]))
+                else:
+                    for line in lines:
+                        output.write((line + "\n").encode("utf8"))
+            except (SymbolReaderError, struct.error, IndexError) as e:
+                raise ProcessorError(f"couldn't read symbols: {e}")
 
 
 class NetvarProcessor(Processor):
@@ -120,6 +373,7 @@ class NetvarProcessor(Processor):
 
 class ConvarProcessor(Processor):
     name = "convars"
+    cacheable = True
 
     def process_file(self, file: File):
         assert file.is_real
@@ -132,52 +386,121 @@ class ConvarProcessor(Processor):
         self.run_command_for_file(self.config["bin_path"], file, env=env)
 
 
+def descriptor_rank(data: bytes) -> tuple[int, bytes]:
+    """
+    Many binaries embed the same descriptors. Of differing versions of a .proto the one with
+    the highest rank is kept, so neither the order of files nor sharding changes the result
+    """
+    return len(data), hashlib.sha256(data).digest()
+
+
 class ProtobufProcessor(Processor):
     name = "protobufs"
+    output_dir = "Protobufs"
 
     def pre_process(self):
-        self.protobuf_dir = self.output_root.joinpath("Protobufs")
+        self.protobuf_dir = self.output_root.joinpath(self.output_dir)
+
+        self.protobuf_dir.mkdir(parents=True, exist_ok=True)
 
-        self.protobuf_dir.mkdir()
+        # Descriptor name -> rank of the version that was written
+        self.written: dict[str, tuple] = {}
+        self.written_lock = threading.Lock()
+
+    def output_path_for(self, file: File, *args, **kwargs) -> Path:
+        # Descriptors found by the built-in extractor all go into one tree
+        if "bin_path" not in self.config:
+            return self.output_root.joinpath(self.output_dir)
+
+        return self.output_root.joinpath(self.output_dir, file.path.stem)
+
+    def forget(self, output_paths: list[Path]):
+        with self.written_lock:
+            for path in output_paths:
+                if path.is_relative_to(self.protobuf_dir):
+                    # What was written may be the version of the forgotten file, any other one wins
+                    self.written[path.relative_to(self.protobuf_dir).as_posix()] = (-1, b"")
+
+    # Called with written_lock held
+    def written_rank(self, name: str, path: Path) -> tuple:
+        rank = self.written.get(name)
+        if rank is None and self.resume and path.is_file():
+            # Written before the run was interrupted
+            rank = self.written[name] = descriptor_rank(path.read_bytes())
+        return rank if rank is not None else (-1, b"")
 
     def process_file(self, file: File):
-        out_path = self.protobuf_dir.joinpath(file.path.stem)
-        proc = subprocess.run(
-            [
-                shutil.which(self.config["bin_path"]),
-                file.obtain_real_file_path(),
-                out_path,
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
+        # An external dumper can still be used
+        if "bin_path" in self.config:
+            out_path = self.output_path_for(file)
+            self.run_tool(
+                [shutil.which(self.config["bin_path"])],
+                [file.obtain_real_file_path(), out_path],
+            )
+            return
+
+        with file.map() as data:
+            found = list(protobuf.find_file_descriptors(data))
+
+        # Custom options are defined in descriptors of the same binary
+        registry = protobuf.Registry()
+        for _, descriptor in found:
+            registry.add(descriptor)
 
-        # TODO: Proper Error handling
-        if proc.returncode != 0:
-            print("ERROR:", file, proc.returncode, self.name)
+        # Every descriptor of the file, also the ones another file has a better version of
+        outputs = []
+
+        for _, descriptor in found:
+            name = descriptor["name"]
+            if name.startswith("/") or ".." in name.split("/"):
+                print(f'Skipping protobuf descriptor with unsafe name "{name}" in "{file.path}"')
+                continue
+
+            try:
+                text = protobuf.to_proto(descriptor, registry).encode("utf8")
+            except protobuf.DescriptorError as e:
+                raise ProcessorError(str(e))
+
+            path = self.protobuf_dir.joinpath(name)
+            outputs.append(path)
+            rank = descriptor_rank(text)
+
+            with self.written_lock:
+                if self.written_rank(name, path) >= rank:
+                    continue
+                self.written[name] = rank
+
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with self.open_output(path) as fd:
+                    fd.write(text)
+
+        return outputs
 
 
 class BspEntitiesProcessor(Processor):
     name = "bsp_entities"
+    replace_processor_name = "entities"
 
     def process_file(self, file: File):
-        self.run_command_for_file(["bspinfo", "entities"], file, replace_processor_name="entities")
+        self.run_command_for_file(["bspinfo", "entities"], file)
 
 class BspFileListingProcessor(Processor):
     name = "bsp_listing"
+    replace_processor_name = "listing"
 
     def process_file(self, file: File):
-        self.run_command_for_file(["bspinfo", "files"], file, replace_processor_name="listing")
+        self.run_command_for_file(["bspinfo", "files"], file)
 
 class VpkProcessor(Processor):
     name = "vpk"
+    no_processor_name = True
 
     def process_file(self, file: File):
         assert file.is_real
 
         pak = vpk.open(file.path)
 
-        with self.create_output_file_for(file, no_processor_name=True) as fd:
+        with self.create_output_file_for(file) as fd:
             entries = []
             for name, meta in pak.read_index_iter():
                 # WTF
@@ -194,21 +517,40 @@ class VpkProcessor(Processor):
                 fd.write(line.encode("utf8"))
 
 
+def transcode(inp_fd, encoding: str, output_encoding: str, out_fd=None) -> bool:
+    """
+    Decodes the rest of inp_fd in chunks, writing it in output_encoding to out_fd if given.
+    Returns False if it can't be decoded
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        while True:
+            chunk = inp_fd.read(1024 * 1024)
+            text = decoder.decode(chunk, final=not chunk)
+            if out_fd is not None:
+                out_fd.write(text.encode(output_encoding))
+            if not chunk:
+                return True
+    except UnicodeError:
+        return False
+
+
 class CopyProcessor(Processor):
     name = "copy"
 
+    def output_path_for(self, file: File, *args, **kwargs) -> Path:
+        path = file.path
+        final_dir = self.output_root.joinpath(path.parent.relative_to(file.input_root))
+
+        return final_dir.joinpath(file.path.name)
+
     def process_file(self, file: File):
         do_raw_copy = True
 
-        path = file.path
-        final_dir = self.output_root.joinpath(path.parent.relative_to(file.input_root))
-        final_dir.mkdir(parents=True, exist_ok=True)
+        output_file = self.output_path_for(file)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
 
-        output_file = final_dir.joinpath(file.path.name)
-        
-        with file.open() as inp_fd, output_file.open(
-            "wb"
-        ) as out_fd:
+        with file.open() as inp_fd, self.open_output(output_file) as out_fd:
             if self.config["convert_utf8"]:
                 do_raw_copy = False
 
@@ -230,31 +572,32 @@ class CopyProcessor(Processor):
                     encoding = "utf-16le"
                     n_copy_back = 2
 
-                data = bom[-n_copy_back:] + inp_fd.read()
+                start = len(bom) - n_copy_back if n_copy_back else 0
 
-                # If decode fails, fallback to raw copy
-                try:
-                    decoded = data.decode(encoding)
-                    out_fd.write(decoded.encode(output_encoding))
-                except:
+                # If decode fails, fallback to raw copy. It's checked before anything is
+                # written, so the file doesn't have to be held in memory
+                inp_fd.seek(start)
+                if transcode(inp_fd, encoding, output_encoding):
+                    inp_fd.seek(start)
+                    transcode(inp_fd, encoding, output_encoding, out_fd)
+                else:
                     do_raw_copy = True
 
             if do_raw_copy:
                 inp_fd.seek(0)
-                out_fd.seek(0)
-                out_fd.truncate(0)
 
                 shutil.copyfileobj(inp_fd, out_fd)
 
 
 class IceProcessor(Processor):
     name = "ice"
+    no_processor_name = True
+    cacheable = True
 
     def process_file(self, file: File):
         self.run_command_for_file(
             [self.config["bin_path"], "-d", "-k", self.config["ice_key"]],
             file,
-            no_processor_name=True,
         )
 
 
@@ -0,0 +1,772 @@
+"""
+Finds the serialized FileDescriptorProtos that protoc generated code embeds in binaries
+and turns them back into .proto files, with a minimal protobuf wire format reader
+"""
+
+import re
+import struct
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LEN = 2
+WIRE_FIXED32 = 5
+
+TYPE_DOUBLE = 1
+TYPE_FLOAT = 2
+TYPE_INT64 = 3
+TYPE_UINT64 = 4
+TYPE_INT32 = 5
+TYPE_FIXED64 = 6
+TYPE_FIXED32 = 7
+TYPE_BOOL = 8
+TYPE_STRING = 9
+TYPE_GROUP = 10
+TYPE_MESSAGE = 11
+TYPE_BYTES = 12
+TYPE_UINT32 = 13
+TYPE_ENUM = 14
+TYPE_SFIXED32 = 15
+TYPE_SFIXED64 = 16
+TYPE_SINT32 = 17
+TYPE_SINT64 = 18
+
+TYPE_NAMES = {
+    TYPE_DOUBLE: "double",
+    TYPE_FLOAT: "float",
+    TYPE_INT64: "int64",
+    TYPE_UINT64: "uint64",
+    TYPE_INT32: "int32",
+    TYPE_FIXED64: "fixed64",
+    TYPE_FIXED32: "fixed32",
+    TYPE_BOOL: "bool",
+    TYPE_STRING: "string",
+    TYPE_BYTES: "bytes",
+    TYPE_UINT32: "uint32",
+    TYPE_SFIXED32: "sfixed32",
+    TYPE_SFIXED64: "sfixed64",
+    TYPE_SINT32: "sint32",
+    TYPE_SINT64: "sint64",
+}
+
+LABEL_OPTIONAL = 1
+LABEL_REQUIRED = 2
+LABEL_REPEATED = 3
+LABEL_NAMES = {LABEL_OPTIONAL: "optional", LABEL_REQUIRED: "required", LABEL_REPEATED: "repeated"}
+
+# Exclusive end of extension ranges declared up to max
+MAX_FIELD_NUMBER = 536870911
+MAX_ENUM_NUMBER = 2147483647
+
+EDITIONS = {1000: "2023", 1001: "2024"}
+
+# Name (field 1) of a FileDescriptorProto, which is where its serialization starts
+MARKER_RE = re.compile(rb"\x0a[\x01-\x7f][\w./-]*\.proto")
+
+
+class DescriptorError(Exception):
+    pass
+
+
+def _varint(data, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise DescriptorError("Truncated varint")
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 70:
+            raise DescriptorError("Varint too long")
+
+
+def _value(data, pos: int, wire_type: int):
+    """Returns (value, position after it)"""
+    if wire_type == WIRE_VARINT:
+        return _varint(data, pos)
+
+    if wire_type == WIRE_LEN:
+        length, pos = _varint(data, pos)
+        end = pos + length
+    elif wire_type == WIRE_FIXED64:
+        end = pos + 8
+    elif wire_type == WIRE_FIXED32:
+        end = pos + 4
+    else:
+        raise DescriptorError(f"Unsupported wire type {wire_type}")
+
+    if end > len(data):
+        raise DescriptorError("Truncated field")
+    return bytes(data[pos:end]), end
+
+
+def iter_fields(data: bytes):
+    """Yields (field number, wire type, value) of a serialized message"""
+    pos = 0
+    while pos < len(data):
+        key, pos = _varint(data, pos)
+        if key >> 3 == 0:
+            raise DescriptorError("Invalid field number 0")
+        value, pos = _value(data, pos, key & 7)
+        yield key >> 3, key & 7, value
+
+
+def _signed(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _zigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+# Field number -> (name, kind, repeated), kind being "string", "int", "bool", "bytes"
+# or the schema of a nested message. Options are kept serialized, see _options
+_RANGE = {1: ("start", "int", False), 2: ("end", "int", False)}
+_ENUM_VALUE = {
+    1: ("name", "string", False),
+    2: ("number", "int", False),
+    3: ("options", "bytes", False),
+}
+_ENUM = {
+    1: ("name", "string", False),
+    2: ("value", _ENUM_VALUE, True),
+    3: ("options", "bytes", False),
+    4: ("reserved_range", _RANGE, True),
+    5: ("reserved_name", "string", True),
+}
+_FIELD = {
+    1: ("name", "string", False),
+    2: ("extendee", "string", False),
+    3: ("number", "int", False),
+    4: ("label", "int", False),
+    5: ("type", "int", False),
+    6: ("type_name", "string", False),
+    7: ("default_value", "string", False),
+    8: ("options", "bytes", False),
+    9: ("oneof_index", "int", False),
+    10: ("json_name", "string", False),
+    17: ("proto3_optional", "bool", False),
+}
+_ONEOF = {1: ("name", "string", False), 2: ("options", "bytes", False)}
+_EXTENSION_RANGE = {
+    1: ("start", "int", False),
+    2: ("end", "int", False),
+    3: ("options", "bytes", False),
+}
+_MESSAGE = {
+    1: ("name", "string", False),
+    2: ("field", _FIELD, True),
+    6: ("extension", _FIELD, True),
+    4: ("enum_type", _ENUM, True),
+    5: ("extension_range", _EXTENSION_RANGE, True),
+    8: ("oneof_decl", _ONEOF, True),
+    7: ("options", "bytes", False),
+    9: ("reserved_range", _RANGE, True),
+    10: ("reserved_name", "string", True),
+}
+_MESSAGE[3] = ("nested_type", _MESSAGE, True)
+_METHOD = {
+    1: ("name", "string", False),
+    2: ("input_type", "string", False),
+    3: ("output_type", "string", False),
+    4: ("options", "bytes", False),
+    5: ("client_streaming", "bool", False),
+    6: ("server_streaming", "bool", False),
+}
+_SERVICE = {
+    1: ("name", "string", False),
+    2: ("method", _METHOD, True),
+    3: ("options", "bytes", False),
+}
+_FILE = {
+    1: ("name", "string", False),
+    2: ("package", "string", False),
+    3: ("dependency", "string", True),
+    10: ("public_dependency", "int", True),
+    11: ("weak_dependency", "int", True),
+    4: ("message_type", _MESSAGE, True),
+    5: ("enum_type", _ENUM, True),
+    6: ("service", _SERVICE, True),
+    7: ("extension", _FIELD, True),
+    8: ("options", "bytes", False),
+    9: ("source_code_info", "bytes", False),
+    12: ("syntax", "string", False),
+    14: ("edition", "int", False),
+}
+
+
+def _decode(data: bytes, schema: dict) -> dict:
+    message = {name: [] for name, _, repeated in schema.values() if repeated}
+
+    for number, wire_type, value in iter_fields(data):
+        spec = schema.get(number)
+        if spec is None:
+            continue
+        name, kind, repeated = spec
+
+        if kind in ("int", "bool"):
+            if wire_type == WIRE_LEN and repeated:
+                # Packed
+                pos = 0
+                while pos < len(value):
+                    v, pos = _varint(value, pos)
+                    message[name].append(_signed(v))
+                continue
+            if wire_type != WIRE_VARINT:
+                raise DescriptorError(f"Unexpected wire type for {name}")
+            value = bool(value) if kind == "bool" else _signed(value)
+        else:
+            if wire_type != WIRE_LEN:
+                raise DescriptorError(f"Unexpected wire type for {name}")
+            if kind == "string":
+                try:
+                    value = value.decode("utf8")
+                except UnicodeDecodeError as e:
+                    raise DescriptorError(f"Invalid {name}: {e}")
+            elif kind != "bytes":
+                value = _decode(value, kind)
+
+        if repeated:
+            message[name].append(value)
+        else:
+            message[name] = value
+
+    return message
+
+
+def decode_file_descriptor(data: bytes) -> dict:
+    descriptor = _decode(data, _FILE)
+    if not descriptor.get("name", "").endswith(".proto"):
+        raise DescriptorError("Not a file descriptor")
+    return descriptor
+
+
+def _descriptor_end(data, start: int) -> int:
+    """
+    Where the FileDescriptorProto at start ends. The size isn't stored anywhere, it ends
+    at the first thing that isn't one of its fields (usually the string terminator)
+    """
+    pos = start
+    seen_name = False
+    while pos < len(data):
+        try:
+            key, value_pos = _varint(data, pos)
+            number, wire_type = key >> 3, key & 7
+            spec = _FILE.get(number)
+            if spec is None:
+                break
+            _, kind, repeated = spec
+            if kind == "int":
+                # Repeated ones can be packed
+                if wire_type != WIRE_VARINT and not (repeated and wire_type == WIRE_LEN):
+                    break
+            elif wire_type != WIRE_LEN:
+                break
+            if number == 1:
+                # The name of the next descriptor
+                if seen_name:
+                    break
+                seen_name = True
+            _, pos = _value(data, value_pos, wire_type)
+        except DescriptorError:
+            break
+    return pos
+
+
+def find_file_descriptors(data):
+    """Yields (serialized, decoded) FileDescriptorProtos found in data, like a mapped binary"""
+    for match in MARKER_RE.finditer(data):
+        start = match.start()
+        # The length of the name, otherwise it's just something that looks like one
+        if data[start + 1] != match.end() - start - 2:
+            continue
+
+        serialized = bytes(data[start : _descriptor_end(data, start)])
+        # Nothing but a name is much more likely a string that happens to look like one
+        if len(serialized) == match.end() - start:
+            continue
+
+        try:
+            descriptor = decode_file_descriptor(serialized)
+        except DescriptorError:
+            continue
+
+        yield serialized, descriptor
+
+
+class Registry:
+    """Extensions and enums of a set of descriptors, to render custom options by name"""
+
+    def __init__(self):
+        # (extendee, number) -> (full name, field)
+        self.extensions: dict[tuple, tuple] = {}
+        # Full name -> {number: value name}
+        self.enums: dict[str, dict] = {}
+
+    def add(self, descriptor: dict):
+        scope = "." + descriptor["package"] if descriptor.get("package") else ""
+        self._add_scope(scope, descriptor["extension"], descriptor["enum_type"], descriptor["message_type"])
+
+    def _add_scope(self, scope: str, extensions: list, enums: list, messages: list):
+        for field in extensions:
+            key = (field.get("extendee"), field.get("number"))
+            self.extensions.setdefault(key, (f"{scope}.{field['name']}", field))
+
+        for enum in enums:
+            self.enums.setdefault(
+                f"{scope}.{enum['name']}",
+                {value.get("number", 0): value["name"] for value in reversed(enum["value"])},
+            )
+
+        for message in messages:
+            self._add_scope(
+                f"{scope}.{message['name']}", message["extension"], message["enum_type"],
+                message["nested_type"],
+            )
+
+
+def quote(data: bytes) -> str:
+    out = []
+    for b in data:
+        c = chr(b)
+        if c in "\"'\\":
+            out.append("\\" + c)
+        elif c == "\n":
+            out.append("\\n")
+        elif c == "\r":
+            out.append("\\r")
+        elif c == "\t":
+            out.append("\\t")
+        elif 0x20 <= b < 0x7F:
+            out.append(c)
+        else:
+            out.append(f"\\{b:03o}")
+    return '"' + "".join(out) + '"'
+
+
+_BOOL = "bool"
+_STRING = "string"
+
+# Standard options by options message name, field number -> (name, kind or {number: name})
+KNOWN_OPTIONS = {
+    "FileOptions": {
+        1: ("java_package", _STRING),
+        8: ("java_outer_classname", _STRING),
+        9: ("optimize_for", {1: "SPEED", 2: "CODE_SIZE", 3: "LITE_RUNTIME"}),
+        10: ("java_multiple_files", _BOOL),
+        11: ("go_package", _STRING),
+        16: ("cc_generic_services", _BOOL),
+        17: ("java_generic_services", _BOOL),
+        18: ("py_generic_services", _BOOL),
+        20: ("java_generate_equals_and_hash", _BOOL),
+        23: ("deprecated", _BOOL),
+        27: ("java_string_check_utf8", _BOOL),
+        31: ("cc_enable_arenas", _BOOL),
+        36: ("objc_class_prefix", _STRING),
+        37: ("csharp_namespace", _STRING),
+        39: ("swift_prefix", _STRING),
+        40: ("php_class_prefix", _STRING),
+        41: ("php_namespace", _STRING),
+        44: ("php_metadata_namespace", _STRING),
+        45: ("ruby_package", _STRING),
+    },
+    "MessageOptions": {
+        1: ("message_set_wire_format", _BOOL),
+        2: ("no_standard_descriptor_accessor", _BOOL),
+        3: ("deprecated", _BOOL),
+        # map_entry (7) is implied by the map syntax
+        7: None,
+    },
+    "FieldOptions": {
+        1: ("ctype", {0: "STRING", 1: "CORD", 2: "STRING_PIECE"}),
+        2: ("packed", _BOOL),
+        3: ("deprecated", _BOOL),
+        5: ("lazy", _BOOL),
+        6: ("jstype", {0: "JS_NORMAL", 1: "JS_STRING", 2: "JS_NUMBER"}),
+        10: ("weak", _BOOL),
+        15: ("unverified_lazy", _BOOL),
+    },
+    "OneofOptions": {},
+    "ExtensionRangeOptions": {},
+    "EnumOptions": {2: ("allow_alias", _BOOL), 3: ("deprecated", _BOOL)},
+    "EnumValueOptions": {1: ("deprecated", _BOOL)},
+    "ServiceOptions": {33: ("deprecated", _BOOL)},
+    "MethodOptions": {
+        33: ("deprecated", _BOOL),
+        34: ("idempotency_level", {0: "IDEMPOTENCY_UNKNOWN", 1: "NO_SIDE_EFFECTS", 2: "IDEMPOTENT"}),
+    },
+}
+
+_FIXED_FORMATS = {
+    TYPE_FIXED32: "<I",
+    TYPE_SFIXED32: "<i",
+    TYPE_FLOAT: "<f",
+    TYPE_FIXED64: "<Q",
+    TYPE_SFIXED64: "<q",
+    TYPE_DOUBLE: "<d",
+}
+
+
+def _option_scalar(field: dict, wire_type: int, value, registry: Registry):
+    """Text of an extension option value, None if it can't be rendered"""
+    field_type = field.get("type")
+
+    if field_type in _FIXED_FORMATS:
+        if len(value if wire_type != WIRE_VARINT else b"") != struct.calcsize(_FIXED_FORMATS[field_type]):
+            return None
+        (number,) = struct.unpack(_FIXED_FORMATS[field_type], value)
+        return repr(number)
+
+    if field_type in (TYPE_STRING, TYPE_BYTES):
+        return quote(value) if wire_type == WIRE_LEN else None
+
+    if wire_type != WIRE_VARINT:
+        return None
+
+    if field_type == TYPE_BOOL:
+        return "true" if value else "false"
+    if field_type in (TYPE_SINT32, TYPE_SINT64):
+        return str(_zigzag(value))
+    if field_type in (TYPE_UINT32, TYPE_UINT64):
+        return str(value)
+    if field_type in (TYPE_INT32, TYPE_INT64):
+        return str(_signed(value))
+    if field_type == TYPE_ENUM:
+        number = _signed(value)
+        return registry.enums.get(field.get("type_name"), {}).get(number, str(number))
+
+    return None
+
+
+def _unknown_value(wire_type: int, value) -> str:
+    if wire_type == WIRE_VARINT:
+        return str(value)
+    if wire_type == WIRE_LEN:
+        return quote(value)
+    return "0x" + value[::-1].hex()
+
+
+def _options(data, options_name: str, registry: Registry):
+    """Returns ([(name, value text)], [unresolved (number, value text)]) of serialized options"""
+    options = []
+    unresolved = []
+    if not data:
+        return options, unresolved
+
+    known = KNOWN_OPTIONS[options_name]
+    for number, wire_type, value in iter_fields(data):
+        if number in known:
+            spec = known[number]
+            if spec is None:
+                continue
+            name, kind = spec
+            if kind == _BOOL and wire_type == WIRE_VARINT:
+                options.append((name, "true" if value else "false"))
+                continue
+            if kind == _STRING and wire_type == WIRE_LEN:
+                options.append((name, quote(value)))
+                continue
+            if isinstance(kind, dict) and wire_type == WIRE_VARINT:
+                options.append((name, kind.get(value, str(value))))
+                continue
+        else:
+            extension = registry.extensions.get((f".google.protobuf.{options_name}", number))
+            if extension is not None:
+                full_name, field = extension
+                text = _option_scalar(field, wire_type, value, registry)
+                if text is not None:
+                    options.append((f"({full_name[1:]})", text))
+                    continue
+
+        unresolved.append((number, _unknown_value(wire_type, value)))
+
+    return options, unresolved
+
+
+def _has_option(data, number: int) -> bool:
+    return bool(data) and any(n == number and v for n, _, v in iter_fields(data))
+
+
+def _range_text(start: int, end: int, maximum: int) -> str:
+    """end is inclusive"""
+    if end == maximum:
+        return f"{start} to max"
+    if end == start:
+        return str(start)
+    return f"{start} to {end}"
+
+
+class _Writer:
+    def __init__(self, descriptor: dict, registry: Registry):
+        self.descriptor = descriptor
+        self.registry = registry
+        self.proto3 = descriptor.get("syntax") == "proto3"
+        self.lines: list[str] = []
+        self.depth = 0
+
+    def line(self, text=""):
+        self.lines.append("\t" * self.depth + text if text else "")
+
+    def statement_options(self, data, options_name: str):
+        options, unresolved = _options(data, options_name, self.registry)
+        for name, value in options:
+            self.line(f"option {name} = {value};")
+        for number, value in unresolved:
+            self.line(f"// option ({number}) = {value};")
+
+    def inline_options(self, data, options_name: str, extra=()):
+        """Returns the [...] and trailing comment of a field or enum value"""
+        options, unresolved = _options(data, options_name, self.registry)
+        options = list(extra) + options
+
+        text = ""
+        if options:
+            text = " [" + ", ".join(f"{name} = {value}" for name, value in options) + "]"
+        comment = ""
+        if unresolved:
+            comment = " // " + ", ".join(f"({number}) = {value}" for number, value in unresolved)
+        return text, comment
+
+    def field_type(self, field: dict) -> str:
+        if field.get("type") in (TYPE_MESSAGE, TYPE_ENUM, TYPE_GROUP) or field.get("type") is None:
+            return field.get("type_name", "")
+        return TYPE_NAMES[field["type"]]
+
+    def label(self, field: dict) -> str:
+        label = field.get("label", LABEL_OPTIONAL)
+        if label == LABEL_OPTIONAL and self.proto3 and not field.get("proto3_optional"):
+            return ""
+        return LABEL_NAMES.get(label, "optional") + " "
+
+    def default(self, field: dict):
+        default = field.get("default_value")
+        if default is None:
+            return []
+        if field.get("type") == TYPE_STRING:
+            default = quote(default.encode("utf8"))
+        elif field.get("type") == TYPE_BYTES:
+            # Already escaped by protoc
+            default = f'"{default}"'
+        return [("default", default)]
+
+    def field(self, field: dict, label: str, nested: dict):
+        name = field["name"]
+        number = field.get("number", 0)
+
+        if field.get("type") == TYPE_GROUP:
+            group = nested.get(field.get("type_name"))
+            if group is not None:
+                options, comment = self.inline_options(field.get("options"), "FieldOptions")
+                self.line(f"{label}group {group['name']} = {number}{options} {{{comment}")
+                self.depth += 1
+                self.message_body(group, field.get("type_name"))
+                self.depth -= 1
+                self.line("}")
+                return
+
+        entry = nested.get(field.get("type_name")) if field.get("type") == TYPE_MESSAGE else None
+        if entry is not None and _has_option(entry.get("options"), 7):
+            key, value = (f for f in entry["field"] if f.get("number") in (1, 2))
+            field_type = f"map<{self.field_type(key)}, {self.field_type(value)}>"
+            label = ""
+        else:
+            field_type = self.field_type(field)
+
+        options, comment = self.inline_options(
+            field.get("options"), "FieldOptions", self.default(field)
+        )
+        self.line(f"{label}{field_type} {name} = {number}{options};{comment}")
+
+    def extensions(self, extensions: list):
+        extendees = {}
+        for field in extensions:
+            extendees.setdefault(field.get("extendee", ""), []).append(field)
+
+        for extendee, fields in extendees.items():
+            self.line(f"extend {extendee} {{")
+            self.depth += 1
+            for field in fields:
+                self.field(field, self.label(field), {})
+            self.depth -= 1
+            self.line("}")
+            self.line()
+
+    def enum(self, enum: dict):
+        self.line(f"enum {enum['name']} {{")
+        self.depth += 1
+        self.statement_options(enum.get("options"), "EnumOptions")
+
+        for value in enum["value"]:
+            options, comment = self.inline_options(value.get("options"), "EnumValueOptions")
+            self.line(f"{value['name']} = {value.get('number', 0)}{options};{comment}")
+
+        self.reserved(
+            [(r.get("start", 0), r.get("end", 0)) for r in enum["reserved_range"]],
+            enum["reserved_name"], MAX_ENUM_NUMBER,
+        )
+        self.depth -= 1
+        self.line("}")
+
+    def reserved(self, ranges: list, names: list, maximum: int):
+        if ranges:
+            self.line(
+                "reserved " + ", ".join(_range_text(start, end, maximum) for start, end in ranges) + ";"
+            )
+        if names:
+            self.line("reserved " + ", ".join(quote(n.encode("utf8")) for n in names) + ";")
+
+    def message(self, message: dict, scope: str):
+        self.line(f"message {message['name']} {{")
+        self.depth += 1
+        self.message_body(message, f"{scope}.{message['name']}")
+        self.depth -= 1
+        self.line("}")
+
+    def message_body(self, message: dict, full_name: str):
+        self.statement_options(message.get("options"), "MessageOptions")
+
+        # Map entries and groups are written as part of their field
+        nested = {f"{full_name}.{m['name']}": m for m in message["nested_type"]}
+        inline = set()
+        for field in message["field"]:
+            if field.get("type") in (TYPE_MESSAGE, TYPE_GROUP) and field.get("type_name") in nested:
+                entry = nested[field["type_name"]]
+                if field["type"] == TYPE_GROUP or _has_option(entry.get("options"), 7):
+                    inline.add(field["type_name"])
+
+        oneofs = message["oneof_decl"]
+        written_oneofs = set()
+        for field in message["field"]:
+            index = field.get("oneof_index")
+            # proto3 optional fields are in a oneof of their own, that isn't written
+            if index is None or field.get("proto3_optional") or index >= len(oneofs):
+                self.field(field, self.label(field), nested)
+                continue
+
+            if index in written_oneofs:
+                continue
+            written_oneofs.add(index)
+
+            self.line(f"oneof {oneofs[index]['name']} {{")
+            self.depth += 1
+            self.statement_options(oneofs[index].get("options"), "OneofOptions")
+            for oneof_field in message["field"]:
+                if oneof_field.get("oneof_index") == index and not oneof_field.get("proto3_optional"):
+                    self.field(oneof_field, "", nested)
+            self.depth -= 1
+            self.line("}")
+
+        for enum in message["enum_type"]:
+            self.line()
+            self.enum(enum)
+
+        for name, nested_message in nested.items():
+            if name not in inline:
+                self.line()
+                self.message(nested_message, full_name)
+
+        if message["extension"]:
+            self.line()
+            self.extensions(message["extension"])
+            self.lines.pop()
+
+        ranges = message["extension_range"]
+        if ranges:
+            self.line(
+                "extensions "
+                + ", ".join(
+                    _range_text(r.get("start", 0), r.get("end", 0) - 1, MAX_FIELD_NUMBER)
+                    for r in ranges
+                )
+                + ";"
+            )
+
+        self.reserved(
+            [(r.get("start", 0), r.get("end", 0) - 1) for r in message["reserved_range"]],
+            message["reserved_name"], MAX_FIELD_NUMBER,
+        )
+
+    def service(self, service: dict):
+        self.line(f"service {service['name']} {{")
+        self.depth += 1
+        self.statement_options(service.get("options"), "ServiceOptions")
+
+        for method in service["method"]:
+            input_type = ("stream " if method.get("client_streaming") else "") + method.get("input_type", "")
+            output_type = ("stream " if method.get("server_streaming") else "") + method.get("output_type", "")
+            signature = f"rpc {method['name']} ({input_type}) returns ({output_type})"
+
+            if method.get("options"):
+                self.line(signature + " {")
+                self.depth += 1
+                self.statement_options(method["options"], "MethodOptions")
+                self.depth -= 1
+                self.line("}")
+            else:
+                self.line(signature + ";")
+
+        self.depth -= 1
+        self.line("}")
+
+    def file(self) -> str:
+        descriptor = self.descriptor
+
+        syntax = descriptor.get("syntax") or "proto2"
+        if syntax == "editions":
+            edition = descriptor.get("edition")
+            self.line(f'edition = "{EDITIONS.get(edition, edition)}";')
+        else:
+            self.line(f'syntax = "{syntax}";')
+        self.line()
+
+        package = descriptor.get("package")
+        if package:
+            self.line(f"package {package};")
+            self.line()
+
+        dependencies = descriptor["dependency"]
+        if dependencies:
+            for i, dependency in enumerate(dependencies):
+                kind = ""
+                if i in descriptor["public_dependency"]:
+                    kind = "public "
+                elif i in descriptor["weak_dependency"]:
+                    kind = "weak "
+                self.line(f"import {kind}{quote(dependency.encode('utf8'))};")
+            self.line()
+
+        if descriptor.get("options"):
+            self.statement_options(descriptor["options"], "FileOptions")
+            self.line()
+
+        scope = "." + package if package else ""
+
+        for enum in descriptor["enum_type"]:
+            self.enum(enum)
+            self.line()
+
+        for message in descriptor["message_type"]:
+            self.message(message, scope)
+            self.line()
+
+        self.extensions(descriptor["extension"])
+
+        for service in descriptor["service"]:
+            self.service(service)
+            self.line()
+
+        while self.lines and not self.lines[-1]:
+            self.lines.pop()
+
+        return "\n".join(self.lines) + "\n"
+
+
+def to_proto(descriptor: dict, registry: Registry) -> str:
+    """.proto source of a decoded FileDescriptorProto"""
+    try:
+        return _Writer(descriptor, registry).file()
+    except (KeyError, ValueError, struct.error) as e:
+        raise DescriptorError(f"Couldn't write {descriptor.get('name')}: {e!r}")
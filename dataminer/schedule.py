@@ -0,0 +1,62 @@
+from pathlib import Path
+import heapq
+import json
+import os
+
+# Used for processors that have no history at all yet
+DEFAULT_SECONDS_PER_BYTE = 1 / (100 * 1024 * 1024)
+DEFAULT_OVERHEAD = 0.005
+
+
+class TimingHistory:
+    """Durations and sizes of previous runs, per (processor, relative path)"""
+
+    FILE_NAME = ".dataminer_timings.json"
+
+    def __init__(self, path: Path):
+        self.path = path
+        # processor name -> relative path -> [duration, size]
+        self.entries: dict[str, dict[str, list]] = {}
+
+        if path.exists():
+            try:
+                with open(path, "r") as fd:
+                    self.entries = json.load(fd)
+            except (OSError, ValueError) as e:
+                print(f'Couldn\'t load timing history "{path}":', e)
+
+        self.rates = {}
+        for proc_name, files in self.entries.items():
+            total_duration = sum(d for d, _ in files.values())
+            total_size = sum(s for _, s in files.values())
+            if total_size > 0:
+                self.rates[proc_name] = total_duration / total_size
+
+    def estimate(self, proc_name: str, relpath: str, size: int) -> float:
+        """Expected duration in seconds"""
+        previous = self.entries.get(proc_name, {}).get(relpath)
+        if previous is not None:
+            duration, old_size = previous
+            if old_size > 0 and old_size != size:
+                duration *= size / old_size
+            return duration
+
+        rate = self.rates.get(proc_name, DEFAULT_SECONDS_PER_BYTE)
+        return DEFAULT_OVERHEAD + rate * size
+
+    def record(self, proc_name: str, relpath: str, duration: float, size: int):
+        self.entries.setdefault(proc_name, {})[relpath] = [duration, size]
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as fd:
+            json.dump(self.entries, fd, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def predict_wall_time(costs: list[float], jobs: int) -> float:
+    """Simulates greedy scheduling of costs (already in scheduling order) on `jobs` workers"""
+    workers = [0.0] * max(jobs, 1)
+    for cost in costs:
+        heapq.heappush(workers, heapq.heappop(workers) + cost)
+    return max(workers)
@@ -0,0 +1,158 @@
+from dataminer.journal import Journal
+from dataminer.processor import ProtobufProcessor, descriptor_rank
+from dataminer.schedule import TimingHistory
+
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import shutil
+
+MANIFEST_FILE_NAME = ".dataminer_manifest.json"
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parses "i/N" into (i, N)"""
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid shard "{value}", expected i/N')
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'invalid shard "{value}", expected 0 <= i < N')
+
+    return index, count
+
+
+def shard_of(relpath: str, count: int) -> int:
+    # Stable across processes and machines, unlike hash()
+    digest = hashlib.md5(relpath.encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "little") % count
+
+
+def write_manifest(output_root: Path, shard, outputs):
+    manifest = {
+        "shard": list(shard) if shard is not None else None,
+        "outputs": sorted(outputs),
+    }
+
+    with open(output_root.joinpath(MANIFEST_FILE_NAME), "w") as fd:
+        json.dump(manifest, fd, indent=1)
+
+
+def load_manifest(output_root: Path):
+    with open(output_root.joinpath(MANIFEST_FILE_NAME), "r") as fd:
+        return json.load(fd)
+
+
+def _same_contents(a: Path, b: Path):
+    if a.stat().st_size != b.stat().st_size:
+        return False
+
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        for chunk in iter(lambda: fa.read(1024 * 1024), b""):
+            if chunk != fb.read(len(chunk)):
+                return False
+    return True
+
+
+def _merge_file(root: Path, relpath: str, output_root: Path, owners: dict[str, Path]) -> bool:
+    """Copies one output file of a shard, returns False if it conflicts with another shard's"""
+    src = root.joinpath(relpath)
+    dst = output_root.joinpath(relpath)
+
+    if relpath in owners:
+        if _same_contents(src, dst):
+            return True
+
+        if not relpath.startswith(ProtobufProcessor.output_dir + "/"):
+            print(f'ERROR: "{relpath}" differs between "{owners[relpath]}" and "{root}"')
+            return False
+
+        # Found in files of several shards, the same version as in a single run wins
+        if descriptor_rank(src.read_bytes()) <= descriptor_rank(dst.read_bytes()):
+            return True
+
+    owners[relpath] = root
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(src, dst)
+    return True
+
+
+def merge(shard_roots: list[Path], output_path: Path) -> bool:
+    """Combines the output roots of a sharded run into one tree, like a single run would produce"""
+    from dataminer.build import Runner
+
+    output_root = output_path.absolute()
+
+    manifests = [load_manifest(root) for root in shard_roots]
+
+    counts = {tuple(m["shard"])[1] for m in manifests if m["shard"] is not None}
+    indices = sorted(m["shard"][0] for m in manifests if m["shard"] is not None)
+    if len(counts) > 1:
+        print(f"ERROR: shards come from runs with different shard counts: {sorted(counts)}")
+        return False
+    ok = True
+    if counts and indices != list(range(counts.pop())):
+        print(f"ERROR: incomplete set of shards, got {indices}")
+        ok = False
+
+    output_root.mkdir(parents=True, exist_ok=True)
+
+    # Relative path of every output file -> shard root it was taken from
+    owners: dict[str, Path] = {}
+    all_outputs = set()
+
+    for root, manifest in zip(shard_roots, manifests):
+        for relpath in manifest["outputs"]:
+            src = root.joinpath(relpath)
+
+            if not src.exists():
+                print(f'ERROR: "{src}" is in the manifest, but doesn\'t exist')
+                ok = False
+                continue
+            all_outputs.add(relpath)
+
+            # Directory outputs are merged file by file
+            if src.is_dir():
+                files = sorted(
+                    path.relative_to(root).as_posix() for path in src.rglob("*") if path.is_file()
+                )
+            else:
+                files = [relpath]
+
+            for file_relpath in files:
+                if not _merge_file(root, file_relpath, output_root, owners):
+                    ok = False
+
+    history = TimingHistory(output_root.joinpath(TimingHistory.FILE_NAME))
+    report = {"failures": [], "corrupt_files": []}
+
+    with open(output_root.joinpath(Journal.FILE_NAME), "w") as journal:
+        for root in shard_roots:
+            shard_history = TimingHistory(root.joinpath(TimingHistory.FILE_NAME))
+            for proc_name, files in shard_history.entries.items():
+                history.entries.setdefault(proc_name, {}).update(files)
+
+            journal_path = root.joinpath(Journal.FILE_NAME)
+            if journal_path.exists():
+                with open(journal_path, "r") as fd:
+                    shutil.copyfileobj(fd, journal)
+
+            report_path = root.joinpath(Runner.REPORT_FILE_NAME)
+            if report_path.exists():
+                with open(report_path, "r") as fd:
+                    shard_report = json.load(fd)
+                for key in report:
+                    report[key] += shard_report.get(key, [])
+
+    history.save()
+
+    with open(output_root.joinpath(Runner.REPORT_FILE_NAME), "w") as fd:
+        json.dump(report, fd, indent=2)
+
+    write_manifest(output_root, None, all_outputs)
+
+    print(f"Merged {len(all_outputs)} outputs from {len(shard_roots)} shards")
+
+    return ok
@@ -0,0 +1,262 @@
+"""
+Minimal Mach-O (including universal binaries) and ELF symbol table reader,
+producing the same symbol names as `llvm-nm --just-symbol-name`
+"""
+
+import struct
+
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+MH_CIGAM = 0xCEFAEDFE
+MH_CIGAM_64 = 0xCFFAEDFE
+
+LC_SYMTAB = 0x2
+N_STAB = 0xE0
+
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+SHT_GNU_VERDEF = 0x6FFFFFFD
+SHT_GNU_VERNEED = 0x6FFFFFFE
+SHT_GNU_VERSYM = 0x6FFFFFFF
+SHN_UNDEF = 0
+VER_NDX_GLOBAL = 1
+VERSYM_HIDDEN = 0x8000
+STT_SECTION = 3
+STT_FILE = 4
+EM_ARM = 40
+EM_AARCH64 = 183
+
+ARM_MAPPING_SYMBOLS = (b"$a", b"$d", b"$t", b"$x")
+ARM_MAPPING_PREFIXES = (b"$a.", b"$d.", b"$t.", b"$x.")
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_NAMES = {
+    7: "i386",
+    7 | CPU_ARCH_ABI64: "x86_64",
+    12: "arm",
+    12 | CPU_ARCH_ABI64: "arm64",
+    18: "ppc",
+    18 | CPU_ARCH_ABI64: "ppc64",
+}
+
+
+class SymbolReaderError(Exception):
+    pass
+
+
+def _cstring(data, offset: int) -> bytes:
+    end = data.find(b"\0", offset)
+    if end < 0:
+        raise SymbolReaderError("Unterminated string")
+    return bytes(data[offset:end])
+
+
+def _table(data, offset: int, size: int):
+    # Slices past the end would silently come out shorter
+    if offset + size > len(data):
+        raise SymbolReaderError("Truncated file, table past the end")
+    return memoryview(data)[offset : offset + size]
+
+
+def macho_symbols(data, base: int = 0):
+    """Yields symbol names of a thin Mach-O image starting at base, in symbol table order"""
+    (magic,) = struct.unpack_from("<I", data, base)
+
+    if magic in (MH_MAGIC, MH_MAGIC_64):
+        endian = "<"
+    elif magic in (MH_CIGAM, MH_CIGAM_64):
+        endian = ">"
+    else:
+        raise SymbolReaderError("Not a Mach-O file")
+
+    is_64 = magic in (MH_MAGIC_64, MH_CIGAM_64)
+    _, _, _, _, ncmds, _, _ = struct.unpack_from(endian + "7I", data, base)
+
+    offset = base + (32 if is_64 else 28)
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from(endian + "2I", data, offset)
+
+        if cmd == LC_SYMTAB:
+            symoff, nsyms, stroff, strsize = struct.unpack_from(endian + "4I", data, offset + 8)
+
+            nlist = struct.Struct(endian + ("IBBHQ" if is_64 else "IBBHI"))
+            strtab = bytes(_table(data, base + stroff, strsize))
+
+            for n_strx, n_type, _, _, _ in nlist.iter_unpack(
+                _table(data, base + symoff, nsyms * nlist.size)
+            ):
+                # Debugger symbols are only shown with nm -a
+                if n_type & N_STAB:
+                    continue
+                yield _cstring(strtab, n_strx)
+
+        offset += cmdsize
+
+
+def fat_archs(data):
+    """Returns [(arch name, offset)] for a universal binary"""
+    (magic, nfat_arch) = struct.unpack_from(">2I", data, 0)
+
+    if magic == FAT_MAGIC:
+        arch = struct.Struct(">iiIII")
+    else:
+        arch = struct.Struct(">iiQQI4x")
+
+    archs = []
+    for i in range(nfat_arch):
+        cputype, _, offset, _, _ = arch.unpack_from(data, 8 + i * arch.size)
+        archs.append((CPU_NAMES.get(cputype, f"cputype {cputype}"), offset))
+    return archs
+
+
+def _elf_versions(data, sections, endian: str):
+    """
+    Returns ({version index: (name, defined here)}, [version index of every dynamic symbol])
+    from .gnu.version_d, .gnu.version_r and .gnu.version
+    """
+    names = {}
+    versym = []
+
+    for section in sections:
+        sh_type, sh_offset, sh_size, sh_link, sh_info = (
+            section[1], section[4], section[5], section[6], section[7]
+        )
+        if sh_type not in (SHT_GNU_VERDEF, SHT_GNU_VERNEED, SHT_GNU_VERSYM):
+            continue
+
+        if sh_type == SHT_GNU_VERSYM:
+            versym = [v for (v,) in struct.iter_unpack(
+                endian + "H", _table(data, sh_offset, sh_size - sh_size % 2)
+            )]
+            continue
+
+        str_section = sections[sh_link]
+        strtab = bytes(_table(data, str_section[4], str_section[5]))
+
+        # sh_info is the number of entries, each one links to the next
+        offset = sh_offset
+        for _ in range(sh_info):
+            if sh_type == SHT_GNU_VERDEF:
+                _, _, vd_ndx, vd_cnt, _, vd_aux, vd_next = struct.unpack_from(endian + "4H3I", data, offset)
+                # The first aux entry is the name of the version itself, the others its parents
+                if vd_cnt:
+                    (vda_name,) = struct.unpack_from(endian + "I", data, offset + vd_aux)
+                    names[vd_ndx] = (_cstring(strtab, vda_name), True)
+                next_offset = vd_next
+            else:
+                _, vn_cnt, _, vn_aux, vn_next = struct.unpack_from(endian + "2H3I", data, offset)
+                aux_offset = offset + vn_aux
+                for _ in range(vn_cnt):
+                    _, _, vna_other, vna_name, vna_next = struct.unpack_from(endian + "IHHII", data, aux_offset)
+                    names[vna_other] = (_cstring(strtab, vna_name), False)
+                    if vna_next == 0:
+                        break
+                    aux_offset += vna_next
+                next_offset = vn_next
+
+            if next_offset == 0:
+                break
+            offset += next_offset
+
+    return names, versym
+
+
+def elf_symbols(data, dynamic=False):
+    """
+    Yields symbol names from .symtab (or .dynsym if dynamic), in symbol table order.
+    Dynamic symbols get their version appended like nm -D does, name@@VERSION for the default
+    version of a symbol defined here, name@VERSION otherwise
+    """
+    ei_class, ei_data = data[4], data[5]
+    if ei_class not in (1, 2) or ei_data not in (1, 2):
+        raise SymbolReaderError("Unsupported ELF class or data encoding")
+
+    is_64 = ei_class == 2
+    endian = "<" if ei_data == 1 else ">"
+
+    (e_machine,) = struct.unpack_from(endian + "H", data, 18)
+    if is_64:
+        (e_shoff,) = struct.unpack_from(endian + "Q", data, 0x28)
+        e_shentsize, e_shnum = struct.unpack_from(endian + "2H", data, 0x3A)
+        shdr = struct.Struct(endian + "IIQQQQIIQQ")
+        sym = struct.Struct(endian + "IBBHQQ")
+    else:
+        (e_shoff,) = struct.unpack_from(endian + "I", data, 0x20)
+        e_shentsize, e_shnum = struct.unpack_from(endian + "2H", data, 0x2E)
+        shdr = struct.Struct(endian + "IIIIIIIIII")
+        sym = struct.Struct(endian + "IIIBBH")
+
+    sections = [
+        shdr.unpack_from(data, e_shoff + i * e_shentsize) for i in range(e_shnum)
+    ]
+
+    wanted = SHT_DYNSYM if dynamic else SHT_SYMTAB
+    is_arm = e_machine in (EM_ARM, EM_AARCH64)
+
+    version_names, versym = _elf_versions(data, sections, endian) if dynamic else ({}, [])
+
+    for section in sections:
+        if section[1] != wanted:
+            continue
+
+        sh_offset, sh_size, sh_link = section[4], section[5], section[6]
+        str_section = sections[sh_link]
+        strtab = bytes(_table(data, str_section[4], str_section[5]))
+
+        symbols = sym.iter_unpack(_table(data, sh_offset, sh_size - sh_size % sym.size))
+        # First entry is the null symbol
+        next(symbols, None)
+
+        for index, entry in enumerate(symbols, 1):
+            if is_64:
+                st_name, st_info, st_shndx = entry[0], entry[1], entry[3]
+            else:
+                st_name, st_info, st_shndx = entry[0], entry[3], entry[5]
+
+            if st_info & 0xF in (STT_SECTION, STT_FILE):
+                continue
+
+            name = _cstring(strtab, st_name)
+
+            # ARM mapping symbols ($a, $d, $t, $x)
+            if is_arm and (name in ARM_MAPPING_SYMBOLS or name[:3] in ARM_MAPPING_PREFIXES):
+                continue
+
+            if index < len(versym):
+                version_index = versym[index] & ~VERSYM_HIDDEN
+                # Local and global are the unversioned ones
+                if version_index > VER_NDX_GLOBAL:
+                    if version_index not in version_names:
+                        raise SymbolReaderError(f"Unknown symbol version index {version_index}")
+                    version, defined = version_names[version_index]
+                    is_default = (
+                        defined and st_shndx != SHN_UNDEF and not versym[index] & VERSYM_HIDDEN
+                    )
+                    name += (b"@@" if is_default else b"@") + version
+
+            yield name
+
+
+def is_universal(data) -> bool:
+    return len(data) >= 4 and struct.unpack_from(">I", data, 0)[0] in (FAT_MAGIC, FAT_MAGIC_64)
+
+
+def symbol_names(data, path: str, dynamic=False):
+    """
+    Yields output lines (without newlines), in nm order: sorted by name, and for universal
+    binaries grouped per architecture with the same headers nm prints
+    """
+    (magic,) = struct.unpack_from(">I", data, 0)
+
+    if bytes(data[:4]) == b"\x7fELF":
+        yield from sorted(elf_symbols(data, dynamic))
+    elif magic in (FAT_MAGIC, FAT_MAGIC_64):
+        for arch, offset in fat_archs(data):
+            yield b""
+            yield f"{path} (for architecture {arch}):".encode("utf8")
+            yield from sorted(macho_symbols(data, offset))
+    else:
+        yield from sorted(macho_symbols(data))
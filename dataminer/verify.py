@@ -0,0 +1,283 @@
+from dataminer import vpk
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from pathlib import Path
+from zlib import crc32
+import json
+import os
+import time
+
+# Large reads keep the time spent outside of crc32/md5 (which release the GIL) low
+VERIFY_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class VerifyResult:
+    def __init__(self, vpk_path):
+        self.vpk_path = vpk_path
+        self.checked = 0
+        self.bytes = 0
+        self.failed: list[str] = []
+        self.checksums_ok = True
+        self.duration = 0.0
+        # Only for fast verification, (checked, total) chunks
+        self.chunks = None
+        self.failed_chunks = []
+        self.chunk_hashes = []
+
+    @property
+    def ok(self):
+        return self.checksums_ok and not self.failed and not self.failed_chunks
+
+    @property
+    def throughput(self):
+        """Throughput in GB/s"""
+        if self.duration <= 0:
+            return 0.0
+        return self.bytes / self.duration / 1e9
+
+
+def hash_range(fd, offset: int, length: int, checksum=0, buf=None):
+    """CRC32 of `length` bytes at `offset` of an open file, using pread into a reusable buffer"""
+    if buf is None:
+        buf = bytearray(min(length, VERIFY_CHUNK_SIZE))
+    view = memoryview(buf)
+
+    while length > 0:
+        n = os.preadv(fd, [view[: min(length, len(view))]], offset)
+        if n == 0:
+            raise EOFError("Unexpected end of archive")
+        checksum = crc32(view[:n], checksum)
+        offset += n
+        length -= n
+
+    return checksum
+
+
+def md5_range(fd, offset: int, length: int, buf) -> bytes:
+    digest = md5()
+    view = memoryview(buf)
+
+    while length > 0:
+        n = os.preadv(fd, [view[: min(length, len(view))]], offset)
+        if n == 0:
+            raise EOFError("Unexpected end of archive")
+        digest.update(view[:n])
+        offset += n
+        length -= n
+
+    return digest.digest()
+
+
+def verify_chunks(archive_path: str, chunks):
+    """Checks the MD5 of chunk hash entries living in one archive, returns the bad ones"""
+    failed = []
+    buf = bytearray(VERIFY_CHUNK_SIZE)
+
+    fd = os.open(archive_path, os.O_RDONLY)
+    try:
+        for chunk in sorted(chunks):
+            _, offset, length, expected = chunk
+            try:
+                ok = md5_range(fd, offset, length, buf) == expected
+            except EOFError:
+                ok = False
+            if not ok:
+                failed.append(chunk)
+    finally:
+        os.close(fd)
+
+    return failed
+
+
+def verify_archive(archive_path: str, entries):
+    """Verify entries (path, metadata) living in one archive, in offset order"""
+    failed = []
+    total = 0
+    buf = bytearray(VERIFY_CHUNK_SIZE)
+
+    entries = sorted(entries, key=lambda e: e[1][4])
+
+    fd = os.open(archive_path, os.O_RDONLY)
+    try:
+        for path, (preload, crc, _, _, archive_offset, file_length) in entries:
+            checksum = crc32(preload)
+            if file_length > 0:
+                checksum = hash_range(fd, archive_offset, file_length, checksum, buf)
+            total += len(preload) + file_length
+
+            if checksum & 0xFFFFFFFF != crc:
+                failed.append(path)
+    finally:
+        os.close(fd)
+
+    return total, failed
+
+
+def verify_vpk(vpk_path: str, threads=None, known_chunks=None) -> VerifyResult:
+    """
+    With known_chunks (chunk hashes of a previously verified version of this vpk), only chunks
+    whose hash changed since then are read, together with the entries overlapping them
+    """
+    result = VerifyResult(vpk_path)
+    start_time = time.time()
+
+    pak = vpk.open(vpk_path)
+
+    chunks = []
+    fast = known_chunks is not None and bool(pak.chunk_hashes)
+    if fast:
+        chunks = vpk.changed_chunks(known_chunks, pak.chunk_hashes)
+        entries = list(pak.entries_in_chunks(chunks))
+        # Not covered by chunk hashes, but small
+        entries += [(path, metadata) for path, metadata in pak.read_index_iter() if metadata[3] == 0x7FFF]
+    else:
+        entries = pak.read_index_iter()
+
+    archives = {}
+    for path, metadata in entries:
+        archive_index = metadata[3]
+        archives.setdefault(archive_index, []).append((path, metadata))
+
+    chunk_archives = {}
+    for chunk in chunks:
+        chunk_archives.setdefault(chunk[0], []).append(chunk)
+
+    with ThreadPoolExecutor(threads) as pool:
+        checksums = None
+        if pak.version == 2:
+            checksums = pool.submit(pak.verify)
+
+        jobs = []
+        for archive_index, archive_entries in archives.items():
+            archive_path = pak._make_vpkfile_path({"archive_index": archive_index})
+            jobs.append(pool.submit(verify_archive, archive_path, archive_entries))
+
+        chunk_jobs = []
+        if fast:
+            for archive_index, archive_chunks in chunk_archives.items():
+                archive_path = pak._make_vpkfile_path({"archive_index": archive_index})
+                chunk_jobs.append(pool.submit(verify_chunks, archive_path, archive_chunks))
+
+        for job in jobs:
+            total, failed = job.result()
+            result.bytes += total
+            result.failed += failed
+
+        for job in chunk_jobs:
+            result.failed_chunks += job.result()
+        result.bytes += sum(chunk[2] for chunk in chunks)
+
+        if checksums is not None:
+            result.checksums_ok = checksums.result()
+            result.bytes += os.path.getsize(vpk_path)
+
+    if fast:
+        result.chunks = (len(chunks), len(pak.chunk_hashes))
+    result.chunk_hashes = pak.chunk_hashes
+    result.checked = sum(len(e) for e in archives.values())
+    result.duration = time.time() - start_time
+
+    return result
+
+
+def find_vpks(paths: list[Path]):
+    for path in paths:
+        if path.is_dir():
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith("_dir.vpk"):
+                        yield Path(root).joinpath(name)
+        else:
+            yield path
+
+
+def load_state(path: Path) -> dict:
+    """Chunk hashes of the last successful verification, per vpk"""
+    if not path.exists():
+        return {}
+
+    try:
+        with open(path, "r") as fd:
+            state = json.load(fd)
+    except (OSError, ValueError) as e:
+        print(f'Couldn\'t load verify state "{path}":', e)
+        return {}
+
+    return {
+        vpk_path: [(a, o, l, bytes.fromhex(h)) for a, o, l, h in chunks]
+        for vpk_path, chunks in state.items()
+    }
+
+
+def save_state(path: Path, state: dict):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as fd:
+        json.dump(
+            {
+                vpk_path: [[a, o, l, h.hex()] for a, o, l, h in chunks]
+                for vpk_path, chunks in state.items()
+            },
+            fd,
+        )
+    os.replace(tmp_path, path)
+
+
+def verify_paths(paths: list[Path], threads=None, state_path: Path = None) -> bool:
+    """
+    With a state file, vpks that were verified before only get the chunks
+    checked whose hash changed since then
+    """
+    all_ok = True
+    total_bytes = 0
+    start_time = time.time()
+
+    state = None
+    if state_path is not None:
+        state = load_state(state_path)
+
+    for path in find_vpks(paths):
+        key = path.absolute().as_posix()
+        known_chunks = state.get(key) if state is not None else None
+
+        try:
+            result = verify_vpk(path.as_posix(), threads, known_chunks)
+        except Exception as e:
+            print(f'ERROR: Couldn\'t verify vpk "{path}":', e)
+            all_ok = False
+            continue
+
+        total_bytes += result.bytes
+
+        status = "OK" if result.ok else "FAILED"
+        chunks = ""
+        if result.chunks is not None:
+            chunks = f", {result.chunks[0]}/{result.chunks[1]} chunks changed"
+        print(
+            f"{path}: {status}, {result.checked} entries{chunks}, "
+            f"{result.bytes / 1e9:.2f} GB in {result.duration:.2f}s ({result.throughput:.2f} GB/s)"
+        )
+
+        if not result.checksums_ok:
+            print("  directory checksum mismatch")
+        for failed in result.failed:
+            print(f"  CRC mismatch: {failed}")
+        for archive_index, offset, length, _ in result.failed_chunks:
+            print(f"  chunk MD5 mismatch: archive {archive_index:03d} at {offset} ({length} bytes)")
+
+        if state is not None:
+            if result.ok and result.chunk_hashes:
+                state[key] = result.chunk_hashes
+            else:
+                state.pop(key, None)
+
+        all_ok = all_ok and result.ok
+
+    if state is not None:
+        save_state(state_path, state)
+
+    duration = time.time() - start_time
+    if duration > 0:
+        print(f"TOTAL: {total_bytes / 1e9:.2f} GB in {duration:.2f}s ({total_bytes / duration / 1e9:.2f} GB/s)")
+
+    return all_ok
@@ -19,9 +19,11 @@
 # SOFTWARE.
 
 import struct
-from binascii import crc32
+from bisect import bisect_left
+from zlib import crc32
 from hashlib import md5
 from io import open as fopen
+import io
 import os
 import sys
 
@@ -43,7 +45,56 @@ def new(*args, **kwargs):
     return NewVPK(*args, **kwargs)
 
 
+_chunk_hash = struct.Struct("<3I16s")
+
+
+def changed_chunks(old_hashes, new_hashes):
+    """
+    Chunks of new_hashes that aren't in old_hashes with the same MD5,
+    both are VPK.chunk_hashes style lists
+    """
+    old = set(old_hashes)
+    return [chunk for chunk in new_hashes if chunk not in old]
+
+
+class _ChunkHasher(object):
+    """
+    Splits an archive into fixed size chunks and MD5s each of them, for the v2 chunk hashes section
+    """
+    def __init__(self, archive_index, chunk_size):
+        self.archive_index = archive_index
+        self.chunk_size = chunk_size
+        self.hashes = []
+
+        self._offset = 0
+        self._length = 0
+        self._md5 = md5()
+
+    def update(self, data):
+        data = memoryview(data)
+
+        while data:
+            n = min(len(data), self.chunk_size - self._length)
+            self._md5.update(data[:n])
+            self._length += n
+            data = data[n:]
+
+            if self._length == self.chunk_size:
+                self.finish()
+
+    def finish(self):
+        if self._length:
+            self.hashes.append((self.archive_index, self._offset, self._length, self._md5.digest()))
+
+        self._offset += self._length
+        self._length = 0
+        self._md5 = md5()
+
+
 class NewVPK(object):
+    chunk_hash_size = 1024 * 1024
+    copy_buffer_size = 4 * 1024 * 1024
+
     def __init__(self, path, path_enc='utf-8'):
         self.path_enc = path_enc
 
@@ -52,7 +103,8 @@ class NewVPK(object):
         self.tree_length = 0
         self.header_length = 4*3
 
-        self.tree = {}
+        # (ext, relpath, filename, size), sorted in tree order
+        self.entries = []
         self.path = ''
         self.file_count = 0
 
@@ -65,8 +117,7 @@ class NewVPK(object):
         """
         Reads the given path into the tree
         """
-        self.tree = {}
-        self.file_count = 0
+        self.entries = []
         self.path = path
 
         for root, _, filelist in os.walk(path, topdown=True):
@@ -75,186 +126,249 @@ class NewVPK(object):
             # empty rel, means file is in root dir
             if not rel:
                 rel = ' '
+            rel = '/'.join(rel.split(os.path.sep))
 
             for filename in filelist:
-                filename = filename.split('.')
-                if len(filename) <= 1:
+                parts = filename.split('.')
+                if len(parts) <= 1:
                     raise RuntimeError("Files without an extension are not supported: {0}".format(
-                                       repr(os.path.join(root, '.'.join(filename))),
+                                       repr(os.path.join(root, filename)),
                                        ))
 
-                ext = filename[-1]
-                filename = '.'.join(filename[:-1])
+                ext = parts[-1]
+                name = '.'.join(parts[:-1])
 
-                if ext not in self.tree:
-                    self.tree[ext] = {}
-                if rel not in self.tree[ext]:
-                    self.tree[ext][rel] = []
-
-                self.tree[ext][rel].append(filename)
-                self.file_count += 1
+                size = os.stat(os.path.join(root, filename)).st_size
+                self.entries.append((ext, rel, name, size))
 
+        self.entries.sort()
+        self.file_count = len(self.entries)
         self.tree_length = self.calculate_tree_length()
 
+    def _source_path(self, entry):
+        ext, relpath, filename, _ = entry
+        return os.path.join(self.path, '' if relpath == ' ' else relpath, filename + '.' + ext)
 
     def calculate_tree_length(self):
         """
         Walks the tree and calculate the tree length
         """
         tree_length = 0
+        last_ext = last_relpath = None
 
-        for ext in self.tree:
-            tree_length += len(ext) + 2
-
-            for relpath in self.tree[ext]:
-                tree_length += len(relpath) + 2
+        for ext, relpath, filename, _ in self.entries:
+            if ext != last_ext:
+                tree_length += len(ext.encode(self.path_enc)) + 2
+                last_ext, last_relpath = ext, None
+            if relpath != last_relpath:
+                tree_length += len(relpath.encode(self.path_enc)) + 2
+                last_relpath = relpath
 
-                for filename in self.tree[ext][relpath]:
-                    tree_length += len(filename) + 1 + 18
+            tree_length += len(filename.encode(self.path_enc)) + 1 + 18
 
         return tree_length + 1
 
-
-    def save(self, vpk_output_path):
+    def build_tree(self, locations, checksums):
         """
-        Saves the VPK at the given path
+        Builds the file tree in memory, from (archive_index, archive_offset) and crc32 for each entry
         """
-        with fopen(vpk_output_path, 'w+b') as f:
-            # write VPK1 header
-            f.write(struct.pack("3I", self.signature,
-                                      self.version,
-                                      self.tree_length,
-                                      ))
-            # write VPK2 header
-            if self.version == 2:
-                f.write(struct.pack("4I", 0, # embed_chunk_length (corrected later)
-                                          0, # chunk_hashes_length
-                                          48, # self_hashes_length
+        tree = bytearray()
+        last_ext = last_relpath = None
+
+        for entry, (archive_index, archive_offset), checksum in zip(self.entries, locations, checksums):
+            ext, relpath, filename, size = entry
+
+            if ext != last_ext:
+                if last_ext is not None:
+                    tree += b"\x00\x00"
+                tree += ext.encode(self.path_enc) + b"\x00"
+                last_ext, last_relpath = ext, None
+            if relpath != last_relpath:
+                if last_relpath is not None:
+                    tree += b"\x00"
+                tree += relpath.encode(self.path_enc) + b"\x00"
+                last_relpath = relpath
+
+            tree += filename.encode(self.path_enc) + b"\x00"
+
+            # crc32, preload_length, archive_index, archive_offset, file_length, suffix
+            tree += struct.pack("IHHIIH", checksum & 0xFFffFFff,
                                           0,
-                                          ))
+                                          archive_index,
+                                          archive_offset,
+                                          size,
+                                          0xffff,
+                                          )
 
-            self.header_length = f.tell()
+        if last_ext is not None:
+            tree += b"\x00\x00"
+        # end of file tree
+        tree += b"\x00"
 
-            data_offset = self.header_length + self.tree_length
+        assert len(tree) == self.tree_length, "Tree length mismatch"
 
-            embed_chunk_length = 0
+        return bytes(tree)
 
-            # write file tree
-            for ext in self.tree:
-                f.write(ext.encode(self.path_enc) + b"\x00")
+    def _copy_entry(self, entry, output, buf, *hashers):
+        """
+        Appends a file to output, feeding the data to hashers. Returns crc32
+        """
+        view = memoryview(buf)
+        checksum = 0
+        copied = 0
 
-                for relpath in self.tree[ext]:
-                    norm_relpath = '/'.join(relpath.split(os.path.sep))
-                    f.write(norm_relpath.encode(self.path_enc) + b"\x00")
+        with fopen(self._source_path(entry), 'rb', buffering=0) as pakfile:
+            while True:
+                n = pakfile.readinto(buf)
+                if not n:
+                    break
 
-                    for filename in self.tree[ext][relpath]:
-                        f.write(filename.encode(self.path_enc) + b'\x00')
+                chunk = view[:n]
+                checksum = crc32(chunk, checksum)
+                for h in hashers:
+                    h.update(chunk)
+                output.write(chunk)
+                copied += n
+
+        # the tree was laid out with the size from read_dir()
+        if copied != entry[3]:
+            raise RuntimeError("File changed while saving: {0}".format(repr(self._source_path(entry))))
+
+        return checksum
+
+    def save(self, vpk_output_path, max_archive_size=None):
+        """
+        Saves the VPK at the given path
 
-                        # append file data
-                        metadata_offset = f.tell()
-                        file_offset = data_offset
-                        real_filename = filename if not ext else (filename + '.' + ext)
-                        checksum = 0
-                        f.seek(data_offset)
+        If max_archive_size is given, file data is split into _NNN.vpk archives next to the
+        _dir.vpk, each of them at most max_archive_size bytes (unless a single file is bigger)
+        """
+        if max_archive_size is not None:
+            return self._save_archives(vpk_output_path, max_archive_size)
+
+        return self._save_embedded(vpk_output_path)
+
+    def _header(self, embed_chunk_length, chunk_hashes_length):
+        header = struct.pack("3I", self.signature, self.version, self.tree_length)
+        if self.version == 2:
+            header += struct.pack("4I", embed_chunk_length,
+                                        chunk_hashes_length,
+                                        48, # self_hashes_length
+                                        0,
+                                        )
+        self.header_length = len(header)
+        return header
+
+    def _write_dir_tail(self, f, tree, file_checksum, chunk_hashes):
+        """
+        Writes chunk hashes and self hashes. file_checksum has to be fed everything written before
+        """
+        tree_checksum = md5(tree)
+        chunk_hashes_checksum = md5(chunk_hashes)
+
+        file_checksum.update(chunk_hashes)
+        file_checksum.update(tree_checksum.digest())
+        file_checksum.update(chunk_hashes_checksum.digest())
+
+        f.write(chunk_hashes)
+        if self.version == 2:
+            f.write(tree_checksum.digest())
+            f.write(chunk_hashes_checksum.digest())
+            f.write(file_checksum.digest())
+
+    def _save_embedded(self, vpk_output_path):
+        # Data is copied after room for the tree, crc32s are computed on the way and the tree
+        # is written afterwards. The file md5 covers the tree before the data, so the written
+        # data is read back once for it, the source files are only read once
+        locations = []
+        offset = 0
+        for entry in self.entries:
+            locations.append((0x7fff, offset))
+            offset += entry[3]
+
+        header = self._header(offset, 0)
+        buf = bytearray(self.copy_buffer_size)
+        view = memoryview(buf)
 
-                        with fopen(os.path.join(self.path,
-                                                '' if relpath == ' ' else relpath,
-                                                real_filename
-                                                ),
-                                   'rb') as pakfile:
-                            for chunk in iter(lambda: pakfile.read(8192), b''):
-                                checksum = crc32(chunk, checksum)
-                                f.write(chunk)
+        with fopen(vpk_output_path, 'w+b') as f:
+            f.write(header)
+            f.seek(len(header) + self.tree_length)
 
-                        data_offset = f.tell()
-                        file_length = f.tell() - file_offset
-                        f.seek(metadata_offset)
+            checksums = [self._copy_entry(entry, f, buf) for entry in self.entries]
 
-                        embed_chunk_length += file_length
-                        # metadata
+            tree = self.build_tree(locations, checksums)
+            f.seek(len(header))
+            f.write(tree)
 
-                        # crc32
-                        # preload_length
-                        # archive_index
-                        # archive_offset
-                        # file_length
-                        # suffix
-                        f.write(struct.pack("IHHIIH", checksum & 0xFFffFFff,
-                                                      0,
-                                                      0x7fff,
-                                                      file_offset - self.tree_length - self.header_length,
-                                                      file_length,
-                                                      0xffff
-                                                      ))
+            file_checksum = md5(header)
+            file_checksum.update(tree)
+            for n in iter(lambda: f.readinto(buf), 0):
+                file_checksum.update(view[:n])
 
+            self._write_dir_tail(f, tree, file_checksum, b'')
 
-                    # next relpath
-                    f.write(b"\x00")
-                # next ext
-                f.write(b"\x00")
-            # end of file tree
-            f.write(b"\x00")
+    def _save_archives(self, vpk_output_path, max_archive_size):
+        if not vpk_output_path.endswith('_dir.vpk'):
+            raise ValueError("Output path has to end with _dir.vpk when splitting into archives")
 
-            if self.version == 2:
-                f.seek(4*3) # jump back to write embed_chunk_length
-                f.write(struct.pack("1I", embed_chunk_length))
+        archive_base = vpk_output_path[:-len('dir.vpk')]
 
-                # calculate and write checksums
-                tree_checksum = md5()
-                chunk_hashes_checksum = md5()
-                file_checksum = md5()
+        locations = []
+        checksums = []
+        chunk_hashes = []
+        buf = bytearray(self.copy_buffer_size)
 
-                def chunk_reader(length, chunk_size=2**14):
-                    limit = f.tell() + length
+        archive_index = -1
+        archive = None
+        hasher = None
+        offset = 0
 
-                    while f.tell() < limit:
-                        yield f.read(min(chunk_size, limit - f.tell()))
+        try:
+            for entry in self.entries:
+                size = entry[3]
+                if archive is None or (offset > 0 and offset + size > max_archive_size):
+                    if archive is not None:
+                        archive.close()
+                        hasher.finish()
+                        chunk_hashes += hasher.hashes
 
-                f.seek(0) # jump to start
-                file_checksum.update(f.read(self.header_length))
+                    archive_index += 1
+                    archive = fopen("%s%03d.vpk" % (archive_base, archive_index), 'wb')
+                    hasher = _ChunkHasher(archive_index, self.chunk_hash_size)
+                    offset = 0
 
-                for chunk in chunk_reader(self.tree_length):
-                    file_checksum.update(chunk)
-                    tree_checksum.update(chunk)
+                locations.append((archive_index, offset))
+                checksums.append(self._copy_entry(entry, archive, buf, hasher))
+                offset += size
+        finally:
+            if archive is not None:
+                archive.close()
 
-                for chunk in chunk_reader(embed_chunk_length):
-                    file_checksum.update(chunk)
+        if hasher is not None:
+            hasher.finish()
+            chunk_hashes += hasher.hashes
 
-                # not supported (chunk_hashes_length == 0)
-                #for chunk in chunk_reader(self.chunk_hashes_length):
-                #    file_checksum.update(chunk)
-                #    chunk_hashes_checksum.update(chunk)
+        tree = self.build_tree(locations, checksums)
 
-                file_checksum.update(tree_checksum.digest())
-                file_checksum.update(chunk_hashes_checksum.digest())
+        chunk_hashes_data = b''
+        if self.version == 2:
+            chunk_hashes_data = b''.join(_chunk_hash.pack(*h) for h in chunk_hashes)
+        header = self._header(0, len(chunk_hashes_data))
 
-                f.write(tree_checksum.digest())
-                f.write(chunk_hashes_checksum.digest())
-                f.write(file_checksum.digest())
+        with fopen(vpk_output_path, 'wb') as f:
+            f.write(header)
+            f.write(tree)
 
+            self._write_dir_tail(f, tree, md5(header + tree), chunk_hashes_data)
 
-    def save_and_open(self, path):
+    def save_and_open(self, path, max_archive_size=None):
         """
         Saves the VPK file and returns VPK instance of it
         """
-        self.save(path)
+        self.save(path, max_archive_size)
         return VPK(path)
 
 
-def _read_cstring(f, encoding='utf-8'):
-    buf = b''
-
-    for chunk in iter(lambda: f.read(64), b''):
-        pos = chunk.find(b'\x00')
-        if pos > -1:
-            buf += chunk[:pos]
-            f.seek(f.tell() - (len(chunk) - (pos + 1)))
-            break
-
-        buf += chunk
-
-    return buf.decode(encoding) if encoding else buf
-
 class VPK(object):
     """
     Wrapper for reading Valve's Pak files
@@ -271,6 +385,8 @@ class VPK(object):
         # header
         self.tree = None
         self.vpk_path = vpk_path
+        # v2 only, [(archive_index, offset, length, md5 digest)]
+        self.chunk_hashes = []
 
         self.read_header()
 
@@ -399,7 +515,8 @@ class VPK(object):
                  ) = struct.unpack("4I", f.read(4*4))
                 self.header_length += 4*7
 
-                f.seek(self.tree_length + self.embed_chunk_length + self.chunk_hashes_length, 1)
+                f.seek(self.tree_length + self.embed_chunk_length, 1)
+                self.chunk_hashes = list(_chunk_hash.iter_unpack(f.read(self.chunk_hashes_length)))
 
                 assert self.self_hashes_length == 48, "Self hashes section size mismatch"
 
@@ -423,7 +540,7 @@ class VPK(object):
         chunk_hashes_checksum = md5()
         file_checksum = md5()
 
-        def chunk_reader(length, chunk_size=2**14):
+        def chunk_reader(length, chunk_size=2**22):
             limit = f.tell() + length
 
             while f.tell() < limit:
@@ -471,39 +588,74 @@ class VPK(object):
         for path, metadata in self.read_index_iter():
             self.tree[path] = metadata
 
-    def read_index_iter(self):
+    def read_index_iter(self, ext_filter=None, dir_filter=None, path_filter=None):
         """Generator function that reads the file index from the vpk file
 
         yeilds (file_path, metadata)
+
+        ext_filter(ext), dir_filter(ext, dir_path) and path_filter(file_path) can
+        return False to skip entries. Skipped extension and directory sections are
+        stepped over without decoding or unpacking any of their entries
         """
         _sblank, _sempty, _sdot, _ssep = ((' ', '', '.', '/')
                                           if self.path_enc else
                                           (b' ', b'', b'.', b'/'))
 
+        def decode(b):
+            return b.decode(self.path_enc) if self.path_enc else b
+
         with self.fopen(self.vpk_path, 'rb') as f:
             f.seek(self.header_length)
+            # headerless vpks don't have the tree length
+            tree = f.read(self.tree_length) if self.version > 0 else f.read()
 
-            while True:
-                if self.version > 0 and f.tell() > self.tree_length + self.header_length:
-                    raise ValueError("Error parsing index (out of bounds)")
+        def cstring_end(pos):
+            end = tree.find(b'\x00', pos)
+            if end < 0:
+                raise ValueError("Error parsing index (out of bounds)")
+            return end
 
-                ext = _read_cstring(f, self.path_enc)
-                if not ext:
+        entry = struct.Struct("<IHHIIH")
+        pos = 0
+
+        try:
+            while True:
+                end = cstring_end(pos)
+                if end == pos:
                     break
+                ext = decode(tree[pos:end])
+                pos = end + 1
+
+                skip_ext = ext_filter is not None and not ext_filter(ext)
 
                 while True:
-                    path = _read_cstring(f, self.path_enc)
-                    if not path:
+                    end = cstring_end(pos)
+                    if end == pos:
+                        pos += 1
                         break
+                    path = decode(tree[pos:end])
+                    pos = end + 1
+
                     if path != _sblank:
                         path = path + _ssep
                     else:
                         path = _sempty
 
+                    if skip_ext or (dir_filter is not None and not dir_filter(ext, path)):
+                        # step over every entry, only looking at the preload length
+                        while tree[pos] != 0:
+                            pos = cstring_end(pos) + 1
+                            pos += 18 + (tree[pos + 4] | tree[pos + 5] << 8)
+                        pos += 1
+                        continue
+
                     while True:
-                        name = _read_cstring(f, self.path_enc)
-                        if not name:
+                        end = cstring_end(pos)
+                        if end == pos:
+                            pos += 1
                             break
+                        name = decode(tree[pos:end])
+                        pos = end + 1
 
                         (crc32,
                          preload_length,
@@ -511,27 +663,66 @@ class VPK(object):
                          archive_offset,
                          file_length,
                          suffix,
-                         ) = metadata = list(struct.unpack("IHHIIH", f.read(18)))
+                         ) = metadata = list(entry.unpack_from(tree, pos))
+                        pos += entry.size
 
                         if suffix != 0xffff:
                             raise ValueError("Error while parsing index")
 
+                        file_path = path + name + _sdot + ext
+                        if path_filter is not None and not path_filter(file_path):
+                            pos += preload_length
+                            continue
+
                         if archive_index == 0x7fff:
                             metadata[3] = self.header_length + self.tree_length + archive_offset
 
-                        metadata = (f.read(preload_length),) + tuple(metadata[:-1])
+                        metadata = (tree[pos:pos + preload_length],) + tuple(metadata[:-1])
+                        pos += preload_length
+
+                        yield file_path, metadata
+        except (IndexError, struct.error):
+            raise ValueError("Error parsing index (out of bounds)")
+
+    def entries_in_chunks(self, chunks):
+        """
+        Yields (file_path, metadata) of the entries overlapping any of the chunks,
+        e.g. the ones returned by changed_chunks(). Entries stored in the _dir.vpk itself
+        are not covered by chunk hashes
+        """
+        # archive_index -> (starts, ends) of the chunks, sorted
+        regions = {}
+        for archive_index, offset, length, _ in sorted(chunks):
+            starts, ends = regions.setdefault(archive_index, ([], []))
+            starts.append(offset)
+            ends.append(offset + length)
+
+        for path, metadata in self.read_index_iter():
+            if metadata[3] not in regions:
+                continue
 
-                        yield path + name + _sdot + ext, metadata
+            starts, ends = regions[metadata[3]]
+            archive_offset, end = metadata[4], metadata[4] + metadata[5]
 
+            # Last chunk starting before the end of the entry
+            i = bisect_left(starts, end) - 1
+            if i >= 0 and ends[i] > archive_offset:
+                yield path, metadata
 
-class VPKFile(object):
+
+class VPKFile(io.RawIOBase):
     """
     File-like object for files inside VPK
+
+    This is a raw stream, wrap it in io.BufferedReader for fast readline/iteration.
+    The archive is opened on first read, and close() only releases the archive handle
     """
     _fp = None
     _vpk_path = None
 
     def __init__(self, vpk_path, fopen=fopen, **kw):
+        super(VPKFile, self).__init__()
+
         self.vpk_path = vpk_path
         self.fopen = fopen
         self.vpk_meta = kw
@@ -546,10 +737,9 @@ class VPKFile(object):
         self.length = self.preload_length + self.file_length
         # offset of entire file
         self.offset = 0
-
-        if vpk_path:
-            self._fp = self.fopen(vpk_path, 'rb')
-            self._fp.seek(self.archive_offset)
+        # running crc32 of the data read so far, as long as it was read sequentially
+        self._stream_crc = 0
+        self._stream_offset = 0
 
     def save(self, path):
         """
@@ -559,10 +749,13 @@ class VPKFile(object):
         pos = self.tell()
         self.seek(0)
 
+        buf = bytearray(2**22)
+        view = memoryview(buf)
+
         with fopen(path, 'wb') as output:
             output.truncate(self.length)
-            for chunk in iter(lambda: self.read(8192), b''):
-                output.write(chunk)
+            for n in iter(lambda: self.readinto(buf), 0):
+                output.write(view[:n])
 
         self.seek(pos)
 
@@ -578,7 +771,7 @@ class VPKFile(object):
         self.seek(0)
 
         checksum = 0
-        for chunk in iter(lambda: self.read(8192), b''):
+        for chunk in iter(lambda: self.read(2**22), b''):
             checksum = crc32(chunk, checksum)
 
         # restore file pointer
@@ -586,6 +779,24 @@ class VPKFile(object):
 
         return self.crc32 == checksum & 0xffffffff
 
+    def verify_streamed(self):
+        """
+        Returns True if the file contents match with the CRC32 attribute
+
+        note: uses the checksum accumulated by previous reads, and only reads
+        the part of the file that hasn't been read sequentially yet
+        """
+        if self._stream_offset < self.length:
+            pos = self.tell()
+            self.seek(self._stream_offset)
+
+            for _ in iter(lambda: self.read(2**22), b''):
+                pass
+
+            self.seek(pos)
+
+        return self.crc32 == self._stream_crc & 0xffffffff
+
     def __repr__(self):
         return "%s(%s, %s)" % (
             self.__class__.__name__,
@@ -593,27 +804,19 @@ class VPKFile(object):
             ', '.join(["%s=%s" % (k, repr(v)) for k, v in self.vpk_meta.items()])
             )
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.close()
-
-    def __iter__(self):
-        return self
+    def next(self):
+        return self.__next__()
 
-    def __next__(self):
-        return self.next()
+    def readable(self):
+        return True
 
-    def next(self):
-        line = self.readline()
-        if line == b'':
-            raise StopIteration
-        return line
+    def seekable(self):
+        return True
 
     def close(self):
         if self._fp:
             self._fp.close()
+            self._fp = None
 
     def tell(self):
         return self.offset
@@ -630,44 +833,45 @@ class VPKFile(object):
             raise ValueError("Invalid value for whence")
 
         self.offset = offset = min(max(offset, 0), self.length)
-        self._fp.seek(self.archive_offset + max(offset - self.preload_length, 0))
-
-    def readlines(self):
-        return [line for line in self]
-
-    def readline(self, a=False):
-        buf = b''
-
-        for chunk in iter(lambda: self.read(256), b''):
-            pos = chunk.find(b'\n')
-            if pos > -1:
-                pos += 1  # include \n
-                buf += chunk[:pos]
-                self.seek(-(len(chunk) - pos), 1)
-                break
-
-            buf += chunk
-
-        return buf
-
-    def read(self, length=-1):
-        if length == 0 or self.offset >= self.length:
-            return b''
-
-        data = b''
+        return offset
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        length = min(len(view), self.length - self.offset)
+        if length <= 0:
+            return 0
+
+        start = self.offset
+        n = 0
+
+        if self.offset < self.preload_length:
+            n = min(length, self.preload_length - self.offset)
+            view[:n] = self.preload[self.offset:self.offset + n]
+            self.offset += n
+
+        if n < length:
+            if self._fp is None:
+                self._fp = self.fopen(self.vpk_path, 'rb')
+
+            self._fp.seek(self.archive_offset + self.offset - self.preload_length)
+            while n < length:
+                got = self._fp.readinto(view[n:length])
+                if not got:
+                    break
+                n += got
+                self.offset += got
 
-        if self.offset <= self.preload_length:
-            data += self.preload[self.offset:self.offset+length if length > -1 else None]
-            self.offset += len(data)
-            if length > 0:
-                length = max(length - len(data), 0)
+        if self._stream_offset == start:
+            self._stream_crc = crc32(view[:n], self._stream_crc)
+            self._stream_offset = self.offset
 
-        if self.file_length > 0 and self.offset >= self.preload_length:
-            left = self.file_length - (self.offset - self.preload_length)
-            data += self._fp.read(left if length == -1 else min(left, length))
-            self.offset += left if length == -1 else min(left, length)
+        return n
 
-        return data
+    def readall(self):
+        buf = bytearray(self.length - self.offset)
+        n = self.readinto(buf)
+        del buf[n:]
+        return bytes(buf)
 
     def write(self, seq):
         raise NotImplementedError("write method is not supported")
@@ -0,0 +1,316 @@
+from dataminer.build import Runner, process_dir
+from dataminer.file import File
+from dataminer.inventory import Inventory
+from dataminer import vpk
+
+from pathlib import Path
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+VPK_ARCHIVE_RE = re.compile(r"^(.*)_(\d{3})\.vpk$")
+
+
+class InotifyWatcher:
+    """Recursive directory watcher on top of inotify, through ctypes"""
+
+    def __init__(self, root: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.root = root
+        self.watches: dict[int, Path] = {}
+        self.pending: set[Path] = set()
+        # Events were dropped, what changed has to be found by scanning everything
+        self.overflowed = False
+
+        self.add_tree(root, report=False)
+
+    def add_tree(self, root: Path, report=True):
+        for dirpath, _, files in os.walk(root):
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {dirpath}")
+            self.watches[wd] = Path(dirpath)
+
+            # Files might have been created before the watch was set up
+            if report:
+                for name in files:
+                    self.pending.add(Path(dirpath).joinpath(name))
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if wd not in self.watches:
+                continue
+            if mask & IN_IGNORED:
+                # The directory is gone
+                del self.watches[wd]
+                continue
+            path = self.watches[wd].joinpath(os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    # Everything that was inside of it is gone, without events for each file
+                    self.pending.add(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+                self.pending.add(path)
+
+    def wait_batch(self, settle: float) -> tuple[set[Path], bool]:
+        """
+        Blocks until some files changed or were removed, and no more changes happened for
+        `settle` seconds. Returns the paths, and whether everything has to be rescanned
+        """
+        while True:
+            timeout = settle if self.pending or self.overflowed else None
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+
+            if ready:
+                self._read_events()
+            elif self.pending or self.overflowed:
+                batch, self.pending = self.pending, set()
+                rescan, self.overflowed = self.overflowed, False
+                if rescan:
+                    # Directories created in the meantime might not be watched yet
+                    self.add_tree(self.root, report=False)
+                return batch, rescan
+
+
+class PollingWatcher:
+    """Fallback watcher, compares (size, mtime, inode) of every file between scans"""
+
+    def __init__(self, root: Path, interval: float = 5.0):
+        self.root = root
+        self.interval = interval
+        self.state = Inventory.scan(self.root)
+
+    def wait_batch(self, settle: float) -> tuple[set[Path], bool]:
+        pending = set()
+
+        while True:
+            time.sleep(settle if pending else self.interval)
+
+            new_state = Inventory.scan(self.root)
+            delta = new_state.diff(self.state)
+            changed = {
+                self.root.joinpath(relpath) for relpath in delta.new | delta.changed | delta.removed
+            }
+            self.state = new_state
+
+            if changed:
+                pending |= changed
+            elif pending:
+                return pending, False
+
+
+def vpk_entry_signatures(path: Path):
+    pak = vpk.open(path.as_posix())
+    # (crc32, file_length) for every entry
+    return {name: (meta[1], meta[5]) for name, meta in pak.read_index_iter()}
+
+
+def dir_vpk_for(path: Path):
+    """Returns the _dir.vpk an archive belongs to, or the path itself"""
+    m = VPK_ARCHIVE_RE.match(path.name)
+    if m:
+        return path.with_name(f"{m.group(1)}_dir.vpk")
+    return path
+
+
+class Watch:
+    def __init__(
+        self, input_path: Path, output_path: Path, settle: float, poll=False, jobs=1,
+        only_changed=False, max_memory=None,
+    ):
+        self.input_root = input_path.absolute()
+        self.settle = settle
+
+        self.watcher = None
+        if not poll:
+            try:
+                self.watcher = InotifyWatcher(self.input_root)
+            except (OSError, AttributeError) as e:
+                print("inotify unavailable, falling back to polling:", e)
+        if self.watcher is None:
+            self.watcher = PollingWatcher(self.input_root)
+
+        # Files that didn't change while nothing was watching are skipped
+        self.runner: Runner = process_dir(
+            self.input_root, output_path, jobs, only_changed=only_changed, max_memory=max_memory,
+            incremental=True,
+        )
+        self.runner.journal.open(append=True)
+
+        self.vpk_signatures = {}
+        for relpath in self.runner.inventory:
+            if relpath.endswith("_dir.vpk"):
+                path = self.input_root.joinpath(relpath)
+                try:
+                    self.vpk_signatures[path] = vpk_entry_signatures(path)
+                except Exception as e:
+                    print("Couldn't read vpk index:", e)
+
+    def rescan(self) -> set[Path]:
+        """Everything that changed compared to the inventory, after events were lost"""
+        print("Too many changes at once, rescanning", self.input_root)
+        delta = Inventory.scan(self.input_root).diff(self.runner.inventory)
+        return {
+            self.input_root.joinpath(relpath)
+            for relpath in delta.new | delta.changed | delta.removed
+        }
+
+    def removed_files(self, path: Path) -> set[str]:
+        """Relative paths of the known files that were at path, or inside of it for a directory"""
+        relpath = path.relative_to(self.input_root).as_posix()
+        prefix = relpath + "/"
+        return {
+            known for known in self.runner.inventory.files
+            if known == relpath or known.startswith(prefix)
+        }
+
+    def process_batch(self, batch: set[Path]):
+        paths = set()
+        removed = set()
+        for path in batch:
+            if not path.exists():
+                removed |= self.removed_files(path)
+
+            path = dir_vpk_for(path)
+            if path.is_file():
+                paths.add(path)
+
+        # Which copy wins can change with any vpk
+        if self.runner.overlay is not None and (
+            any(p.name.endswith("_dir.vpk") for p in paths)
+            or any(r.endswith("_dir.vpk") for r in removed)
+        ):
+            self.runner.build_overlay(self.input_root)
+
+        # Outputs of removed files go away, unless other files produce them too. Those are
+        # processed again, just like the ones sharing outputs with files that changed
+        again = set()
+        for relpath in sorted(removed):
+            print("Removed", relpath)
+            self.vpk_signatures.pop(self.input_root.joinpath(relpath), None)
+            again |= self.runner.forget_source(relpath)
+
+        entry_filters = {}
+        for path in paths:
+            relpath = path.relative_to(self.input_root).as_posix()
+
+            if path.name.endswith("_dir.vpk") and path in self.vpk_signatures:
+                try:
+                    signatures = vpk_entry_signatures(path)
+                except Exception as e:
+                    print("Couldn't read vpk index:", e)
+                    continue
+
+                old = self.vpk_signatures[path]
+                self.vpk_signatures[path] = signatures
+
+                # Without removed entries, only the changed ones have to be processed again
+                if old.keys() <= signatures.keys():
+                    changed = {
+                        name for name, sig in signatures.items() if old.get(name) != sig
+                    }
+                    print(f"{path}: {len(changed)} changed entries")
+                    entry_filters[path] = lambda f, changed=changed: f.file.filepath in changed
+                    continue
+            elif path.name.endswith("_dir.vpk"):
+                try:
+                    self.vpk_signatures[path] = vpk_entry_signatures(path)
+                except Exception as e:
+                    print("Couldn't read vpk index:", e)
+
+            again |= self.runner.forget_source(relpath)
+            entry_filters[path] = None
+
+        for relpath in again - removed:
+            path = self.input_root.joinpath(relpath)
+            if path not in entry_filters and path.is_file():
+                entry_filters[path] = None
+
+        for path in sorted(entry_filters):
+            file_info = File(input_root=self.input_root, path=path)
+
+            print("Processing", path)
+            self.runner.process_file(file_info, entry_filters[path])
+
+    def update_inventory(self, batch: set[Path]):
+        """So that a restart only picks up what changed after this batch"""
+        files = self.runner.inventory.files
+        for path in batch:
+            relpath = path.relative_to(self.input_root).as_posix()
+            try:
+                st = path.stat()
+            except OSError:
+                for removed in self.removed_files(path):
+                    files.pop(removed)
+                continue
+            if path.is_file():
+                files[relpath] = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def run(self):
+        print("Watching", self.input_root)
+
+        while True:
+            batch, rescan = self.watcher.wait_batch(self.settle)
+            self.run_batch(batch, rescan)
+
+    def run_batch(self, batch: set[Path], rescan=False):
+        start_time = time.time()
+        self.runner.proc_timings.clear()
+        self.runner.corrupt_files.clear()
+        self.runner.failures.clear()
+        try:
+            if rescan:
+                batch |= self.rescan()
+            self.process_batch(batch)
+            # Aggregated outputs, and removing the ones nothing produces anymore
+            self.runner.post_process()
+        finally:
+            self.update_inventory(batch)
+            self.runner.journal.sync()
+            self.runner.save_state()
+
+        print(f"Processed {len(batch)} changed files in {time.time() - start_time:.2f}s")
+        self.runner.print_summary()
@@ -0,0 +1,162 @@
+"""
+Persistent helper processes for bin_path tools.
+
+Instead of starting the tool once per file, processors with `worker: true` start
+`<bin_path> [fixed args...] --worker` once and send it one request per file.
+
+Protocol, all integers are unsigned 32 bit little-endian:
+
+    request  (stdin):  u32 length, then `length` bytes: the per-file arguments
+                       (what would be appended to the command line), UTF-8
+                       encoded and separated by NUL bytes
+    response (stdout): u32 status, u32 length, then `length` bytes of output
+
+A status of 0 means success and the output is what the tool would have written
+to stdout. Any other status is treated like a non-zero exit code, and the output
+is an error message. Logging has to go to stderr. The helper should exit once
+stdin is closed. A helper that dies or stops responding is killed and replaced
+for the next request.
+
+See dataminer/echo_helper.py for a reference implementation.
+"""
+
+from dataminer.metrics import METRICS
+from dataminer.processor import ProcessorError, ToolTimeoutError
+
+import os
+import select
+import signal
+import struct
+import subprocess
+import threading
+import time
+
+_U32 = struct.Struct("<I")
+_RESPONSE_HEADER = struct.Struct("<II")
+
+WORKER_FLAG = "--worker"
+
+
+class Worker:
+    def __init__(self, command: list, env=None):
+        METRICS.subprocess_spawned()
+        self.proc = subprocess.Popen(
+            command + [WORKER_FLAG],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _read_exact(self, length: int, deadline):
+        buf = bytearray()
+        fd = self.proc.stdout.fileno()
+
+        while len(buf) < length:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    raise ToolTimeoutError("helper timed out")
+
+            data = os.read(fd, length - len(buf))
+            if not data:
+                self.proc.wait()
+                raise ProcessorError(f"helper exited with code {self.proc.returncode}")
+            buf += data
+
+        return bytes(buf)
+
+    def request(self, args: list, timeout=None, max_output_bytes=None) -> tuple[int, bytes]:
+        payload = b"\0".join(os.fsencode(a) for a in args)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        try:
+            self.proc.stdin.write(_U32.pack(len(payload)) + payload)
+            self.proc.stdin.flush()
+
+            status, length = _RESPONSE_HEADER.unpack(
+                self._read_exact(_RESPONSE_HEADER.size, deadline)
+            )
+            if max_output_bytes is not None and length > max_output_bytes:
+                raise ProcessorError(f"output exceeded {max_output_bytes} bytes")
+
+            output = self._read_exact(length, deadline)
+        except BrokenPipeError:
+            self.kill()
+            raise ProcessorError("helper exited")
+        except BaseException:
+            # The stream is out of sync now, this helper can't be reused
+            self.kill()
+            raise
+
+        return status, output
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        try:
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+
+class WorkerPool:
+    """Idle helpers, per command and LD_LIBRARY_PATH"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle: dict[tuple, list[Worker]] = {}
+
+    def request(self, command: list, args: list, env=None, timeout=None, max_output_bytes=None):
+        key = (tuple(str(c) for c in command), (env or {}).get("LD_LIBRARY_PATH"))
+
+        worker = None
+        with self.lock:
+            workers = self.idle.setdefault(key, [])
+            while workers and worker is None:
+                worker = workers.pop()
+                if not worker.alive:
+                    worker.close()
+                    worker = None
+
+        if worker is None:
+            worker = Worker(list(command), env)
+
+        status, output = worker.request(args, timeout, max_output_bytes)
+
+        with self.lock:
+            self.idle.setdefault(key, []).append(worker)
+
+        if status != 0:
+            raise ProcessorError(
+                f"helper returned status {status}: {output.decode('utf8', 'replace')}"
+            )
+
+        return output
+
+    def close(self):
+        with self.lock:
+            for workers in self.idle.values():
+                for worker in workers:
+                    worker.close()
+            self.idle.clear()
+
+
+WORKER_POOL = WorkerPool()
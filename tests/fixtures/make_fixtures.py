@@ -0,0 +1,149 @@
+"""
+Regenerates the binaries in this directory. Needs gcc and protoc, and llvm-nm for the
+expected symbol listings:
+
+    python tests/fixtures/make_fixtures.py
+"""
+
+from pathlib import Path
+import struct
+import subprocess
+import tempfile
+
+HERE = Path(__file__).parent
+
+MH_MAGIC_64 = 0xFEEDFACF
+MH_OBJECT = 1
+LC_SYMTAB = 0x2
+N_UNDF_EXT = 0x01
+N_ABS_EXT = 0x03
+N_FUN = 0x24
+
+CPU_X86_64 = 0x01000007
+CPU_SUBTYPE_X86_64_ALL = 3
+CPU_ARM64 = 0x0100000C
+CPU_SUBTYPE_ARM64_ALL = 0
+
+
+def thin_macho(cputype: int, cpusubtype: int, symbols: list[tuple[bytes, int]]) -> bytes:
+    """64-bit Mach-O with nothing but a symbol table of (name, n_type)"""
+    header_size = 32 + 24
+    nlist = struct.Struct("<IBBHQ")
+
+    strtab = b"\0"
+    entries = b""
+    for name, n_type in symbols:
+        entries += nlist.pack(len(strtab), n_type, 0, 0, 0)
+        strtab += name + b"\0"
+
+    symoff = header_size
+    stroff = symoff + len(entries)
+
+    header = struct.pack("<7I4x", MH_MAGIC_64, cputype, cpusubtype, MH_OBJECT, 1, 24, 0)
+    symtab = struct.pack("<6I", LC_SYMTAB, 24, symoff, len(symbols), stroff, len(strtab))
+    return header + symtab + entries + strtab
+
+
+def fat_macho(images: list[tuple[int, int, bytes]]) -> bytes:
+    """Universal binary of (cputype, cpusubtype, thin image), aligned to 4 KiB like lipo does"""
+    data = bytearray(struct.pack(">2I", 0xCAFEBABE, len(images)))
+    offset = 0x1000
+    for cputype, cpusubtype, image in images:
+        data += struct.pack(">iiIII", cputype, cpusubtype, offset, len(image), 12)
+        offset += (len(image) + 0xFFF) & ~0xFFF
+
+    for _, _, image in images:
+        data += b"\0" * (((len(data) + 0xFFF) & ~0xFFF) - len(data))
+        data += image
+    return bytes(data)
+
+
+def nm(path: Path, *args) -> bytes:
+    return subprocess.run(
+        ["llvm-nm", "--just-symbol-name", *args, path], check=True, capture_output=True
+    ).stdout
+
+
+def make_symbols():
+    thin = thin_macho(CPU_X86_64, CPU_SUBTYPE_X86_64_ALL, [
+        (b"_zeta", N_ABS_EXT), (b"_alpha", N_ABS_EXT), (b"_printf", N_UNDF_EXT),
+        (b"_debug_only", N_FUN),
+    ])
+    HERE.joinpath("thin.macho").write_bytes(thin)
+
+    arm64 = thin_macho(CPU_ARM64, CPU_SUBTYPE_ARM64_ALL, [(b"_only_arm64", N_ABS_EXT), (b"_both", N_ABS_EXT)])
+    HERE.joinpath("fat.macho").write_bytes(fat_macho([
+        (CPU_X86_64, CPU_SUBTYPE_X86_64_ALL, thin), (CPU_ARM64, CPU_SUBTYPE_ARM64_ALL, arm64),
+    ]))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        tmp.joinpath("lib.c").write_text(
+            "#include <stdio.h>\n"
+            "static int local_counter;\n"
+            "int exported(void) { return printf(\"%d\", local_counter++); }\n"
+            "int old_impl(void) { return 1; }\n"
+            "int new_impl(void) { return 2; }\n"
+            "__asm__(\".symver old_impl,versioned@VERS_1\");\n"
+            "__asm__(\".symver new_impl,versioned@@VERS_2\");\n"
+        )
+        tmp.joinpath("lib.map").write_text(
+            "VERS_1 { global: exported; old_impl; versioned; local: *; };\n"
+            "VERS_2 { global: new_impl; } VERS_1;\n"
+        )
+        subprocess.run([
+            "gcc", "-shared", "-fPIC", "-O1", "-Wl,--version-script=" + str(tmp.joinpath("lib.map")),
+            "-o", HERE.joinpath("versioned.so"), tmp.joinpath("lib.c"),
+        ], check=True)
+
+    HERE.joinpath("thin.macho.nm").write_bytes(nm(HERE.joinpath("thin.macho")))
+    # Paths are part of the headers of universal binaries
+    path = HERE.joinpath("fat.macho")
+    HERE.joinpath("fat.macho.nm").write_bytes(nm(path, "--arch=all").replace(bytes(path), b"PATH"))
+    HERE.joinpath("versioned.so.nm").write_bytes(nm(HERE.joinpath("versioned.so")))
+    HERE.joinpath("versioned.so.nm-D").write_bytes(nm(HERE.joinpath("versioned.so"), "-D"))
+
+
+def make_protobufs():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        tmp.joinpath("common.proto").write_text(
+            'syntax = "proto2";\n'
+            "package fixture;\n"
+            "message Common {\n"
+            "  optional int32 id = 1;\n"
+            "  repeated string tags = 2;\n"
+            "  enum Kind { KIND_A = 0; KIND_B = 1; }\n"
+            "  optional Kind kind = 3 [default = KIND_B];\n"
+            "}\n"
+        )
+        subprocess.run([
+            "protoc", "-I", tmp, "--descriptor_set_out", tmp.joinpath("set.pb"),
+            tmp.joinpath("common.proto"),
+        ], check=True)
+        descriptor_set = tmp.joinpath("set.pb").read_bytes()
+
+    # A FileDescriptorSet is the FileDescriptorProtos, each with a 0x0a tag and a length
+    length, pos = 0, 1
+    for shift in range(0, 35, 7):
+        length |= (descriptor_set[pos] & 0x7F) << shift
+        pos += 1
+        if descriptor_set[pos - 1] < 0x80:
+            break
+    descriptor = descriptor_set[pos : pos + length]
+
+    HERE.joinpath("descriptor.bin").write_bytes(
+        b"\x7fELF padding\0"
+        # Looks like the start of a descriptor, but the length doesn't match the name
+        + b"\x0a\x05wrong.proto\0"
+        # Right length, but nothing of a descriptor after the name
+        + b"\x0a\x0bbogus.proto\0"
+        + b"\0" * 7
+        + descriptor
+        + b"\0trailing data\0"
+    )
+
+
+if __name__ == "__main__":
+    make_symbols()
+    make_protobufs()
@@ -0,0 +1,117 @@
+from dataminer import cache
+from dataminer.cache import ResultCache, config_hash
+from dataminer.file import File
+
+import itertools
+import os
+
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Every call to time.time() in the cache is one second later"""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(cache.time, "time", lambda: float(next(ticks)))
+
+
+def make_tool(path, body="#!/bin/sh\necho v1\n"):
+    path.write_text(body)
+    path.chmod(0o755)
+    return path
+
+
+def output(tmp_path, name, data: bytes):
+    path = tmp_path.joinpath(name)
+    path.write_bytes(data)
+    return path
+
+
+def test_config_hash_ignores_runtime_keys():
+    base = {"name": "strings", "line_discard_filter": "GLIBC"}
+    runtime = dict(base, filters=["*.so"], timeout=5, retries=2, max_output_bytes=10, worker=True)
+
+    assert config_hash(runtime) == config_hash(base)
+    assert config_hash(dict(base, line_discard_filter="GCC")) != config_hash(base)
+
+
+def test_config_hash_includes_tool(tmp_path):
+    tool = make_tool(tmp_path.joinpath("tool"))
+    config = {"name": "protobufs", "bin_path": str(tool)}
+    before = config_hash(config)
+    assert config_hash(config) == before
+
+    # Another version of the tool at the same path
+    make_tool(tool, "#!/bin/sh\necho version 2\n")
+    os.utime(tool, ns=(1, 1))
+    assert config_hash(config) != before
+
+
+def test_hit_and_misses(tmp_path, clock):
+    result_cache = ResultCache(tmp_path.joinpath("cache"))
+    tool = make_tool(tmp_path.joinpath("tool"))
+    config = {"name": "symbols", "bin_path": str(tool)}
+
+    input_file = File(tmp_path, output(tmp_path, "input.so", b"\x7fELF input"))
+    digest = result_cache.digest(input_file)
+    key = result_cache.key(digest, "symbols", config_hash(config))
+    result_cache.put(key, output(tmp_path, "out.txt", b"symbol list"))
+
+    cached = result_cache.get(key)
+    assert cached is not None and cached.read_bytes() == b"symbol list"
+
+    # A runtime setting doesn't change the key
+    assert result_cache.get(
+        result_cache.key(digest, "symbols", config_hash(dict(config, timeout=60)))
+    ) is not None
+
+    assert result_cache.get(
+        result_cache.key(digest, "symbols", config_hash(dict(config, demangle=False)))
+    ) is None
+
+    make_tool(tool, "#!/bin/sh\necho a newer version\n")
+    assert result_cache.get(result_cache.key(digest, "symbols", config_hash(config))) is None
+
+    # Other contents
+    input_file.path.write_bytes(b"\x7fELF changed input")
+    os.utime(input_file.path, ns=(1, 1))
+    assert result_cache.digest(input_file) != digest
+
+    assert result_cache.stats() == {"hits": 2, "misses": 2, "evictions": 0}
+
+
+def test_digest_remembered_by_identity(tmp_path, monkeypatch):
+    result_cache = ResultCache(tmp_path.joinpath("cache"))
+    input_file = File(tmp_path, output(tmp_path, "input.so", b"contents"))
+    digest = result_cache.digest(input_file)
+
+    # Same size and mtime, so not read again
+    monkeypatch.setattr(File, "map", lambda self: pytest.fail("hashed again"))
+    assert result_cache.digest(input_file) == digest
+
+
+def test_eviction_order(tmp_path, clock):
+    root = tmp_path.joinpath("cache")
+    result_cache = ResultCache(root, max_size=250)
+
+    keys = [result_cache.key(f"digest{i}", "strings", "config") for i in range(3)]
+    for i, key in enumerate(keys):
+        result_cache.put(key, output(tmp_path, f"out{i}.txt", bytes([i]) * 100))
+
+    # The first one was used last, so the second one is the least recently used now
+    assert result_cache.get(keys[0]) is not None
+    result_cache.save()
+
+    assert result_cache.stats()["evictions"] == 1
+    assert not result_cache.object_path(keys[1]).exists()
+
+    reopened = ResultCache(root, max_size=250)
+    assert sorted(reopened.entries) == sorted([keys[0], keys[2]])
+    assert reopened.get(keys[1]) is None
+    assert reopened.get(keys[0]).read_bytes() == bytes([0]) * 100
+    assert reopened.get(keys[2]).read_bytes() == bytes([2]) * 100
+
+    # Both fit, nothing else goes
+    reopened.save()
+    assert reopened.stats()["evictions"] == 0
+    assert sorted(ResultCache(root, max_size=250).entries) == sorted([keys[0], keys[2]])
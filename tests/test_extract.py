@@ -0,0 +1,65 @@
+from dataminer import extract, vpk
+
+from test_vpk import INDEX_FILES, build_vpk, make_source
+
+
+def test_extract_vpk(tmp_path, monkeypatch):
+    # Several batches per archive
+    monkeypatch.setattr(extract, "BATCH_SIZE", 30000)
+
+    contents = make_source(tmp_path.joinpath("src"))
+    input_root = tmp_path.joinpath("in")
+    input_root.joinpath("tf").mkdir(parents=True)
+    vpk.new(str(tmp_path.joinpath("src"))).save(
+        str(input_root.joinpath("tf/pak01_dir.vpk")), max_archive_size=50000
+    )
+    build_vpk(input_root.joinpath("tf/misc_dir.vpk"), INDEX_FILES)
+
+    output_root = tmp_path.joinpath("out")
+    assert extract.extract(input_root, output_root, threads=4)
+
+    for relpath, data in contents.items():
+        assert output_root.joinpath("tf/pak01_dir", relpath).read_bytes() == data
+    for relpath, (preload, data) in INDEX_FILES.items():
+        assert output_root.joinpath("tf/misc_dir", relpath).read_bytes() == preload + data
+
+    extracted = [path for path in output_root.rglob("*") if path.is_file()]
+    assert len(extracted) == len(contents) + len(INDEX_FILES)
+
+
+def test_extract_match(tmp_path):
+    input_root = tmp_path.joinpath("in")
+    input_root.mkdir()
+    build_vpk(input_root.joinpath("misc_dir.vpk"), INDEX_FILES)
+
+    output_root = tmp_path.joinpath("out")
+    assert extract.extract(input_root, output_root, ["misc_dir/scripts/*"])
+
+    extracted = sorted(
+        path.relative_to(output_root).as_posix() for path in output_root.rglob("*") if path.is_file()
+    )
+    assert extracted == [
+        "misc_dir/scripts/game/modes.txt", "misc_dir/scripts/items.txt", "misc_dir/scripts/units.txt",
+    ]
+
+
+def test_extract_refuses_unsafe_names(tmp_path, capsys):
+    input_root = tmp_path.joinpath("in")
+    input_root.mkdir()
+    files = dict(INDEX_FILES)
+    files["../../escape/evil.txt"] = (b"", b"outside")
+    files["/abs/evil.txt"] = (b"", b"absolute")
+    files["scripts/../../evil.txt"] = (b"", b"sneaky")
+    build_vpk(input_root.joinpath("misc_dir.vpk"), files)
+
+    output_root = tmp_path.joinpath("out")
+    assert not extract.extract(input_root, output_root)
+
+    assert capsys.readouterr().out.count("unsafe path") == 3
+    assert not tmp_path.joinpath("escape").exists()
+    assert not output_root.joinpath("evil.txt").exists()
+    assert not output_root.joinpath("misc_dir/abs").exists()
+
+    # Everything else is still extracted
+    for relpath, (preload, data) in INDEX_FILES.items():
+        assert output_root.joinpath("misc_dir", relpath).read_bytes() == preload + data
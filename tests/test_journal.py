@@ -0,0 +1,95 @@
+from dataminer import build
+from dataminer.journal import Journal
+
+import json
+import os
+
+import pytest
+
+CONFIG = {
+    "extractors": {
+        "vpk": {"filters": ["*_dir.vpk"]},
+        "bsp": {"filters": ["*.bsp"]},
+    },
+    "processors": [
+        {"name": "copy", "convert_utf8": False, "filters": ["*.txt"]},
+    ],
+}
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setattr(build, "CONFIG", CONFIG)
+
+
+def read_records(path):
+    with open(path, "r") as fd:
+        return [json.loads(line) for line in fd]
+
+
+def test_resume_after_torn_line(config, tmp_path):
+    input_root = tmp_path.joinpath("in")
+    input_root.mkdir()
+    for name in ("a", "b", "c"):
+        input_root.joinpath(f"{name}.txt").write_text(f"contents of {name}\n")
+    output_root = tmp_path.joinpath("out")
+
+    build.process_dir(input_root, output_root)
+    journal_path = output_root.joinpath(Journal.FILE_NAME)
+    records = read_records(journal_path)
+    assert sorted(record[1] for record in records) == ["a.txt", "b.txt", "c.txt"]
+
+    # Killed while the third record was written
+    lines = journal_path.read_bytes().splitlines(keepends=True)
+    journal_path.write_bytes(lines[0] + lines[1] + lines[2][:10])
+    done = {records[0][1], records[1][1]}
+    todo = records[2][1]
+
+    journal = Journal(journal_path, resume=True)
+    assert {key[1] for key in journal.completed} == done
+
+    runner = build.process_dir(input_root, output_root, resume=True)
+    assert runner.skipped == 2
+
+    # The torn line was dropped, and only the unfinished item was done again
+    resumed = read_records(journal_path)
+    assert resumed[:2] == records[:2]
+    assert [record[1] for record in resumed[2:]] == [todo]
+    assert output_root.joinpath(todo).read_text() == f"contents of {todo[0]}\n"
+    assert sorted(runner.outputs) == ["a.txt", "b.txt", "c.txt"]
+
+
+def test_open_append_truncates_torn_line(tmp_path):
+    path = tmp_path.joinpath(Journal.FILE_NAME)
+    # Longer than the 4096 bytes scanned backwards at once
+    path.write_text(json.dumps(["copy", "a.txt", "1:1"]) + "\n" + '["copy", "' + "x" * 10000)
+
+    journal = Journal(path)
+    journal.open(append=True)
+    journal.record("copy", "b.txt", "2:2")
+    journal.close()
+
+    assert read_records(path) == [["copy", "a.txt", "1:1"], ["copy", "b.txt", "2:2"]]
+
+
+def test_sync_batching(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd))
+
+    journal = Journal(tmp_path.joinpath(Journal.FILE_NAME))
+    journal.SYNC_RECORDS = 3
+    journal.SYNC_INTERVAL = 3600
+    journal.open()
+
+    for i in range(7):
+        journal.record("copy", f"{i}.txt", "1:1")
+    assert len(synced) == 2
+
+    # Or after SYNC_INTERVAL, whatever comes first
+    journal.SYNC_INTERVAL = 0
+    journal.record("copy", "7.txt", "1:1")
+    assert len(synced) == 3
+
+    journal.close()
+    assert len(synced) == 4
+    assert len(read_records(journal.path)) == 8
@@ -0,0 +1,105 @@
+from dataminer.output import SPILL_SIZE, ChangedOnlyFile, OutputStats
+
+import os
+import random
+
+import pytest
+
+OLD_MTIME_NS = 1_000_000_000 * 10**9
+
+# Below the spill threshold, and past it so that new contents go through a temporary file
+SIZES = [1000, SPILL_SIZE + 1000]
+
+
+def write(path, data: bytes, stats: OutputStats) -> ChangedOnlyFile:
+    with ChangedOnlyFile(path, stats) as fd:
+        # In pieces, so the threshold is crossed in the middle of a write
+        for start in range(0, len(data), 1 << 20):
+            fd.write(data[start:start + (1 << 20)])
+        spilled = fd.spill is not None
+    assert spilled == (len(data) > SPILL_SIZE)
+    return fd
+
+
+def existing(tmp_path, data: bytes):
+    path = tmp_path.joinpath("output.txt")
+    path.write_bytes(data)
+    os.utime(path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+    return path
+
+
+def leftovers(tmp_path):
+    return [path.name for path in tmp_path.iterdir() if path.name != "output.txt"]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_identical_contents_keep_mtime(tmp_path, size):
+    data = random.Random(size).randbytes(size)
+    path = existing(tmp_path, data)
+    stats = OutputStats()
+
+    write(path, data, stats)
+
+    assert path.stat().st_mtime_ns == OLD_MTIME_NS
+    assert (stats.written, stats.unchanged) == (0, 1)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_same_size_different_contents(tmp_path, size):
+    data = random.Random(size).randbytes(size)
+    path = existing(tmp_path, data)
+    stats = OutputStats()
+
+    # Only the hash tells them apart
+    changed = data[:-1] + bytes([data[-1] ^ 1])
+    write(path, changed, stats)
+
+    assert path.read_bytes() == changed
+    assert path.stat().st_mtime_ns != OLD_MTIME_NS
+    assert (stats.written, stats.unchanged) == (1, 0)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_different_size(tmp_path, size):
+    data = random.Random(size).randbytes(size)
+    path = existing(tmp_path, data)
+    stats = OutputStats()
+
+    write(path, data + b"more", stats)
+
+    assert path.read_bytes() == data + b"more"
+    assert path.stat().st_mtime_ns != OLD_MTIME_NS
+    assert (stats.written, stats.unchanged) == (1, 0)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_new_file(tmp_path, size):
+    data = random.Random(size).randbytes(size)
+    path = tmp_path.joinpath("output.txt")
+    stats = OutputStats()
+
+    write(path, data, stats)
+
+    assert path.read_bytes() == data
+    assert (stats.written, stats.unchanged) == (1, 0)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_error_keeps_old_output(tmp_path, size):
+    data = random.Random(size).randbytes(size)
+    path = existing(tmp_path, b"old contents")
+    stats = OutputStats()
+
+    with pytest.raises(RuntimeError):
+        with ChangedOnlyFile(path, stats) as fd:
+            fd.write(data)
+            raise RuntimeError("processor failed")
+
+    assert path.read_bytes() == b"old contents"
+    assert path.stat().st_mtime_ns == OLD_MTIME_NS
+    assert (stats.written, stats.unchanged) == (0, 0)
+    assert leftovers(tmp_path) == []
@@ -0,0 +1,130 @@
+from dataminer import protobuf
+from dataminer.file import File
+from dataminer.processor import ProtobufProcessor
+from dataminer.shard import MANIFEST_FILE_NAME, merge
+
+from pathlib import Path
+import json
+
+FIXTURES = Path(__file__).parent.joinpath("fixtures")
+
+COMMON_PROTO = """\
+syntax = "proto2";
+
+package fixture;
+
+message Common {
+	optional int32 id = 1;
+	repeated string tags = 2;
+	optional .fixture.Common.Kind kind = 3 [default = KIND_B];
+
+	enum Kind {
+		KIND_A = 0;
+		KIND_B = 1;
+	}
+}
+"""
+
+
+def field(number: int, payload: bytes) -> bytes:
+    """Length-delimited field, payloads here are shorter than 128 bytes"""
+    return bytes([number << 3 | protobuf.WIRE_LEN, len(payload)]) + payload
+
+
+def descriptor(name: str, *messages: str) -> bytes:
+    return field(1, name.encode()) + b"".join(field(4, field(1, m.encode())) for m in messages)
+
+
+def test_find_file_descriptors():
+    data = FIXTURES.joinpath("descriptor.bin").read_bytes()
+
+    # The markers with a wrong length, or nothing but a name after them, are skipped
+    found = list(protobuf.find_file_descriptors(data))
+    assert [d["name"] for _, d in found] == ["common.proto"]
+
+    _, common = found[0]
+    registry = protobuf.Registry()
+    registry.add(common)
+    assert protobuf.to_proto(common, registry) == COMMON_PROTO
+
+
+def test_truncated_descriptor():
+    data = FIXTURES.joinpath("descriptor.bin").read_bytes()
+    start = data.index(b"\x0a\x0ccommon.proto")
+
+    # The fields that are complete are still found
+    found = list(protobuf.find_file_descriptors(data[: start + 40]))
+    assert [d["name"] for _, d in found] == ["common.proto"]
+    assert found[0][1]["package"] == "fixture"
+    assert found[0][1]["message_type"] == []
+
+
+def run_protobufs(output_root: Path, inputs: list[Path], resume=False):
+    proc = ProtobufProcessor(output_root, {"filters": ["*"]})
+    proc.resume = resume
+    proc.pre_process()
+    return [proc.run_processor(File(path.parent, path)) for path in inputs]
+
+
+def test_biggest_version_wins_in_any_order(tmp_path):
+    small = tmp_path.joinpath("small.bin")
+    small.write_bytes(b"\0" + descriptor("shared.proto", "A") + b"\0")
+    big = tmp_path.joinpath("big.bin")
+    big.write_bytes(
+        b"\0" + descriptor("shared.proto", "A", "B") + b"\0" + descriptor("own.proto", "C") + b"\0"
+    )
+
+    outputs = run_protobufs(tmp_path.joinpath("a"), [small, big])
+    run_protobufs(tmp_path.joinpath("b"), [big, small])
+
+    # Every descriptor of a file is one of its outputs
+    protobuf_dir = tmp_path.joinpath("a", "Protobufs")
+    assert outputs == [
+        [protobuf_dir.joinpath("shared.proto")],
+        [protobuf_dir.joinpath("shared.proto"), protobuf_dir.joinpath("own.proto")],
+    ]
+    for root in ("a", "b"):
+        assert "message B" in tmp_path.joinpath(root, "Protobufs", "shared.proto").read_text()
+
+    # A resumed run keeps what the interrupted one wrote, unless it finds something better
+    run_protobufs(tmp_path.joinpath("b"), [small], resume=True)
+    assert "message B" in tmp_path.joinpath("b", "Protobufs", "shared.proto").read_text()
+
+
+def write_shard(root: Path, files: dict[str, str]):
+    for relpath, text in files.items():
+        root.joinpath(relpath).parent.mkdir(parents=True, exist_ok=True)
+        root.joinpath(relpath).write_text(text)
+    with open(root.joinpath(MANIFEST_FILE_NAME), "w") as fd:
+        json.dump({"shard": None, "outputs": sorted(files)}, fd)
+
+
+def test_merge_protobufs(tmp_path):
+    write_shard(tmp_path.joinpath("s0"), {"Protobufs/x.proto": "small", "Protobufs/a.proto": "a"})
+    write_shard(tmp_path.joinpath("s1"), {"Protobufs/x.proto": "bigger", "Protobufs/b.proto": "b"})
+
+    for order in (["s0", "s1"], ["s1", "s0"]):
+        output = tmp_path.joinpath("merged-" + order[0])
+        assert merge([tmp_path.joinpath(shard) for shard in order], output)
+        assert output.joinpath("Protobufs", "x.proto").read_text() == "bigger"
+        assert output.joinpath("Protobufs", "a.proto").exists()
+        assert output.joinpath("Protobufs", "b.proto").exists()
+
+
+def test_merge_directory_outputs(tmp_path):
+    write_shard(tmp_path.joinpath("s0"), {"dir/same.txt": "same", "dir/one.txt": "1"})
+    write_shard(tmp_path.joinpath("s1"), {"dir/same.txt": "same", "dir/two.txt": "2"})
+    for shard in ("s0", "s1"):
+        with open(tmp_path.joinpath(shard, MANIFEST_FILE_NAME), "w") as fd:
+            json.dump({"shard": None, "outputs": ["dir"]}, fd)
+
+    output = tmp_path.joinpath("merged")
+    assert merge([tmp_path.joinpath("s0"), tmp_path.joinpath("s1")], output)
+    assert sorted(p.name for p in output.joinpath("dir").iterdir()) == [
+        "one.txt", "same.txt", "two.txt",
+    ]
+
+    # Anything else that differs between shards is a conflict
+    tmp_path.joinpath("s1", "dir", "same.txt").write_text("different")
+    shards = [tmp_path.joinpath("s0"), tmp_path.joinpath("s1")]
+    assert not merge(shards, tmp_path.joinpath("merged2"))
@@ -0,0 +1,115 @@
+from dataminer.file import File
+from dataminer.processor import ProcessorError, SymbolsProcessor
+from dataminer.symbols import SymbolReaderError, is_universal, symbol_names
+
+from pathlib import Path
+import struct
+
+import pytest
+
+FIXTURES = Path(__file__).parent.joinpath("fixtures")
+
+# What SymbolsProcessor turns into a ProcessorError
+READ_ERRORS = (SymbolReaderError, struct.error, IndexError)
+
+
+def fixture(name: str) -> bytes:
+    return FIXTURES.joinpath(name).read_bytes()
+
+
+def nm_output(data, dynamic=False) -> bytes:
+    # The expected outputs have the path of universal binaries replaced
+    return b"".join(line + b"\n" for line in symbol_names(data, "PATH", dynamic))
+
+
+@pytest.mark.parametrize("name", ["thin.macho", "fat.macho", "versioned.so"])
+def test_same_as_llvm_nm(name):
+    assert nm_output(fixture(name)) == fixture(name + ".nm")
+
+
+def test_elf_dynamic_symbols_with_versions():
+    assert nm_output(fixture("versioned.so"), dynamic=True) == fixture("versioned.so.nm-D")
+
+
+def test_elf_symtab_and_dynsym():
+    data = fixture("versioned.so")
+    symtab = list(symbol_names(data, "PATH"))
+    dynsym = list(symbol_names(data, "PATH", dynamic=True))
+
+    # Local symbols are only in .symtab, which has no version definitions
+    assert b"local_counter" in symtab
+    assert not any(name.startswith(b"local_counter") for name in dynsym)
+    assert b"versioned@@VERS_2" in dynsym
+    assert b"versioned@VERS_1" in dynsym
+
+
+def test_thin_macho():
+    data = fixture("thin.macho")
+    assert not is_universal(data)
+    # Debugger symbols are left out like nm does without -a
+    assert list(symbol_names(data, "PATH")) == [b"_alpha", b"_printf", b"_zeta"]
+
+
+def test_fat_macho():
+    data = fixture("fat.macho")
+    assert is_universal(data)
+    assert list(symbol_names(data, "some/path")) == [
+        b"",
+        b"some/path (for architecture x86_64):",
+        b"_alpha",
+        b"_printf",
+        b"_zeta",
+        b"",
+        b"some/path (for architecture arm64):",
+        b"_both",
+        b"_only_arm64",
+    ]
+
+
+@pytest.mark.parametrize("name, size", [
+    # ELF header, the section header table (at the end of the file)
+    ("versioned.so", 30),
+    ("versioned.so", -64),
+    # Mach-O header, load command, string table
+    ("thin.macho", 20),
+    ("thin.macho", 40),
+    ("thin.macho", -10),
+    # Architecture table, header of the second image
+    ("fat.macho", 30),
+    ("fat.macho", 0x2000 + 10),
+])
+def test_truncated(name, size):
+    data = fixture(name)[:size]
+    with pytest.raises(READ_ERRORS):
+        list(symbol_names(data, "PATH"))
+
+
+def test_corrupt_headers():
+    elf = bytearray(fixture("versioned.so"))
+    # ELF class
+    elf[4] = 7
+    with pytest.raises(SymbolReaderError):
+        list(symbol_names(elf, "PATH"))
+
+    with pytest.raises(SymbolReaderError):
+        list(symbol_names(b"\0" * 64, "PATH"))
+
+    fat = bytearray(fixture("fat.macho"))
+    # Offset of the first image
+    struct.pack_into(">I", fat, 16, 0x100)
+    with pytest.raises(READ_ERRORS):
+        list(symbol_names(fat, "PATH"))
+
+
+def test_processor_drops_partial_output(tmp_path):
+    input_path = tmp_path.joinpath("input", "broken.so")
+    input_path.parent.mkdir()
+    input_path.write_bytes(fixture("versioned.so")[:-64])
+    output_root = tmp_path.joinpath("output")
+
+    proc = SymbolsProcessor(output_root, {"filters": ["*.so"]})
+    file = File(tmp_path.joinpath("input"), input_path)
+
+    with pytest.raises(ProcessorError):
+        proc.run_processor(file)
+    assert not proc.output_path_for(file).exists()
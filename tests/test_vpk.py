@@ -0,0 +1,198 @@
+from dataminer import vpk
+
+from pathlib import Path
+import random
+import struct
+import zlib
+
+import pytest
+
+# Relative path -> size, with entries in the root, nested directories and several extensions
+SOURCE_FILES = {
+    "readme.txt": 100,
+    "empty.txt": 0,
+    "scripts/items.txt": 5000,
+    "scripts/game/units.txt": 12345,
+    "materials/wall.vmt": 300,
+    "materials/wall.vtf": 70000,
+    "models/crate.mdl": 40000,
+    "models/crate.vvd": 20000,
+}
+
+
+def make_source(root: Path) -> dict[str, bytes]:
+    rng = random.Random(1)
+    contents = {}
+    for relpath, size in SOURCE_FILES.items():
+        path = root.joinpath(relpath)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = rng.randbytes(size)
+        path.write_bytes(data)
+        contents[relpath] = data
+    return contents
+
+
+def check_entries(pak: vpk.VPK, contents: dict[str, bytes]):
+    assert sorted(pak) == sorted(contents)
+
+    for relpath, data in contents.items():
+        entry = pak.get_file(relpath)
+        assert entry.read() == data
+        assert entry.verify()
+        entry.close()
+
+
+def chunk_hashes(paths: list[Path], chunk_size: int) -> list[tuple]:
+    hashes = []
+    for archive_index, path in enumerate(paths):
+        hasher = vpk._ChunkHasher(archive_index, chunk_size)
+        hasher.update(path.read_bytes())
+        hasher.finish()
+        hashes += hasher.hashes
+    return hashes
+
+
+def test_save_embedded(tmp_path):
+    contents = make_source(tmp_path.joinpath("src"))
+    out_path = tmp_path.joinpath("pak01_dir.vpk")
+
+    pak = vpk.new(str(tmp_path.joinpath("src"))).save_and_open(str(out_path))
+
+    assert pak.version == 2
+    assert pak.embed_chunk_length == sum(SOURCE_FILES.values())
+    assert pak.chunk_hashes == []
+    assert pak.verify()
+    check_entries(pak, contents)
+
+    for _, metadata in pak.read_index_iter():
+        assert metadata[3] >= pak.header_length + pak.tree_length
+
+
+def test_save_archives(tmp_path):
+    contents = make_source(tmp_path.joinpath("src"))
+    out_path = tmp_path.joinpath("pak01_dir.vpk")
+
+    new = vpk.new(str(tmp_path.joinpath("src")))
+    new.chunk_hash_size = 4096
+    pak = new.save_and_open(str(out_path), max_archive_size=50000)
+
+    archives = sorted(tmp_path.glob("pak01_[0-9][0-9][0-9].vpk"))
+    # The 70000 byte file is bigger than the limit and gets an archive of its own
+    assert len(archives) > 2
+    for path in archives:
+        if path.stat().st_size > 50000:
+            assert path.stat().st_size == 70000
+
+    assert pak.embed_chunk_length == 0
+    assert pak.verify()
+    assert pak.chunk_hashes == chunk_hashes(archives, 4096)
+    check_entries(pak, contents)
+
+    # Nothing changed, so a rewrite has the same chunks
+    rewritten = tmp_path.joinpath("rewritten")
+    rewritten.mkdir()
+    again = new.save_and_open(str(rewritten.joinpath("pak01_dir.vpk")), max_archive_size=50000)
+    assert vpk.changed_chunks(pak.chunk_hashes, again.chunk_hashes) == []
+
+
+def test_save_detects_changed_file(tmp_path):
+    make_source(tmp_path.joinpath("src"))
+    new = vpk.new(str(tmp_path.joinpath("src")))
+    tmp_path.joinpath("src/readme.txt").write_bytes(b"shorter")
+
+    with pytest.raises(RuntimeError, match="changed while saving"):
+        new.save(str(tmp_path.joinpath("pak01_dir.vpk")))
+
+
+# Relative path -> (preload, data) for a v1 VPK written by hand, with preload data on some entries
+INDEX_FILES = {
+    "readme.txt": (b"", b"hello"),
+    "scripts/items.txt": (b"items preload", b" and the rest"),
+    "scripts/units.txt": (b"", b"units"),
+    "scripts/game/modes.txt": (b"modes", b""),
+    "materials/wall.vmt": (b"wall preload", b"wall"),
+    "materials/floor.vmt": (b"", b"floor"),
+    "models/crate.mdl": (b"\x00\x01\x02", b"\x03\x04"),
+}
+
+
+def build_vpk(path: Path, files: dict[str, tuple[bytes, bytes]]):
+    """Tree sorted by extension and then directory, data stored in the _dir.vpk itself"""
+    tree = bytearray()
+    data = bytearray()
+
+    by_ext = {}
+    for relpath in sorted(files):
+        directory, _, filename = relpath.rpartition("/")
+        name, _, ext = filename.rpartition(".")
+        by_ext.setdefault(ext, {}).setdefault(directory or " ", []).append((name, relpath))
+
+    for ext, dirs in by_ext.items():
+        tree += ext.encode() + b"\x00"
+        for directory, names in dirs.items():
+            tree += directory.encode() + b"\x00"
+            for name, relpath in names:
+                preload, contents = files[relpath]
+                crc = zlib.crc32(preload + contents)
+                tree += name.encode() + b"\x00"
+                tree += struct.pack("<IHHIIH", crc, len(preload), 0x7fff, len(data), len(contents), 0xffff)
+                tree += preload
+                data += contents
+            tree += b"\x00"
+        tree += b"\x00"
+    tree += b"\x00"
+
+    path.write_bytes(struct.pack("<III", 0x55aa1234, 1, len(tree)) + tree + data)
+
+
+def test_read_index_iter(tmp_path):
+    path = tmp_path.joinpath("pak01_dir.vpk")
+    build_vpk(path, INDEX_FILES)
+    pak = vpk.open(str(path))
+
+    entries = dict(pak.read_index_iter())
+    assert sorted(entries) == sorted(INDEX_FILES)
+
+    for relpath, (preload, contents) in INDEX_FILES.items():
+        metadata = entries[relpath]
+        assert metadata[0] == preload
+        assert metadata[2] == len(preload)
+        assert metadata[5] == len(contents)
+
+        entry = pak.get_vpkfile_instance(relpath, metadata)
+        assert entry.read() == preload + contents
+        assert entry.verify()
+        entry.close()
+
+
+@pytest.mark.parametrize("kwargs, wanted", [
+    ({"ext_filter": lambda ext: ext == "txt"}, lambda path: path.endswith(".txt")),
+    ({"ext_filter": lambda ext: ext != "txt"}, lambda path: not path.endswith(".txt")),
+    (
+        {"dir_filter": lambda ext, path: path == "scripts/"},
+        lambda path: path.rpartition("/")[0] == "scripts",
+    ),
+    ({"dir_filter": lambda ext, path: path == ""}, lambda path: "/" not in path),
+    (
+        {"dir_filter": lambda ext, path: ext == "vmt" or path.startswith("scripts/")},
+        lambda path: path.endswith(".vmt") or path.startswith("scripts/"),
+    ),
+    (
+        {"path_filter": lambda path: "preload" in INDEX_FILES[path][0].decode()},
+        lambda path: "preload" in INDEX_FILES[path][0].decode(),
+    ),
+    (
+        {"ext_filter": lambda ext: ext == "txt", "path_filter": lambda path: "/game/" in path},
+        lambda path: path == "scripts/game/modes.txt",
+    ),
+])
+def test_read_index_iter_filters(tmp_path, kwargs, wanted):
+    path = tmp_path.joinpath("pak01_dir.vpk")
+    build_vpk(path, INDEX_FILES)
+    pak = vpk.open(str(path))
+
+    unfiltered = list(pak.read_index_iter())
+    filtered = list(pak.read_index_iter(**kwargs))
+
+    assert filtered == [(path, metadata) for path, metadata in unfiltered if wanted(path)]
+    assert filtered
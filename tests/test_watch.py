@@ -0,0 +1,150 @@
+from dataminer import build
+from dataminer.processor import Processor
+from dataminer.shard import load_manifest
+from dataminer.watch import InotifyWatcher, Watch
+
+from test_protobuf import descriptor
+
+import pytest
+
+CONFIG = {
+    "extractors": {
+        "vpk": {"filters": ["*_dir.vpk"]},
+        "bsp": {"filters": ["*.bsp"]},
+    },
+    "processors": [
+        {"name": "copy", "convert_utf8": False, "filters": ["*.txt"]},
+        {"name": "protobufs", "filters": ["*.so"]},
+    ],
+}
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setattr(build, "CONFIG", CONFIG)
+
+
+def binary(*descriptors: bytes) -> bytes:
+    return b"\0" + b"\0".join(descriptors) + b"\0"
+
+
+@pytest.fixture
+def watch(config, tmp_path):
+    input_root = tmp_path.joinpath("in")
+    input_root.joinpath("docs").mkdir(parents=True)
+    input_root.joinpath("docs/a.txt").write_text("a\n")
+    input_root.joinpath("docs/b.txt").write_text("b\n")
+    input_root.joinpath("keep.txt").write_text("keep\n")
+    input_root.joinpath("small.so").write_bytes(binary(descriptor("shared.proto", "B")))
+    input_root.joinpath("big.so").write_bytes(binary(
+        descriptor("shared.proto", "A", "B"), descriptor("own.proto", "C"),
+    ))
+
+    return Watch(input_root, tmp_path.joinpath("out"), settle=0, poll=True)
+
+
+def manifest(watch: Watch) -> list[str]:
+    return load_manifest(watch.runner.output_root)["outputs"]
+
+
+def test_initial_run(watch):
+    assert manifest(watch) == [
+        "Protobufs/own.proto", "Protobufs/shared.proto", "docs/a.txt", "docs/b.txt", "keep.txt",
+    ]
+    shared = watch.runner.output_root.joinpath("Protobufs/shared.proto").read_text()
+    assert "message A" in shared and "message B" in shared
+
+
+def test_removed_files(watch):
+    input_root = watch.input_root
+    output_root = watch.runner.output_root
+    input_root.joinpath("keep.txt").unlink()
+    input_root.joinpath("docs/a.txt").unlink()
+    input_root.joinpath("docs/b.txt").write_text("changed\n")
+
+    watch.run_batch({input_root.joinpath("keep.txt"), input_root.joinpath("docs/a.txt"),
+                     input_root.joinpath("docs/b.txt")})
+
+    assert not output_root.joinpath("keep.txt").exists()
+    assert not output_root.joinpath("docs/a.txt").exists()
+    assert output_root.joinpath("docs/b.txt").read_text() == "changed\n"
+    assert "keep.txt" not in watch.runner.inventory.files
+    assert manifest(watch) == [
+        "Protobufs/own.proto", "Protobufs/shared.proto", "docs/b.txt",
+    ]
+
+    # A removed directory, reported as a whole
+    input_root.joinpath("docs/b.txt").unlink()
+    input_root.joinpath("docs").rmdir()
+    watch.run_batch({input_root.joinpath("docs")})
+    assert not output_root.joinpath("docs/b.txt").exists()
+    assert "docs/b.txt" not in manifest(watch)
+
+
+def test_shared_outputs(watch):
+    input_root = watch.input_root
+    shared = watch.runner.output_root.joinpath("Protobufs/shared.proto")
+
+    # The file with the best version is gone, the other one has to win again
+    input_root.joinpath("big.so").unlink()
+    watch.run_batch({input_root.joinpath("big.so")})
+
+    assert "message A" not in shared.read_text()
+    assert "message B" in shared.read_text()
+    assert manifest(watch) == ["Protobufs/shared.proto", "docs/a.txt", "docs/b.txt", "keep.txt"]
+
+    # A version that ranks lower than the one that was written
+    input_root.joinpath("small.so").write_bytes(binary(descriptor("shared.proto", "A")))
+    watch.run_batch({input_root.joinpath("small.so")})
+    assert "message A" in shared.read_text()
+    assert "message B" not in shared.read_text()
+
+    # Not in any file anymore
+    input_root.joinpath("small.so").write_bytes(b"no descriptors")
+    watch.run_batch({input_root.joinpath("small.so")})
+    assert not shared.exists()
+    assert manifest(watch) == ["docs/a.txt", "docs/b.txt", "keep.txt"]
+
+
+def test_rescan(watch):
+    input_root = watch.input_root
+    output_root = watch.runner.output_root
+    input_root.joinpath("keep.txt").unlink()
+    input_root.joinpath("docs/a.txt").write_text("rewritten\n")
+    input_root.joinpath("new.txt").write_text("new\n")
+
+    # Events were lost, so nothing is known about what changed
+    watch.run_batch(set(), rescan=True)
+
+    assert not output_root.joinpath("keep.txt").exists()
+    assert output_root.joinpath("docs/a.txt").read_text() == "rewritten\n"
+    assert output_root.joinpath("new.txt").read_text() == "new\n"
+    assert "new.txt" in manifest(watch)
+    assert "keep.txt" not in manifest(watch)
+
+
+def test_post_process_after_batch(watch, monkeypatch):
+    calls = []
+    monkeypatch.setattr(Processor, "post_process", lambda self: calls.append(self.name))
+
+    watch.input_root.joinpath("keep.txt").write_text("again\n")
+    watch.run_batch({watch.input_root.joinpath("keep.txt")})
+
+    assert sorted(calls) == ["copy", "protobufs"]
+
+
+def test_inotify_deletions(tmp_path):
+    tmp_path.joinpath("dir/sub").mkdir(parents=True)
+    tmp_path.joinpath("file.txt").write_text("x")
+    tmp_path.joinpath("dir/sub/inner.txt").write_text("x")
+    watcher = InotifyWatcher(tmp_path)
+
+    tmp_path.joinpath("file.txt").unlink()
+    tmp_path.joinpath("dir").rename(tmp_path.parent.joinpath(tmp_path.name + "-moved"))
+    tmp_path.joinpath("created.txt").write_text("x")
+
+    batch, rescan = watcher.wait_batch(0.1)
+    assert batch == {
+        tmp_path.joinpath("file.txt"), tmp_path.joinpath("dir"), tmp_path.joinpath("created.txt"),
+    }
+    assert not rescan
@@ -0,0 +1,115 @@
+from dataminer import echo_helper
+from dataminer.processor import ProcessorError, ToolTimeoutError
+from dataminer.worker import Worker, WorkerPool
+
+import os
+import sys
+
+import pytest
+
+HELPER = [sys.executable, echo_helper.__file__]
+
+
+def helper_pid(output: bytes) -> int:
+    last = output.splitlines()[-1]
+    assert last.startswith(b"pid ")
+    return int(last[4:])
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool()
+    yield pool
+    pool.close()
+
+
+def test_request(pool, tmp_path):
+    path = tmp_path.joinpath("input.bin")
+    path.write_bytes(b"x" * 1234)
+
+    output = pool.request(HELPER, [str(path), "second"])
+    lines = output.splitlines()
+    assert lines[:3] == [os.fsencode(path), b"second", b"1234"]
+
+    # The same helper answers the next request
+    again = pool.request(HELPER, ["other"])
+    assert again.splitlines()[0] == b"other"
+    assert helper_pid(again) == helper_pid(output)
+
+
+def test_worker_status():
+    worker = Worker(list(HELPER))
+    try:
+        status, output = worker.request(["fail"])
+        assert status == 1
+        assert output == b"failed on request"
+
+        status, output = worker.request(["ok"])
+        assert status == 0
+        assert output.splitlines()[0] == b"ok"
+    finally:
+        worker.close()
+    assert not worker.alive
+
+
+def test_nonzero_status(pool):
+    pid = helper_pid(pool.request(HELPER, ["first"]))
+
+    with pytest.raises(ProcessorError, match="status 1: failed on request"):
+        pool.request(HELPER, ["fail"])
+
+    # The response was complete, so the helper is still used
+    assert helper_pid(pool.request(HELPER, ["after"])) == pid
+
+
+def test_crash_respawns(pool):
+    pid = helper_pid(pool.request(HELPER, ["first"]))
+
+    with pytest.raises(ProcessorError, match="exited with code 3"):
+        pool.request(HELPER, ["crash"])
+
+    output = pool.request(HELPER, ["after"])
+    assert output.splitlines()[0] == b"after"
+    assert helper_pid(output) != pid
+
+
+def test_timeout_kills_helper(pool):
+    pid = helper_pid(pool.request(HELPER, ["first"]))
+
+    with pytest.raises(ToolTimeoutError):
+        pool.request(HELPER, ["hang"], timeout=0.5)
+
+    # Killed rather than left hanging
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+    assert helper_pid(pool.request(HELPER, ["after"], timeout=10)) != pid
+
+
+def test_max_output_bytes(pool):
+    with pytest.raises(ProcessorError, match="exceeded 8 bytes"):
+        pool.request(HELPER, ["a long argument"], max_output_bytes=8)
+
+    assert pool.request(HELPER, ["a"]).splitlines()[0] == b"a"
+
+
+def test_pooled_per_library_path(pool):
+    default = helper_pid(pool.request(HELPER, ["a"]))
+    env = dict(os.environ, LD_LIBRARY_PATH="/nonexistent")
+    other = helper_pid(pool.request(HELPER, ["b"], env=env))
+
+    assert other != default
+    assert helper_pid(pool.request(HELPER, ["c"], env=env)) == other
+    assert helper_pid(pool.request(HELPER, ["d"])) == default
+
+
+def test_close(pool):
+    pool.request(HELPER, ["a"])
+    workers = [worker for workers in pool.idle.values() for worker in workers]
+    assert len(workers) == 1
+
+    pool.close()
+
+    assert not workers[0].alive
+    assert workers[0].proc.returncode == 0
+    assert not pool.idle